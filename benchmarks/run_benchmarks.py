@@ -0,0 +1,204 @@
+""" Offline benchmarks of the parse, deduplicate, annotate, plot, top-k, rescore and alignment statistics
+stages on synthetic data.
+
+For every stage and size the throughput (rows per second) and the peak memory
+allocated while the stage runs (tracemalloc) are measured. Results are compared
+with a stored baseline and regressions beyond the tolerance fail the run. The
+baseline depends on the machine, so it is not committed: save one on the machine
+that runs the checks first, a check without a baseline fails (exit code 2).
+
+Usage:
+    python benchmarks/run_benchmarks.py                      # compare with baseline.json
+    python benchmarks/run_benchmarks.py --save-baseline      # store the results as the new baseline
+    python benchmarks/run_benchmarks.py --sizes 1000 20000 --stages parse plot
+"""
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+
+BENCHMARK_DIR = pathlib.Path(__file__).parent.absolute()
+sys.path.append(str(BENCHMARK_DIR.parent / 'foldseek_search'))
+
+from synthetic_data import (make_hits, write_m8_tree, write_annotation_caches, write_query_structures,
+                            make_annotated_table)
+from foldseek_parse_results import parse_foldseek_results
+from foldseek_annotate import annotate
+from foldseek_plot import plot_query_len_target_len
+from foldseek_topk import select_top_hits
+from structural_rescore import load_query_coordinates, rescore
+from deduplicate import deduplicate_hits
+from alignment_stats import alignment_stats
+
+
+def measure(func, rows):
+    """
+    Run func once and return its throughput, runtime and peak traced memory.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    # the stages report progress with print, which is not part of the benchmark
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_s': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_mb': round(peak / 2 ** 20, 2),
+    }
+
+
+def get_shape(size, args):
+    """
+    Number of queries and hits per query giving about `size` rows.
+    """
+    hits_per_query = max(size // (args.queries * args.databases), 1)
+    return dict(n_queries=args.queries, hits_per_query=hits_per_query, n_databases=args.databases,
+                tca_length=args.tca_length, n_species=args.species, seed=args.seed)
+
+
+def bench_parse(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_hits(**shape)
+    results_dir = write_m8_tree(df, tmp_dir / f'results_{size}')
+    return measure(lambda: parse_foldseek_results(results_dir), len(df))
+
+
+def bench_dedup(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_hits(**shape)
+    return measure(lambda: deduplicate_hits(df, minhash=args.minhash), len(df))
+
+
+def bench_annotate(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_hits(**shape)
+    script_dir = write_annotation_caches(tmp_dir / f'annotate_{size}', args.species)
+    write_query_structures(script_dir, df, args.seed)
+    return measure(lambda: annotate(df, script_dir), len(df))
+
+
+def bench_plot(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_annotated_table(**shape)
+    save_p = tmp_dir / f'plot_{size}.svg'
+    return measure(lambda: plot_query_len_target_len(df.copy(), save_p, hue='pident',
+                                                     density=args.density), len(df))
+
+
+def bench_topk(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_annotated_table(**shape)
+    return measure(lambda: select_top_hits([df]).to_frame(), len(df))
+
+
+def bench_rescore(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_hits(**shape)
+    query_coords = load_query_coordinates(write_query_structures(tmp_dir / f'rescore_{size}', df, args.seed))
+    return measure(lambda: rescore(df, query_coords), len(df))
+
+
+def bench_alnstats(size, args, tmp_dir):
+    shape = get_shape(size, args)
+    df = make_hits(**shape)
+    return measure(lambda: alignment_stats(df), len(df))
+
+
+def get_benchmarks():
+    """
+    Benchmark functions per stage.
+    """
+    return {
+        'parse': bench_parse,
+        'dedup': bench_dedup,
+        'annotate': bench_annotate,
+        'plot': bench_plot,
+        'topk': bench_topk,
+        'rescore': bench_rescore,
+        'alnstats': bench_alnstats,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    List regressions: throughput below or peak memory above the baseline by more than tolerance.
+    """
+    regressions = []
+    for stage, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(stage, {}).get(size)
+            if base is None:
+                continue
+            if base['rows_per_s'] and result['rows_per_s'] < base['rows_per_s'] * (1 - tolerance):
+                regressions.append(f"{stage} ({size} rows): {result['rows_per_s']} rows/s, "
+                                   f"baseline {base['rows_per_s']} rows/s")
+            if result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+                regressions.append(f"{stage} ({size} rows): {result['peak_mb']} MB peak, "
+                                   f"baseline {base['peak_mb']} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help='approximate number of hits per run')
+    parser.add_argument('--stages', nargs='+', default=list(get_benchmarks()), choices=list(get_benchmarks()))
+    parser.add_argument('--queries', type=int, default=20, help='number of queries')
+    parser.add_argument('--databases', type=int, default=4, help='number of databases (max 8)')
+    parser.add_argument('--tca-length', type=int, default=150, help='mean target length (tca / tseq size)')
+    parser.add_argument('--species', type=int, default=2_000, help='number of distinct species')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--density', action='store_true', help='benchmark the density plot mode')
+    parser.add_argument('--minhash', action='store_true', help='benchmark deduplication of near-identical targets')
+    parser.add_argument('--baseline', type=pathlib.Path, default=BENCHMARK_DIR / 'baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown / memory growth')
+    parser.add_argument('--output', type=pathlib.Path, default=None, help='write the results as json')
+    args = parser.parse_args()
+
+    benchmarks = get_benchmarks()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for stage in args.stages:
+            results[stage] = {}
+            for size in args.sizes:
+                result = benchmarks[stage](size, args, pathlib.Path(tmp))
+                # json keys are strings, so keep sizes as strings to compare with the baseline
+                results[stage][str(size)] = result
+                print(f"{stage:>9} {size:>9} rows: {result['rows_per_s']:>12} rows/s "
+                      f"{result['seconds']:>9} s {result['peak_mb']:>9} MB")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=1))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=1))
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        # without a baseline nothing was checked, which must not pass as a clean run
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        sys.exit(2)
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+    for r in regressions:
+        print(f"REGRESSION {r}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+""" Seeded synthetic foldseek results for benchmarks.
+
+Writes m8 result trees (one folder per query, one alis_<database>.m8 file per
+database) and builds annotated tables with the same columns as the real ones,
+together with species / lineage caches so annotation runs without network access.
+"""
+import pathlib
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+
+AMINO_ACIDS = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+
+
+def get_databases():
+    """
+    Result filenames of the foldseek databases, in the order they are used.
+    """
+    return ['alis_afdb50.m8', 'alis_afdb-swissprot.m8', 'alis_afdb-proteome.m8', 'alis_cath50.m8',
+            'alis_mgnify_esm30.m8', 'alis_pdb100.m8', 'alis_gmgcl_id.m8', 'alis_bfmd.m8']
+
+
+def get_species(n_species):
+    """
+    Synthetic species names, taxon IDs and lineages (about 70% bacteria).
+    """
+    taxon_ids = np.arange(n_species) + 1_000_000
+    names = [f'Synthetic species {i}' for i in range(n_species)]
+    lineages = []
+    for i in range(n_species):
+        if i % 10 < 7:
+            lineages.append(f'cellular organisms; Bacteria; Phylum{i % 13}; Class{i % 29}; Order{i % 53}; '
+                            f'Family{i % 97}; Genus{i % 211}')
+        else:
+            lineages.append(f'cellular organisms; Eukaryota; Phylum{i % 7}; Class{i % 17}; Order{i % 31}; '
+                            f'Family{i % 61}; Genus{i % 127}')
+    return names, taxon_ids, lineages
+
+
+def random_sequences(rng, lengths):
+    """
+    Random amino acid sequences of the given lengths.
+    """
+    total = int(np.sum(lengths))
+    letters = AMINO_ACIDS[rng.integers(0, len(AMINO_ACIDS), total)]
+    ends = np.cumsum(lengths)
+    return [''.join(letters[e - l:e]) for e, l in zip(ends, lengths)]
+
+
+def add_gaps(rng, seqs, rate=0.05):
+    """
+    Replace a fraction of the positions of each sequence with gaps.
+    """
+    gapped = []
+    for s in seqs:
+        chars = np.array(list(s))
+        chars[rng.random(len(chars)) < rate] = '-'
+        gapped.append(''.join(chars))
+    return gapped
+
+
+def make_hits(n_queries=10, hits_per_query=100, n_databases=4, tca_length=150, n_species=500, seed=0):
+    """
+    Synthetic parsed foldseek hits with the columns of foldseek_parse_results.
+
+    tca_length is the (mean) target length, which sets the size of the tca and tseq payloads.
+    """
+    rng = np.random.default_rng(seed)
+    databases = get_databases()[:n_databases]
+    names, taxon_ids, _ = get_species(n_species)
+    n = n_queries * hits_per_query * n_databases
+
+    query_i = np.repeat(np.arange(n_queries), hits_per_query * n_databases)
+    database_i = np.tile(np.repeat(np.arange(n_databases), hits_per_query), n_queries)
+    species_i = rng.integers(0, n_species, n)
+    query_len = rng.integers(8, 120, n_queries)[query_i]
+    target_len = np.maximum(rng.normal(tca_length, tca_length / 4, n).astype(int), 20)
+    alnlen = np.minimum(query_len, target_len) - rng.integers(0, 5, n)
+    alnlen = np.maximum(alnlen, 5)
+    qstart = rng.integers(1, np.maximum(query_len - alnlen, 1) + 1)
+    tstart = rng.integers(1, np.maximum(target_len - alnlen, 1) + 1)
+    pident = np.round(rng.uniform(5, 60, n), 1)
+    prob = np.round(rng.uniform(0, 1, n), 3)
+    evalue = 10 ** rng.uniform(-10, 1, n)
+
+    qaln = add_gaps(rng, random_sequences(rng, alnlen))
+    taln = add_gaps(rng, random_sequences(rng, alnlen))
+    tseq = random_sequences(rng, target_len)
+    tca = [','.join(f'{v:.3f}' for v in rng.normal(0, 20, 3 * l)) for l in target_len]
+
+    return pd.DataFrame({
+        'Query': [f'Synthetic_peptide_{i}_0ABC' for i in query_i],
+        'Filename': [databases[i] for i in database_i],
+        'Job ID': [f'job{i}' for i in query_i],
+        'Target and Description': [f'AF-A0A{i:06d}-F1-model_v4 synthetic protein' for i in rng.integers(0, n // 2 + 1, n)],
+        'pident': pident,
+        'alnlen': alnlen,
+        'Mismatch(not sure)': rng.integers(0, 20, n),
+        'Gapopen': rng.integers(0, 4, n),
+        'Query start': qstart,
+        'Query end': qstart + alnlen - 1,
+        'Target start': tstart,
+        'Target end': tstart + alnlen - 1,
+        'Probability': prob,
+        'E-value': evalue,
+        'Score(not sure)': rng.integers(10, 100, n),
+        'Query length': query_len,
+        'Target length': target_len,
+        'Qaln': qaln,
+        'Taln': taln,
+        'tca': tca,
+        'tseq': tseq,
+        'Taxid': taxon_ids[species_i],
+        'taxname/species': [names[i] for i in species_i],
+    })
+
+
+def write_m8_tree(df, results_dir):
+    """
+    Write hits as a foldseek results tree (<results_dir>/<query>/<database file>).
+    """
+    results_dir = pathlib.Path(results_dir)
+    columns = list(df.columns[2:])
+    for (query, filename), group in df.groupby(['Query', 'Filename'], sort=False):
+        query_dir = results_dir / query
+        query_dir.mkdir(parents=True, exist_ok=True)
+        group[columns].to_csv(query_dir / filename, sep='\t', header=False, index=False)
+    return results_dir
+
+
+def write_annotation_caches(script_dir, n_species):
+    """
+    Write the species -> taxon and taxon -> lineage caches and the GMrepo / MGnify lists
+    so that annotation finds every species without network lookups.
+    """
+    script_dir = pathlib.Path(script_dir)
+    script_dir.mkdir(parents=True, exist_ok=True)
+    names, taxon_ids, lineages = get_species(n_species)
+    pd.DataFrame({'Species': names, 'Taxon ID': taxon_ids}).to_csv(
+        script_dir / 'foldseek_species_to_taxon.csv', index=False)
+    pd.DataFrame({'Taxon ID': taxon_ids, 'Lineage': lineages}).to_csv(
+        script_dir / 'foldseek_taxon_to_lineage.csv', index=False)
+    # every third species is a known gut microbe
+    (script_dir / 'GMrepo_species_taxon_ids_morethan3.txt').write_text(
+        '\n'.join(str(t) for t in taxon_ids[::3]))
+    (script_dir / 'mgnify_human_gut_taxons.txt').write_text(
+        '\n'.join(str(t) for t in taxon_ids[::5]))
+    return script_dir
+
+
+def random_ca_trace(rng, length):
+    """
+    Random walk with the CA-CA distance of a protein backbone (3.8 A).
+    """
+    steps = rng.normal(0, 1, (length, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=1, keepdims=True)
+    return np.cumsum(steps, axis=0)
+
+
+def write_query_structures(script_dir, df, seed=0):
+    """
+    Write peptide_structures.zip with a random CA trace for every query of the hits.
+    """
+    rng = np.random.default_rng(seed)
+    script_dir = pathlib.Path(script_dir)
+    script_dir.mkdir(parents=True, exist_ok=True)
+    zip_p = script_dir / 'peptide_structures.zip'
+    with zipfile.ZipFile(zip_p, 'w') as z:
+        for query, length in df.groupby('Query')['Query length'].max().items():
+            lines = [f'ATOM  {i + 1:5d}  CA  ALA A{i + 1:4d}    {x:8.3f}{y:8.3f}{z_:8.3f}  1.00  0.00           C'
+                     for i, (x, y, z_) in enumerate(random_ca_trace(rng, int(length)))]
+            z.writestr(f'peptide_structures/{query}.pdb', '\n'.join(lines + ['END']))
+    return zip_p
+
+
+def make_annotated_table(n_queries=10, hits_per_query=100, n_databases=4, tca_length=150,
+                         n_species=500, seed=0):
+    """
+    Synthetic annotated hits with the column names used by foldseek_plot.
+    """
+    df = make_hits(n_queries, hits_per_query, n_databases, tca_length, n_species, seed)
+    names, taxon_ids, lineages = get_species(n_species)
+    species_i = df['Taxid'].values - 1_000_000
+    parts = [lineages[i].split('; ') for i in species_i]
+    df['Taxon ID'] = df['Taxid']
+    df['Lineage'] = [lineages[i] for i in species_i]
+    levels = ['Super Kingdom', 'Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+    for level_i, level in enumerate(levels):
+        df[level] = [p[level_i] if level_i < len(p) else None for p in parts]
+    df['Known Gut Microbe'] = species_i % 3 == 0
+    df = df.rename(columns={'Filename': 'Database', 'Probability': 'Prob.',
+                            'Target and Description': 'Target/Description'})
+    return df
@@ -0,0 +1,267 @@
+""" Alignment statistics of foldseek hits recomputed from the alignment strings (Qaln / Taln).
+
+Some m8 columns are labelled "not sure" by the parser (Mismatch(not sure),
+Score(not sure)); here the columns that follow from the alignment are recomputed
+and compared with the reported ones. The alignment strings of a chunk of hits are
+packed into fixed-width byte arrays (one array per power-of-two length bucket,
+padded with zeros) and all statistics are taken with array operations:
+
+    Verified alnlen           alignment columns
+    Verified pident           identical pairs per alignment column (in %, like foldseek)
+    Verified mismatch         aligned pairs that are not identical
+    Verified gapopen          runs of gaps in query or target
+    Verified gap extensions   gap columns after the first of a run
+    Verified query end / Verified target end   last aligned residue (1-based)
+    Query coverage / Target coverage           aligned residues per sequence length
+
+Hits whose alignment strings are missing or differ in length get missing values.
+The bit score (Score(not sure)) depends on the 3Di+AA substitution matrices and is
+not recomputed.
+
+Usage:
+    python alignment_stats.py          # writes foldseek_alignment_discrepancies.csv and ..._summary.csv
+"""
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from foldseek_parse_results import iter_foldseek_chunks, get_data_dir
+from instrumentation import get_report
+
+
+def get_verified_columns():
+    """
+    Verified columns and their dtypes.
+    """
+    return {
+        'Verified alnlen': 'Int32',
+        'Verified pident': 'Float32',
+        'Verified mismatch': 'Int32',
+        'Verified gapopen': 'Int32',
+        'Verified gap extensions': 'Int32',
+        'Verified query end': 'Int32',
+        'Verified target end': 'Int32',
+        'Query coverage': 'Float32',
+        'Target coverage': 'Float32',
+    }
+
+
+def get_checks():
+    """
+    Reported column -> (verified column, tolerance) of the discrepancy report.
+
+    pident is reported with one decimal, truncated from the identity fraction.
+    """
+    return {
+        'alnlen': ('Verified alnlen', 0),
+        'pident': ('Verified pident', 0.1 + 1e-6),
+        'Mismatch(not sure)': ('Verified mismatch', 0),
+        'Gapopen': ('Verified gapopen', 0),
+        'Query end': ('Verified query end', 0),
+        'Target end': ('Verified target end', 0),
+    }
+
+
+def pack_strings(strings, rows, width):
+    """
+    Strings of the given rows as a zero padded (len(rows), width) uint8 array.
+    """
+    strings = strings[rows]
+    lengths = np.fromiter((len(s) for s in strings), dtype=np.int64, count=len(strings))
+    buffer = np.frombuffer(''.join(strings).encode('ascii', 'replace'), dtype=np.uint8)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    columns = np.arange(width)
+    inside = columns[None, :] < lengths[:, None]
+    index = np.where(inside, starts[:, None] + columns[None, :], 0)
+    return np.where(inside, buffer[index] if len(buffer) else 0, 0).astype(np.uint8)
+
+
+def bucket_stats(q, t):
+    """
+    Counts per row of packed query and target alignment strings (uppercase, '-' for gaps).
+    """
+    gap = ord('-')
+    valid = q != 0
+    q_gap = valid & (q == gap)
+    t_gap = valid & (t == gap)
+    pairs = valid & ~q_gap & ~t_gap
+
+    def runs(is_gap):
+        # gap columns not preceded by a gap column of the same sequence
+        previous = np.zeros_like(is_gap)
+        previous[:, 1:] = is_gap[:, :-1]
+        return (is_gap & ~previous).sum(axis=1)
+
+    gap_opens = runs(q_gap) + runs(t_gap)
+    return {
+        'columns': valid.sum(axis=1),
+        'identical': (pairs & (q == t)).sum(axis=1),
+        'pairs': pairs.sum(axis=1),
+        'gap opens': gap_opens,
+        'gap columns': q_gap.sum(axis=1) + t_gap.sum(axis=1),
+        'query residues': (valid & ~q_gap).sum(axis=1),
+        'target residues': (valid & ~t_gap).sum(axis=1),
+    }
+
+
+def alignment_stats(df, max_cells=1 << 24):
+    """
+    Verified columns of hits (parse column names), indexed like df.
+
+    Hits are bucketed by the power of two above their alignment length, buckets
+    are packed in parts of at most max_cells bytes.
+    """
+    n = len(df)
+    qaln = df['Qaln'].fillna('').astype(str).str.upper().to_numpy()
+    taln = df['Taln'].fillna('').astype(str).str.upper().to_numpy()
+    lengths = np.fromiter((len(s) for s in qaln), dtype=np.int64, count=n)
+    consistent = (lengths > 0) & (lengths == np.fromiter((len(s) for s in taln), dtype=np.int64, count=n))
+
+    counts = {name: np.zeros(n, dtype=np.int64) for name in
+              ['columns', 'identical', 'pairs', 'gap opens', 'gap columns', 'query residues', 'target residues']}
+    widths = np.where(consistent, 1 << np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64), 0)
+    for width in np.unique(widths[consistent]):
+        bucket = np.flatnonzero(widths == width)
+        step = max(max_cells // int(width), 1)
+        for start in range(0, len(bucket), step):
+            rows = bucket[start:start + step]
+            stats = bucket_stats(pack_strings(qaln, rows, width), pack_strings(taln, rows, width))
+            for name, values in stats.items():
+                counts[name][rows] = values
+
+    query_start = pd.to_numeric(df['Query start'], errors='coerce').to_numpy(dtype=float)
+    target_start = pd.to_numeric(df['Target start'], errors='coerce').to_numpy(dtype=float)
+    query_length = pd.to_numeric(df['Query length'], errors='coerce').to_numpy(dtype=float)
+    target_length = pd.to_numeric(df['Target length'], errors='coerce').to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = {
+            'Verified alnlen': counts['columns'],
+            'Verified pident': 100 * counts['identical'] / counts['columns'],
+            'Verified mismatch': counts['pairs'] - counts['identical'],
+            'Verified gapopen': counts['gap opens'],
+            'Verified gap extensions': counts['gap columns'] - counts['gap opens'],
+            'Verified query end': query_start + counts['query residues'] - 1,
+            'Verified target end': target_start + counts['target residues'] - 1,
+            'Query coverage': counts['query residues'] / query_length,
+            'Target coverage': counts['target residues'] / target_length,
+        }
+    stats = pd.DataFrame(index=df.index)
+    for name, dtype in get_verified_columns().items():
+        column = pd.Series(values[name], index=df.index, dtype=float)
+        column = column.where(consistent & np.isfinite(column.to_numpy()))
+        stats[name] = column.round().astype(dtype) if dtype == 'Int32' else column.astype(dtype)
+    return stats
+
+
+def add_alignment_stats(df):
+    """
+    Add the verified columns to parsed hits.
+    """
+    stats = alignment_stats(df)
+    for column in stats.columns:
+        df[column] = stats[column].values
+    return df
+
+
+def compare(df, stats):
+    """
+    Per reported column: which values could be checked and their absolute difference to the verified value.
+    """
+    comparison = {}
+    for reported, (verified, _) in get_checks().items():
+        reported_values = pd.to_numeric(df[reported], errors='coerce').to_numpy(dtype=float)
+        verified_values = stats[verified].to_numpy(dtype=float, na_value=np.nan)
+        checked = np.isfinite(reported_values) & np.isfinite(verified_values)
+        comparison[reported] = checked, np.where(checked, np.abs(reported_values - verified_values), 0)
+    return comparison
+
+
+def get_discrepancy_columns():
+    """
+    Columns of the discrepancy report.
+    """
+    columns = ['Query', 'Filename', 'Target and Description', 'Discrepancies']
+    for reported, (verified, _) in get_checks().items():
+        columns.extend([reported, verified])
+    return columns
+
+
+def find_discrepancies(df, stats=None):
+    """
+    Rows whose reported columns differ from the verified ones, with both values.
+
+    The Discrepancies column lists the reported columns that differ.
+    """
+    stats = alignment_stats(df) if stats is None else stats
+    checks = get_checks()
+    differs = np.zeros((len(df), len(checks)), dtype=bool)
+    for i, (reported, (checked, diff)) in enumerate(compare(df, stats).items()):
+        differs[:, i] = checked & (diff > checks[reported][1])
+    rows = differs.any(axis=1)
+
+    report = pd.DataFrame(index=df.index[rows], columns=get_discrepancy_columns())
+    for column in ['Query', 'Filename', 'Target and Description']:
+        report[column] = df[column].values[rows]
+    names = np.array(list(checks))
+    report['Discrepancies'] = [';'.join(names[flags]) for flags in differs[rows]]
+    for reported, (verified, _) in checks.items():
+        report[reported] = df[reported].values[rows]
+        report[verified] = stats[verified].values[rows]
+    return report.reset_index(drop=True)
+
+
+def summarize_discrepancies(df, stats=None):
+    """
+    Number of checked and discrepant values and the largest difference per reported column.
+    """
+    stats = alignment_stats(df) if stats is None else stats
+    checks = get_checks()
+    summary = []
+    for reported, (checked, diff) in compare(df, stats).items():
+        summary.append({'Column': reported, 'Verified column': checks[reported][0], 'Checked': int(checked.sum()),
+                        'Discrepant': int((checked & (diff > checks[reported][1])).sum()),
+                        'Max difference': float(diff[checked].max()) if checked.any() else np.nan})
+    return pd.DataFrame(summary)
+
+
+def combine_summaries(summaries):
+    """
+    Sum the per chunk summaries of summarize_discrepancies.
+    """
+    combined = pd.concat(summaries).groupby(['Column', 'Verified column'], sort=False)
+    return combined.agg({'Checked': 'sum', 'Discrepant': 'sum', 'Max difference': 'max'}).reset_index()
+
+
+def main():
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    results_dir = get_data_dir() / 'foldseek_results'
+
+    # the report is written chunk by chunk, only the summary is kept in memory
+    report = get_report()
+    summaries = []
+    discrepancies_p = script_dir / 'foldseek_alignment_discrepancies.csv'
+    pd.DataFrame(columns=get_discrepancy_columns()).to_csv(discrepancies_p, index=False)
+    n_discrepant = 0
+    with report.stage('alignment statistics') as stage:
+        stage['items'] = 0
+        for chunk in iter_foldseek_chunks(results_dir):
+            stats = alignment_stats(chunk)
+            summaries.append(summarize_discrepancies(chunk, stats))
+            rows = find_discrepancies(chunk, stats)
+            rows.to_csv(discrepancies_p, mode='a', header=False, index=False)
+            n_discrepant += len(rows)
+            stage['items'] += len(chunk)
+
+    if len(summaries) == 0:
+        print("No foldseek results found")
+        return
+    summary = combine_summaries(summaries)
+    print(summary.to_string(index=False))
+    summary.to_csv(script_dir / 'foldseek_alignment_discrepancy_summary.csv', index=False)
+    print(f"Hits with discrepancies: {n_discrepant}, written to {discrepancies_p}")
+    report.write()
+
+
+if __name__ == "__main__":
+    main()
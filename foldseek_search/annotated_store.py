@@ -0,0 +1,223 @@
+""" Partitioned store of the annotated foldseek results.
+
+The annotated hits are stored as one Parquet file per Query and Database
+(result file) under the dataset directory:
+
+    foldseek_annotated/<Query>/<m8 filename>.parquet
+    foldseek_annotated/_manifest.json
+
+The manifest records the checksum of the m8 file each partition was built from,
+the version of the annotation and its number of rows (result files without
+non-human hits have no Parquet file), so a run only parses and annotates result
+files that are new or changed, or were annotated by an older version.
+Readers see the union of all partitions (files starting with '_' are ignored).
+The summary per Query, Database and Kingdom (_summary.parquet, see
+summary_index.py) is updated with every written partition.
+"""
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+
+import pandas as pd
+
+from foldseek_parse_results import (find_result_files, iter_m8_rows, to_dataframe, convert_numeric,
+                                    format_parse_filter)
+from summary_index import get_summary_path, update_summary
+
+
+def get_dataset_dir():
+    """
+    Default location of the partitioned annotated results.
+    """
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    return script_dir / 'foldseek_annotated'
+
+
+def file_checksum(path):
+    """
+    sha256 checksum of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_source_key(file_path):
+    """
+    Manifest key of a result file: '<query>/<filename>'.
+    """
+    file_path = pathlib.Path(file_path)
+    return f'{file_path.parent.name}/{file_path.name}'
+
+
+def get_partition_path(dataset_dir, source_key):
+    """
+    Parquet file of the partition built from a result file.
+    """
+    query, filename = source_key.split('/')
+    return pathlib.Path(dataset_dir) / query / f'{filename}.parquet'
+
+
+def read_manifest(dataset_dir):
+    """
+    Load the manifest (source key -> {'sha256', 'version', 'rows'}) or an empty one.
+    """
+    manifest_p = pathlib.Path(dataset_dir) / '_manifest.json'
+    if manifest_p.exists():
+        return json.loads(manifest_p.read_text())
+    return {}
+
+
+def write_manifest(dataset_dir, manifest):
+    """
+    Atomically replace the manifest.
+    """
+    manifest_p = pathlib.Path(dataset_dir) / '_manifest.json'
+    tmp_p = manifest_p.with_suffix('.json.tmp')
+    tmp_p.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    os.replace(tmp_p, manifest_p)
+
+
+def find_changes(results_dir, dataset_dir, version=None):
+    """
+    Compare the result files with the manifest.
+
+    Returns the checksums of new or changed files (or of files annotated with
+    another version) and the keys of partitions whose result file no longer exists.
+    """
+    manifest = read_manifest(dataset_dir)
+    changed = {}
+    current = set()
+    for file_path in find_result_files(results_dir):
+        key = get_source_key(file_path)
+        current.add(key)
+        checksum = file_checksum(file_path)
+        entry = manifest.get(key, {})
+        missing = entry.get('rows', 0) > 0 and not get_partition_path(dataset_dir, key).exists()
+        if entry.get('sha256') != checksum or entry.get('version') != version or missing:
+            changed[file_path] = checksum
+    removed = [key for key in manifest if key not in current]
+    return changed, removed
+
+
+def write_partition(dataset_dir, source_key, df):
+    """
+    Write the annotated rows of a single result file (an empty partition has no file).
+    """
+    partition_p = get_partition_path(dataset_dir, source_key)
+    if len(df) == 0:
+        if partition_p.exists():
+            partition_p.unlink()
+        return
+    partition_p.parent.mkdir(parents=True, exist_ok=True)
+    tmp_p = partition_p.with_name(f'_{partition_p.name}.tmp')
+    df.to_parquet(tmp_p, index=False)
+    os.replace(tmp_p, partition_p)
+
+
+def get_summary_source_columns():
+    """
+    Annotated columns read by the summary.
+    """
+    return ['Query', 'Filename', 'kingdom', 'E-value', 'pident', 'Probability',
+            'KnownGutMicrobe(GMrepo)', 'KnownGutMicrobe(MGnify)']
+
+
+def rebuild_summary(dataset_dir, manifest):
+    """
+    Summarize all existing partitions (datasets written before the summary existed).
+    """
+    parts = {}
+    for key, entry in manifest.items():
+        partition_p = get_partition_path(dataset_dir, key)
+        if entry.get('rows', 0) > 0 and partition_p.exists():
+            df = pd.read_parquet(partition_p)
+            parts[key] = df[[c for c in get_summary_source_columns() if c in df.columns]]
+    return update_summary(dataset_dir, parts)
+
+
+def get_batches(paths, batch_files, by_query=False):
+    """
+    Split result files into batches of about batch_files files (whole queries with by_query).
+    """
+    if not by_query:
+        return [paths[start:start + batch_files] for start in range(0, len(paths), batch_files)]
+    batches = [[]]
+    for query, group in itertools.groupby(sorted(paths), key=lambda p: pathlib.Path(p).parent.name):
+        if len(batches[-1]) >= batch_files:
+            batches.append([])
+        batches[-1].extend(group)
+    return [batch for batch in batches if batch]
+
+
+def update_annotated_dataset(results_dir, dataset_dir, annotate, batch_files=100, version=None, by_query=False,
+                             parse_filter=None):
+    """
+    Annotate and write only the result files that are new or changed since the last run.
+
+    annotate takes a parsed DataFrame and returns it annotated, version identifies
+    the annotation (a new version annotates all files again). With by_query all
+    result files of a query are annotated together whenever one of them changed
+    (for steps across databases like deduplicate.py). parse_filter drops hits while
+    the m8 files are read, it is part of the version. Files are handled
+    in batches of batch_files, and the manifest is saved after every batch, so an
+    interrupted run continues where it stopped. The summary is updated before
+    the manifest, so keys that are not yet in the manifest are summarized again
+    on the next run. Returns the written source keys.
+    """
+    dataset_dir = pathlib.Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    if format_parse_filter(parse_filter):
+        version = f'{version} {format_parse_filter(parse_filter)}'
+    changed, removed = find_changes(results_dir, dataset_dir, version)
+    manifest = read_manifest(dataset_dir)
+    print(f"Result files changed: {len(changed)}, removed: {len(removed)}")
+    if by_query:
+        queries = {pathlib.Path(p).parent.name for p in changed} | {key.split('/')[0] for key in removed}
+        for file_path in find_result_files(results_dir):
+            if pathlib.Path(file_path).parent.name in queries and file_path not in changed:
+                changed[file_path] = file_checksum(file_path)
+
+    for key in removed:
+        partition_p = get_partition_path(dataset_dir, key)
+        if partition_p.exists():
+            partition_p.unlink()
+        del manifest[key]
+    if not get_summary_path(dataset_dir).exists():
+        rebuild_summary(dataset_dir, manifest)
+    update_summary(dataset_dir, {}, removed)
+    write_manifest(dataset_dir, manifest)
+
+    written = []
+    for batch in get_batches(list(changed), batch_files, by_query):
+        rows = [row for file_path in batch for row in iter_m8_rows(file_path, parse_filter)]
+        df = convert_numeric(to_dataframe(rows))
+        if len(df) > 0:
+            df = annotate(df)
+
+        # split the annotated batch back into one partition per result file
+        groups = dict(list(df.groupby(['Query', 'Filename'], sort=False)))
+        parts = {}
+        for file_path in batch:
+            key = get_source_key(file_path)
+            query, filename = key.split('/')
+            parts[key] = groups.get((query, filename), df.iloc[:0])
+            write_partition(dataset_dir, key, parts[key])
+        update_summary(dataset_dir, parts)
+        for file_path in batch:
+            key = get_source_key(file_path)
+            manifest[key] = {'sha256': changed[file_path], 'version': version, 'rows': len(parts[key])}
+            written.append(key)
+        write_manifest(dataset_dir, manifest)
+    return written
+
+
+def read_annotated_dataset(dataset_dir, columns=None):
+    """
+    Read the union of all partitions.
+    """
+    return pd.read_parquet(dataset_dir, columns=columns)
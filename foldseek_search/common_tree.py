@@ -0,0 +1,219 @@
+""" Common tree of a set of taxa from the local NCBI taxonomy, with per-clade hit rollups.
+
+Replaces uploading taxid lists to https://www.ncbi.nlm.nih.gov/Taxonomy/CommonTree.
+The tree is induced by the paths of the taxa to the root; unranked nodes with a
+single child are collapsed. It is written in the text format of the CommonTree
+page (foldseek_tree_common.txt) and as a table with, for every clade, the number
+of hits, the best E-value and the number of distinct queries below it.
+
+Text format: a line per top-level clade followed by its subtree, where children
+are prefixed with '+' (more siblings follow) or '\\' (last child), then '+' if
+nodes between the clade and (some of) its children were collapsed and '-' otherwise.
+
+Usage:
+    python common_tree.py                              # taxa of the annotated foldseek hits
+    python common_tree.py --taxids mgnify_human_gut_taxons.txt --output mgnify_tree_common
+"""
+import argparse
+import pathlib
+import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from taxonomy_index import load_taxonomy_index, load_taxon_names, read_taxon_list
+
+
+def get_tree_ranks():
+    """
+    Ranks that are shown even if the clade has a single child.
+    """
+    return ['realm', 'domain', 'superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus',
+            'species']
+
+
+def get_hidden_taxa():
+    """
+    Taxa that are never shown (root and cellular organisms), their children become top-level clades.
+    """
+    return {1, 131567}
+
+
+def build_common_tree(taxon_ids, index, names=None, keep_ranks=None, hidden_taxa=None):
+    """
+    Induced tree of the taxa as a table in pre-order (children sorted by name).
+
+    names is a dict taxid -> name or a function returning it for a list of taxids.
+
+    Columns: Taxon ID, Name, Rank, Parent (shown parent, -1 for top-level clades), Depth,
+    Selected (in taxon_ids) and Collapsed (nodes between the clade and a child were left out).
+    """
+    keep_ranks = set(get_tree_ranks() if keep_ranks is None else keep_ranks)
+    hidden_taxa = get_hidden_taxa() if hidden_taxa is None else set(hidden_taxa)
+    ids = index.to_current(taxon_ids)
+    selected = set(ids[(ids >= 0)].tolist())
+    selected = {t for t in selected if index.tin[t] >= 0}
+
+    # union of the paths to the root
+    tree_parent = {}
+    n_children = Counter()
+    for taxid in selected:
+        node = taxid
+        while node >= 0 and node not in tree_parent:
+            parent = int(index.parent[node])
+            parent = -1 if parent == node else parent
+            tree_parent[node] = parent
+            if parent >= 0:
+                n_children[parent] += 1
+            node = parent
+
+    def is_shown(node):
+        if node in selected:
+            return True
+        if node in hidden_taxa:
+            return False
+        rank = index.rank[node] if index.rank is not None else ''
+        return n_children[node] >= 2 or rank in keep_ranks
+
+    shown = {node for node in tree_parent if is_shown(node)}
+
+    # closest shown ancestor of every shown node
+    shown_parent = {}
+    collapsed = set()
+    for node in shown:
+        parent = tree_parent[node]
+        while parent >= 0 and parent not in shown:
+            parent = tree_parent[parent]
+        shown_parent[node] = parent
+        if parent >= 0 and parent != tree_parent[node]:
+            collapsed.add(parent)
+
+    if callable(names):
+        names = names(sorted(shown))
+    names = names or {}
+    children = {}
+    for node, parent in shown_parent.items():
+        children.setdefault(parent, []).append(node)
+    for nodes in children.values():
+        nodes.sort(key=lambda n: (names.get(n, ''), n))
+
+    rows = []
+    stack = [(node, 0) for node in reversed(children.get(-1, []))]
+    while stack:
+        node, depth = stack.pop()
+        rows.append((node, names.get(node, str(node)),
+                     index.rank[node] if index.rank is not None else '',
+                     shown_parent[node], depth, node in selected, node in collapsed))
+        stack.extend((child, depth + 1) for child in reversed(children.get(node, [])))
+    return pd.DataFrame(rows, columns=['Taxon ID', 'Name', 'Rank', 'Parent', 'Depth', 'Selected', 'Collapsed'])
+
+
+def rollup_hits(tree, hits, index, taxon_column='Taxon ID', query_column='Query', evalue_column='E-value'):
+    """
+    Add hit counts, the best E-value and the number of distinct queries of every clade.
+
+    Hits are counted at their taxon (Direct hits) and summed up to the top-level
+    clades in one bottom-up pass over the tree, queries are kept as bitsets.
+    """
+    n = len(tree)
+    position = pd.Series(np.arange(n), index=tree['Taxon ID'].values)
+    ids = pd.Series(index.to_current(hits[taxon_column]))
+    pos = ids.map(position).to_numpy(dtype=float, na_value=np.nan)
+    in_tree = ~np.isnan(pos)
+    pos = pos[in_tree].astype(np.int64)
+
+    direct = np.bincount(pos, minlength=n)
+    best = np.full(n, np.inf)
+    # fmin ignores missing E-values
+    np.fmin.at(best, pos, hits[evalue_column].to_numpy(dtype=float, na_value=np.nan)[in_tree])
+    query_codes, _ = pd.factorize(hits[query_column].values[in_tree])
+    bits = [0] * n
+    for p, q in set(zip(pos.tolist(), query_codes.tolist())):
+        if q >= 0:
+            bits[p] |= 1 << q
+
+    # rows are in pre-order, so every child comes after its parent
+    clade_hits = direct.copy()
+    parent_pos = tree['Parent'].map(position).fillna(-1).astype(np.int64).values
+    for i in range(n - 1, -1, -1):
+        p = parent_pos[i]
+        if p >= 0:
+            clade_hits[p] += clade_hits[i]
+            best[p] = min(best[p], best[i])
+            bits[p] |= bits[i]
+
+    tree = tree.copy()
+    tree['Direct hits'] = direct
+    tree['Hits'] = clade_hits
+    tree['Best E-value'] = np.where(np.isinf(best), np.nan, best)
+    tree['Queries'] = [bin(b).count('1') for b in bits]
+    return tree
+
+
+def format_tree(tree):
+    """
+    Lines of the tree in the text format of the NCBI CommonTree page.
+    """
+    children = {}
+    for row in tree.itertuples(index=False):
+        children.setdefault(row.Parent, []).append(row)
+
+    def push(stack, rows, prefix):
+        stack.extend((row, prefix, i == len(rows) - 1) for i, row in reversed(list(enumerate(rows))))
+
+    lines = []
+    for top in children.get(-1, []):
+        lines.append(top.Name)
+        stack = []
+        push(stack, children.get(top[0], []), '')
+        while stack:
+            row, prefix, last = stack.pop()
+            node_children = children.get(row[0], [])
+            marker = ('\\' if last else '+') + ('+' if row.Collapsed and node_children else '-')
+            lines.append(prefix + marker + row.Name)
+            push(stack, node_children, prefix + ('  ' if last else '| '))
+        lines.append('-' * 35)
+    return lines
+
+
+def write_common_tree(tree, output_p):
+    """
+    Write the tree as text (<output>.txt) and as a table (<output>.csv).
+    """
+    output_p = pathlib.Path(output_p)
+    output_p.with_suffix('.txt').write_text('\n'.join(format_tree(tree)) + '\n')
+    tree.to_csv(output_p.with_suffix('.csv'), index=False)
+    return output_p.with_suffix('.txt'), output_p.with_suffix('.csv')
+
+
+def main():
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--taxids', type=pathlib.Path, default=None,
+                        help='file with one taxid per line (default: taxa of the annotated foldseek hits)')
+    parser.add_argument('--output', type=pathlib.Path, default=script_dir / 'foldseek_tree_common',
+                        help='output path without suffix, .txt and .csv are written')
+    parser.add_argument('--taxdump-dir', type=pathlib.Path, default=None)
+    args = parser.parse_args()
+
+    index = load_taxonomy_index(args.taxdump_dir)
+    if index is None:
+        sys.exit("No NCBI taxdump found, download it with taxonomy_index.download_taxdump()")
+
+    if args.taxids:
+        hits = pd.DataFrame({'Taxon ID': read_taxon_list(args.taxids), 'Query': None, 'E-value': np.nan})
+    else:
+        from annotated_store import get_dataset_dir, read_annotated_dataset
+        hits = read_annotated_dataset(get_dataset_dir(), columns=['Query', 'Taxon ID', 'E-value'])
+
+    taxon_ids = hits['Taxon ID'].dropna().unique()
+    tree = build_common_tree(taxon_ids, index, names=lambda taxids: load_taxon_names(args.taxdump_dir, taxids))
+    tree = rollup_hits(tree, hits, index)
+    print(f"{len(taxon_ids)} taxa, {len(tree)} clades in the common tree")
+    for p in write_common_tree(tree, args.output):
+        print(f"Written {p}")
+
+
+if __name__ == "__main__":
+    main()
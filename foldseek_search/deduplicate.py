@@ -0,0 +1,192 @@
+""" Collapse hits of the same target found in several foldseek databases.
+
+The same protein is often a hit of a query in afdb50, afdb-proteome,
+afdb-swissprot. Per query, hits are keyed on a hash of the target sequence
+(tseq) and the target accession (the UniProt accession of AlphaFold models),
+and every group of duplicates is replaced by one representative chosen by a
+tie-break. The representative keeps the number of copies and the list of
+databases they came from (Copies, Source databases).
+
+With minhash=True near-identical sequences of the same accession are collapsed
+as well (e.g. the models of an accession in databases built from different
+releases): MinHash signatures of the k-mers of every target sequence are
+bucketed with banded locality sensitive hashing, and hits of a query and
+accession whose signatures agree on at least `threshold` of the hashes
+(estimated Jaccard similarity) are merged. Different accessions are never
+merged, so their taxa are kept.
+
+Counts per database should expand the representatives to all of their source
+databases (expand_source_databases), otherwise the databases that lost their
+copies to a representative are undercounted.
+"""
+import numpy as np
+import pandas as pd
+
+
+def get_tie_breaks():
+    """
+    Ranking (columns, ascending) of the copies of a target, the first one is kept.
+    """
+    return {
+        'evalue': (['E-value', 'Score(not sure)'], [True, False]),
+        'prob': (['Probability', 'E-value'], [False, True]),
+        'pident': (['pident', 'E-value'], [False, True]),
+        'score': (['Score(not sure)', 'E-value'], [False, True]),
+    }
+
+
+def get_database_name(filenames):
+    """
+    Short database names of result filenames ('alis_afdb50.m8' -> 'afdb50').
+    """
+    return pd.Series(filenames).fillna('').astype(str).str.replace(r'^alis_', '', regex=True).str.replace(
+        r'\.m8$', '', regex=True)
+
+
+def get_target_accession(targets):
+    """
+    Accession of the target (UniProt accession of AlphaFold models, otherwise the target name).
+    """
+    name = pd.Series(targets).fillna('').astype(str).str.split(' ', n=1).str[0]
+    uniprot = name.str.extract(r'^AF-([A-Za-z0-9]+)-F\d+', expand=False)
+    return uniprot.fillna(name)
+
+
+def get_target_keys(df):
+    """
+    Hash of the target sequence and accession.
+
+    Identical sequences under different accessions (e.g. an afdb50 and an
+    mgnify_esm30 entry of different species) are different targets, so their
+    taxa are kept.
+    """
+    seqs = df['tseq'].fillna('').astype(str).str.upper()
+    accessions = get_target_accession(df['Target and Description'])
+    key_source = pd.DataFrame({'tseq': seqs.to_numpy(), 'accession': accessions.to_numpy()})
+    return pd.util.hash_pandas_object(key_source, index=False).to_numpy()
+
+
+def minhash_signatures(seqs, k=5, num_perm=32, seed=0):
+    """
+    MinHash signatures (n, num_perm) of the k-mer sets of sequences.
+
+    Sequences shorter than k get a signature of -1, which never matches another one.
+    """
+    seqs = pd.Series(seqs).fillna('').astype(str).str.upper()
+    lengths = seqs.str.len().to_numpy()
+    codes = np.frombuffer(''.join(seqs).encode('ascii', 'replace'), dtype=np.uint8).astype(np.int64) & 31
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    n_kmers = np.maximum(lengths - k + 1, 0)
+
+    # k-mers as 5 bit per letter integers, only those inside a sequence
+    positions = np.repeat(starts - np.concatenate([[0], np.cumsum(n_kmers)[:-1]]), n_kmers) + np.arange(n_kmers.sum())
+    kmers = np.zeros(len(positions), dtype=np.int64)
+    for j in range(k):
+        kmers = (kmers << 5) | codes[positions + j]
+
+    prime = (1 << 31) - 1
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, prime, num_perm)
+    b = rng.integers(0, prime, num_perm)
+    signatures = np.full((len(seqs), num_perm), -1, dtype=np.int64)
+    has_kmers = n_kmers > 0
+    segment_starts = np.concatenate([[0], np.cumsum(n_kmers)[:-1]])[has_kmers]
+    for i in range(num_perm):
+        hashes = (a[i] * (kmers % prime) + b[i]) % prime
+        if len(hashes):
+            signatures[has_kmers, i] = np.minimum.reduceat(hashes, segment_starts)
+    return signatures
+
+
+def find_near_duplicates(signatures, groups, bands=8, threshold=0.9):
+    """
+    Label of the cluster of near-identical signatures within each group (e.g. query).
+    """
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    valid = np.flatnonzero(signatures[:, 0] >= 0)
+    for band in range(bands):
+        band_sig = signatures[valid, band * rows:(band + 1) * rows]
+        bucket = pd.util.hash_pandas_object(
+            pd.DataFrame(band_sig).assign(group=np.asarray(groups)[valid]), index=False).to_numpy()
+        order = np.argsort(bucket, kind='stable')
+        run_starts = np.flatnonzero(np.diff(bucket[order], prepend=bucket[order][0] - 1) != 0)
+        run_ends = np.append(run_starts[1:], len(order))
+        for start, end in zip(run_starts[run_ends - run_starts > 1], run_ends[run_ends - run_starts > 1]):
+            # compare the members of a bucket with its first member
+            members = valid[order[start:end]]
+            first = members[0]
+            similar = (signatures[members[1:]] == signatures[first]).mean(axis=1) >= threshold
+            for other in members[1:][similar]:
+                root_a, root_b = find(first), find(other)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+    return np.array([find(i) for i in range(n)])
+
+
+def deduplicate_hits(df, tie_break='evalue', minhash=False, threshold=0.9):
+    """
+    Keep one hit per query and target, with the number of copies and their source databases.
+
+    Uses the parse column names. Rows keep their order.
+    """
+    if len(df) == 0:
+        return df.assign(**{'Copies': pd.Series(dtype='int64'), 'Source databases': pd.Series(dtype='string')})
+    columns, ascending = get_tie_breaks()[tie_break]
+
+    keys = get_target_keys(df)
+    groups = pd.DataFrame({'Query': df['Query'].values, 'key': keys}).groupby(['Query', 'key'], sort=False).ngroup()
+    groups = groups.to_numpy()
+    if minhash:
+        # one signature per group of identical targets, merged into clusters of near-identical ones
+        # of the same query and accession only
+        first = pd.Series(np.arange(len(df))).groupby(groups).first().to_numpy()
+        signatures = minhash_signatures(df['tseq'].values[first])
+        accessions = get_target_accession(df['Target and Description'].values[first])
+        within = pd.DataFrame({'Query': df['Query'].values[first], 'accession': accessions.to_numpy()})
+        within = within.groupby(['Query', 'accession'], sort=False, dropna=False).ngroup().to_numpy()
+        clusters = find_near_duplicates(signatures, within, threshold=threshold)
+        groups = clusters[groups]
+
+    # rank the copies of every group by the tie-break, the first one represents the group
+    ranking = pd.DataFrame({c: df[c].values for c in columns}).assign(group=groups, row=np.arange(len(df)))
+    ranking = ranking.sort_values(['group'] + columns + ['row'], ascending=[True] + ascending + [True],
+                                  na_position='last', kind='stable')
+    keep = np.sort(ranking['row'].values[~ranking['group'].duplicated().values])
+
+    # source databases of every group as a bit mask, then one string per distinct mask
+    # (missing filenames are named '', a factorize code of -1 would shift by a negative count)
+    database_codes, database_names = pd.factorize(get_database_name(df['Filename'].values), sort=True)
+    masks = np.zeros(groups.max() + 1, dtype=np.int64)
+    np.bitwise_or.at(masks, groups, np.left_shift(1, database_codes, dtype=np.int64))
+    mask_names = {m: ';'.join(name for i, name in enumerate(database_names) if (m >> i) & 1)
+                  for m in set(masks[groups[keep]].tolist())}
+
+    deduplicated = df.iloc[keep].copy()
+    deduplicated['Copies'] = np.bincount(groups)[groups[keep]]
+    deduplicated['Source databases'] = pd.array([mask_names[m] for m in masks[groups[keep]]], dtype='string')
+    return deduplicated
+
+
+def expand_source_databases(df, filename_column='Filename'):
+    """
+    One row per hit and source database of its copies, with the database as result filename.
+
+    Hits without Source databases (not deduplicated) keep their own file. The
+    scores of the rows are those of the representative.
+    """
+    if 'Source databases' not in df.columns or len(df) == 0:
+        return df
+    own = pd.Series(get_database_name(df[filename_column].values).values, index=df.index)
+    sources = df['Source databases'].astype('string').fillna(own.astype('string')).str.split(';')
+    expanded = df.iloc[np.repeat(np.arange(len(df)), sources.str.len().to_numpy())].copy()
+    expanded[filename_column] = ['alis_' + name + '.m8' for names in sources for name in names]
+    return expanded
@@ -1,12 +1,21 @@
+import argparse
 import pandas as pd
 import numpy as np
 import os
 import sys
 import pathlib
-import time
 
 from species_name_to_taxon_id import get_taxon_id_uniprot
 from taxon_to_lineage import get_taxon_lineage_batch
+from foldseek_parse_results import get_data_dir, add_filter_arguments, get_parse_filter
+from annotated_store import get_dataset_dir, update_annotated_dataset
+from http_client import get_client
+from instrumentation import get_report
+from taxonomy_index import load_taxonomy_index, read_taxon_list
+from structural_rescore import load_query_coordinates, add_structure_scores
+from deduplicate import deduplicate_hits
+from alignment_stats import add_alignment_stats
+from sequence_store import SequenceStore, get_sequence_store_dir, store_sequences
 
 
 def get_df():
@@ -37,14 +46,16 @@ def get_species_to_taxon(species, species_csv, sleep_time=0.1, save_interval=100
     species_found = set(species_to_taxon.index)
     species_missing = set(species) - species_found
 
-    # expected runtime
+    # expected runtime (lower bound, the requests themselves take time as well)
     print(f"Expected runtime: {round(sleep_time * len(species_missing))} seconds")
+    progress = get_report().progress('species lookup', len(species_missing))
     for i, species in enumerate(species_missing):
         taxon_id = get_taxon_id_uniprot(species)
         species_to_taxon.loc[species] = taxon_id
         if i % save_interval == 0:
             species_to_taxon.to_csv(species_csv)
-        time.sleep(sleep_time)
+        progress.update()
+        get_client().pause(sleep_time)
 
     species_to_taxon['Taxon ID'] = species_to_taxon['Taxon ID'].apply(lambda x: np.nan if 'Error' in str(x) else x)    
     species_to_taxon['Taxon ID'] = species_to_taxon['Taxon ID'].astype('Int64')
@@ -52,6 +63,75 @@ def get_species_to_taxon(species, species_csv, sleep_time=0.1, save_interval=100
     return species_to_taxon
 
 
+def get_embedded_taxon_ids(taxids):
+    """
+    Taxon IDs reported by foldseek (m8 Taxid column), NA where missing or invalid.
+
+    With a local NCBI taxdump, renamed taxids are replaced and unknown ones are invalid.
+    """
+    taxids = pd.to_numeric(pd.Series(taxids), errors='coerce')
+    taxids = taxids.where(taxids > 0)
+    index = load_taxonomy_index()
+    if index is not None:
+        current = index.to_current(taxids)
+        taxids = pd.Series(current, index=taxids.index).where(current >= 0)
+    return taxids.round().astype('Int64')
+
+
+def find_taxid_conflicts(df, embedded, by_name):
+    """
+    Distinct species and taxid pairs where the m8 taxid and the taxon of the species name disagree.
+
+    A taxid below the taxon of the name (e.g. a strain of the species) is not a conflict.
+    """
+    conflict = (embedded != by_name).fillna(False).astype(bool)
+    index = load_taxonomy_index()
+    if index is not None and conflict.any():
+        for taxon_id in by_name[conflict].unique():
+            rows = conflict & (by_name == taxon_id).fillna(False).astype(bool)
+            conflict[rows] = ~index.is_descendant_of_any(embedded[rows], [taxon_id])
+    conflicts = pd.DataFrame({'Species': df['taxname/species'], 'Taxid (m8)': embedded,
+                              'Taxon ID (name)': by_name})[conflict]
+    return conflicts.drop_duplicates().sort_values(['Species', 'Taxid (m8)']).reset_index(drop=True)
+
+
+def write_taxid_conflicts(conflicts, conflicts_csv):
+    """
+    Add conflicts to the reconciliation report (annotation runs only see new results).
+    """
+    if os.path.exists(conflicts_csv):
+        previous = pd.read_csv(conflicts_csv, dtype={'Taxid (m8)': 'Int64', 'Taxon ID (name)': 'Int64'})
+        conflicts = pd.concat([previous, conflicts]).drop_duplicates().sort_values(['Species', 'Taxid (m8)'])
+    conflicts.to_csv(conflicts_csv, index=False)
+
+
+def resolve_taxon_ids(df, script_dir):
+    """
+    Taxon ID of every row: the taxid reported by foldseek, the species name (UniProt) where it is missing.
+
+    Conflicts between both (for species with a known name lookup) go to foldseek_taxid_conflicts.csv.
+    """
+    report = get_report()
+    embedded = get_embedded_taxon_ids(df['Taxid'])
+    missing = embedded.isna()
+    report.count('taxids from m8', int((~missing).sum()))
+    print("Rows without a valid m8 taxid: ", int(missing.sum()))
+
+    # only species of rows without a taxid are looked up, the others come from the cache
+    species = df.loc[missing, 'taxname/species'].dropna().unique()
+    with report.stage('species to taxon', items=len(species)):
+        species_to_taxon = get_species_to_taxon(species, script_dir / 'foldseek_species_to_taxon.csv',
+                                                sleep_time=2, save_interval=50)
+    by_name = df['taxname/species'].map(species_to_taxon['Taxon ID']).astype('Int64')
+
+    conflicts = find_taxid_conflicts(df, embedded, by_name)
+    report.count('taxid conflicts', len(conflicts))
+    if len(conflicts) > 0:
+        print("Species with a m8 taxid that conflicts with the name: ", len(conflicts))
+        write_taxid_conflicts(conflicts, script_dir / 'foldseek_taxid_conflicts.csv')
+    return embedded.fillna(by_name)
+
+
 def get_taxon_to_lineage(taxon_ids, taxon_csv, email,
                          batch_size=50, sleep_time=0.1, save_interval=100):
     """ 
@@ -68,24 +148,25 @@ def get_taxon_to_lineage(taxon_ids, taxon_csv, email,
     taxon_ids_missing = set(taxon_ids) - taxon_ids_found
     
     # split missing into batches
-    if len(taxon_ids_missing) > 0:
-        batch_count = len(taxon_ids_missing) // batch_size + 1
-        print("Expected runtime: ", round(sleep_time * len(taxon_ids_missing) * batch_count), "seconds")
-    else:
-        batch_count = 0
+    batch_count = (len(taxon_ids_missing) + batch_size - 1) // batch_size
+    if batch_count > 0:
+        # one request and one sleep per batch
+        print("Expected runtime: ", round(sleep_time * batch_count), "seconds")
 
     batches = []
     for i in range(batch_count):
         batch = list(taxon_ids_missing)[i*batch_size:(i+1)*batch_size]
         batches.append(batch)
    
+    progress = get_report().progress('lineage lookup', len(taxon_ids_missing))
     for i, batch in enumerate(batches):
         lineages = get_taxon_lineage_batch(batch, email)
+        progress.update(len(batch))
         for taxon_id, lineage in lineages.items():
             taxon_to_lineage.loc[taxon_id] = lineage
         if i % save_interval == 0:
             taxon_to_lineage.to_csv(taxon_csv)
-        time.sleep(sleep_time)
+        get_client().pause(sleep_time)
     
     # make sure taxon id is int
     taxon_to_lineage.index = taxon_to_lineage.index.astype(int)
@@ -151,53 +232,129 @@ def get_lineage(df, id, ignore_nan=True):
         return lineage
 
 
-def main():
-    df = get_df()
-    script_dir = pathlib.Path(__file__).parent.absolute()
-    plot_dir = script_dir / 'plots'
-    plot_dir.mkdir(parents=True, exist_ok=True)
+def get_annotation_version():
+    """
+    Version of the annotation columns, increase it when annotate adds or changes columns
+    so that the annotated dataset is rebuilt.
+    """
+    return 8
+
 
+def get_gut_microbe_lists(script_dir):
+    """
+    Reference taxon lists of known gut microbes, by annotation column.
+    """
+    return {
+        'KnownGutMicrobe(GMrepo)': script_dir / 'GMrepo_species_taxon_ids_morethan3.txt',
+        'KnownGutMicrobe(MGnify)': script_dir / 'mgnify_human_gut_taxons.txt',
+    }
+
+
+def is_known_gut_microbe(taxon_ids, reference_taxon_ids):
+    """
+    Check if taxons are a reference taxon or a descendant of one (strains, subspecies).
+
+    Falls back to exact matching of the taxon IDs if there is no local NCBI taxdump.
+    """
+    index = load_taxonomy_index()
+    if index is None:
+        print("No NCBI taxdump found (see taxonomy_index.py), matching taxon IDs exactly")
+        return taxon_ids.isin(set(reference_taxon_ids)).fillna(False).astype(bool).values
+    return index.is_descendant_of_any(taxon_ids, reference_taxon_ids)
+
+
+def deduplicate(df, tie_break='evalue'):
+    """
+    Keep one hit per query and target across the databases (see deduplicate.py).
+    """
+    report = get_report()
+    with report.stage('deduplicate', items=len(df)):
+        deduplicated = deduplicate_hits(df, tie_break=tie_break)
+    report.count('duplicate hits removed', len(df) - len(deduplicated))
+    print("Duplicate hits removed: ", len(df) - len(deduplicated))
+    return deduplicated
+
+
+def annotate(df, script_dir, email='lzr765@ku.dk'):
+    """
+    Add taxon IDs, lineages, gut microbe membership, verified alignment statistics and structural scores
+    to parsed foldseek results.
+    """
+    report = get_report()
     print("Number of rows: ", len(df))
     print(df['Filename'].value_counts())
     print("Number of unique species", len(df['taxname/species'].unique()))
+    report.count('rows annotated', len(df))
 
-    # get species to taxon
-    species = df['taxname/species'].unique()
-    species_to_taxon = get_species_to_taxon(species, script_dir / 'foldseek_species_to_taxon.csv',
-                                            sleep_time=2, save_interval=50)
-    
-    # add taxon id to df
-    df['Taxon ID'] = df['taxname/species'].apply(lambda x: species_to_taxon.loc[x])
+    # add taxon id to df (the m8 taxid, species names only where it is missing)
+    df['Taxon ID'] = resolve_taxon_ids(df, script_dir)
     taxon_ids = df['Taxon ID'].dropna().unique()
 
-    # save taxons    
+    # save taxons (all taxons seen so far, annotation runs only see new results)
     print("Number of unique taxons", len(df['Taxon ID'].unique()))
     taxon_p = script_dir / 'foldseek_taxids.txt'
-    taxon_p.write_text('\n'.join([str(int(t)) for t in taxon_ids]))
+    known_taxon_ids = set(taxon_p.read_text().split()) if taxon_p.exists() else set()
+    known_taxon_ids |= set(str(int(t)) for t in taxon_ids)
+    taxon_p.write_text('\n'.join(sorted(known_taxon_ids, key=int)))
     
     # get taxon to lineage
-    taxon_to_lineage = get_taxon_to_lineage(taxon_ids, script_dir / 'foldseek_taxon_to_lineage.csv',
-                                            'lzr765@ku.dk', batch_size=100,
-                                            sleep_time=1, save_interval=5)
+    with report.stage('taxon to lineage', items=len(taxon_ids)):
+        taxon_to_lineage = get_taxon_to_lineage(taxon_ids, script_dir / 'foldseek_taxon_to_lineage.csv',
+                                                email, batch_size=100,
+                                                sleep_time=1, save_interval=5)
     
-    # add lineage to df (ignore nans)
-    df['Lineage'] = df['Taxon ID'].apply(lambda x: get_lineage(taxon_to_lineage, x, ignore_nan=True))
-
-    # add each individual part of the lineage to the df
-    options = get_phylogentic_options()
-    for option in options:
-        df[option] = df['Lineage'].apply(get_lineage_part, part=option)
-
-    # def check if is in taxon list from GMrepo
-    GMrepo_taxon_p = script_dir / 'GMrepo_species_taxon_ids_morethan3.txt'
-    known_gut_microbe_taxons = set(map(int, GMrepo_taxon_p.read_text().split('\n')))
-    df['KnownGutMicrobe(GMrepo)'] = df['Taxon ID'].apply(lambda x: x in known_gut_microbe_taxons)
+    with report.stage('lineage columns', items=len(df)):
+        # add lineage to df (ignore nans)
+        df['Lineage'] = df['Taxon ID'].apply(lambda x: None if pd.isna(x) else get_lineage(taxon_to_lineage, x, ignore_nan=True))
+
+        # add each individual part of the lineage to the df
+        options = get_phylogentic_options()
+        for option in options:
+            df[option] = df['Lineage'].apply(get_lineage_part, part=option)
+
+        # strings stay strings even if a batch has no lineages, so partitions share one schema
+        for column in ['Lineage'] + options:
+            df[column] = df[column].astype('string')
+
+    # check if the taxon is in (or below) a taxon of the GMrepo / MGnify gut microbe lists
+    with report.stage('gut microbe membership', items=len(df)):
+        for column, list_p in get_gut_microbe_lists(script_dir).items():
+            df[column] = is_known_gut_microbe(df['Taxon ID'], read_taxon_list(list_p))
+
+    # identity, mismatches, gaps and coverage recomputed from Qaln / Taln
+    with report.stage('alignment statistics', items=len(df)):
+        df = add_alignment_stats(df)
+
+    # RMSD and TM-score of the aligned CA atoms of query peptide and target
+    zip_p = script_dir / 'peptide_structures.zip'
+    with report.stage('structural rescoring', items=len(df)):
+        query_coords = load_query_coordinates(zip_p) if zip_p.exists() else {}
+        df = add_structure_scores(df, query_coords)
 
     print(df['KnownGutMicrobe(GMrepo)'].value_counts())
+    print(df['KnownGutMicrobe(MGnify)'].value_counts())
     print(df['kingdom'].value_counts())
+    return df
+
 
-    # save the df
-    df.to_csv(script_dir / 'foldseek_parsed_results_nohuman_annotated.csv')
+def main():
+    parser = argparse.ArgumentParser(description='Annotate new or changed foldseek results.')
+    parse_filter = get_parse_filter(add_filter_arguments(parser).parse_args())
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    results_dir = get_data_dir() / 'foldseek_results'
+
+    # only result files that are new or changed since the last run are annotated,
+    # target sequences go to the sequence store and the partitions keep their tseq_id
+    report = get_report()
+    store = SequenceStore(get_sequence_store_dir(get_dataset_dir()))
+    with report.stage('annotate') as stage:
+        written = update_annotated_dataset(results_dir, get_dataset_dir(),
+                                           lambda df: store_sequences(annotate(deduplicate(df), script_dir), store),
+                                           version=get_annotation_version(), by_query=True,
+                                           parse_filter=parse_filter)
+        stage['items'] = report.counters.get('rows annotated', 0)
+    print("Partitions written: ", len(written))
+    report.write()
 
 if __name__ == "__main__":
     main()
@@ -11,7 +11,15 @@
 
 echo "I am running a job"
 
-BASE_DIR="/projects/ilfgrid/data/lzr765/foldseek_results"
+# DATA_DIR can be set in the environment (e.g. by pipeline.py)
+DATA_DIR="${DATA_DIR:-/projects/ilfgrid/data/lzr765}"
+
+BASE_DIR="$DATA_DIR/foldseek_results"
+
+# request timings (endpoint, seconds, http code), turn into a run report with
+# python instrumentation.py foldseek_http_timings.tsv
+timings_file="$DATA_DIR/foldseek_http_timings.tsv"
+
 if [[ ! -d "$BASE_DIR" ]]; then
     mkdir -p "$BASE_DIR"
 fi
@@ -36,9 +44,11 @@ while IFS=':' read -r name info; do
 
   download_file="$download_dir/$name.tar.gz"
 
-  curl -o "$download_file" "$download_url"
+  timing=$(curl -o "$download_file" -w '%{time_total}\t%{http_code}' "$download_url")
+  status=$?
+  echo -e "foldseek_download\t$timing" >> "$timings_file"
 
-  if [[ $? -ne 0 ]]; then
+  if [[ $status -ne 0 ]]; then
     echo "Error downloading file for ID: $name"
     continue
   fi
@@ -46,7 +56,7 @@ while IFS=':' read -r name info; do
   tar -xvzf "$download_file" -C "$download_dir"
 
   echo "Downloaded and unzipped file for ID: $name"
-done < "/projects/ilfgrid/data/lzr765/foldseek_results.txt"
+done < "$DATA_DIR/foldseek_results.txt"
 
 echo "I am done running a job"
 # End of script
\ No newline at end of file
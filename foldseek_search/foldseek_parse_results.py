@@ -1,28 +1,18 @@
+import argparse
+import heapq
 import os
+import pathlib
+from collections import namedtuple
 import pandas as pd
 
-def parse_foldseek_results(results_dir):
+from instrumentation import get_report
+
+def get_column_names():
     """
-    Parses FoldSeek results files from each folder into a DataFrame. Filtered by non-human results.
+    Column names of the parsed FoldSeek results.
     """
-
-    data = []
-    for subdir, _, files in os.walk(results_dir):
-        for file in files:
-            if file.endswith('.m8'):
-                file_path = os.path.join(subdir, file)
-                with open(file_path, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if not line.startswith('#'):
-                            columns = line.split('\t')
-                            if len(columns) >= 6:
-                                directory_name = os.path.basename(subdir) 
-                                data.append([directory_name] + [file] + columns)
-
-
     # Column names based on the provided example
-    column_names = [
+    return [
         'Query', 'Filename', 'Job ID', 'Target and Description', 'pident', 'alnlen', 'Mismatch(not sure)',
         'Gapopen', 'Query start', 'Query end', 'Target start', 'Target end',
         'Probability', 'E-value', 'Score(not sure)', 'Query length',
@@ -30,20 +20,300 @@ def parse_foldseek_results(results_dir):
     ]
     #Query,Filename,Job ID,Target/Description,pident,alnlen,mismatch(not sure),gapopen,qstart,Qend,tstart,tend,Prob.,
     # E-value,Score(not sure),Not sure,Target length,Qaln,Taln,tca,tseq,Taxid,taxname/species
-   
 
-    df = pd.DataFrame(data, columns=column_names)
+
+def get_numeric_columns():
+    """
+    Parsed columns that hold numbers.
+    """
+    return [
+        'pident', 'alnlen', 'Mismatch(not sure)', 'Gapopen', 'Query start', 'Query end',
+        'Target start', 'Target end', 'Probability', 'E-value', 'Score(not sure)',
+        'Query length', 'Target length', 'Taxid'
+    ]
+
+
+# Quality filters applied while the m8 lines are read (None: no filter). top_n_per_database
+# keeps the hits with the lowest E-values of every result file (a query in one database).
+ParseFilter = namedtuple('ParseFilter', ['max_evalue', 'min_prob', 'min_alnlen', 'min_pident',
+                                         'top_n_per_database', 'exclude_species'],
+                         defaults=(None, None, None, None, None, ()))
+
+
+def format_parse_filter(parse_filter):
+    """
+    Canonical text of the filters that are set (e.g. to version a dataset), '' without filters.
+    """
+    if parse_filter is None:
+        return ''
+    return ','.join(f'{name}={sorted(value) if name == "exclude_species" else value}'
+                    for name, value in parse_filter._asdict().items() if value not in (None, ()))
+
+
+def get_m8_index(column):
+    """
+    Position of a parsed column in an m8 line (the query and filename columns are not in the file).
+    """
+    return get_column_names().index(column) - 2
+
+
+def get_numeric_checks(parse_filter):
+    """
+    (m8 index, lower bound, upper bound) of the numeric filters that are set.
+    """
+    checks = [
+        ('E-value', None, parse_filter.max_evalue),
+        ('Probability', parse_filter.min_prob, None),
+        ('alnlen', parse_filter.min_alnlen, None),
+        ('pident', parse_filter.min_pident, None),
+    ]
+    return [(get_m8_index(column), low, high) for column, low, high in checks
+            if low is not None or high is not None]
+
+
+def passes_numeric_checks(fields, checks):
+    """
+    Check the numeric filters on the first fields of an m8 line (unreadable values fail).
+    """
+    for index, low, high in checks:
+        try:
+            value = float(fields[index])
+        except (IndexError, ValueError):
+            return False
+        # nan compares False with both bounds and would pass
+        if value != value or (low is not None and value < low) or (high is not None and value > high):
+            return False
+    return True
+
+
+def split_fields(fields, n_head):
+    """
+    All columns of an m8 line split with maxsplit=n_head.
+    """
+    if len(fields) > n_head:
+        return fields[:n_head] + fields[n_head].split('\t')
+    return fields
+
+
+def iter_m8_rows(file_path, parse_filter=None):
+    """
+    Yield the parsed rows of a single m8 file (query directory, filename and the m8 columns).
+
+    With a ParseFilter, the numeric filters are checked on the first columns and the
+    species on the last one before the alignment, tca and tseq columns are split.
+    """
+    directory_name = os.path.basename(os.path.dirname(file_path))
+    file = os.path.basename(file_path)
+    if parse_filter is None:
+        with open(file_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line.startswith('#'):
+                    columns = line.split('\t')
+                    if len(columns) >= 6:
+                        yield [directory_name] + [file] + columns
+        return
+
+    # the columns up to Target length are short, Qaln, Taln, tca and tseq are not
+    n_head = get_m8_index('Qaln')
+    checks = get_numeric_checks(parse_filter)
+    excluded = set(parse_filter.exclude_species)
+    evalue_index = get_m8_index('E-value')
+    top = []
+    with open(file_path, 'r') as f:
+        for line_i, line in enumerate(f):
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t', n_head)
+            if len(fields) < 6 or not passes_numeric_checks(fields, checks):
+                continue
+            if excluded and len(fields) > n_head and fields[n_head].rsplit('\t', 1)[-1] in excluded:
+                continue
+            if parse_filter.top_n_per_database is None:
+                yield [directory_name] + [file] + split_fields(fields, n_head)
+                continue
+            # bounded heap of the lowest E-values, the earlier line wins ties
+            try:
+                entry = (-float(fields[evalue_index]), -line_i, fields)
+            except (IndexError, ValueError):
+                continue
+            if entry[0] != entry[0]:
+                continue
+            if len(top) < parse_filter.top_n_per_database:
+                heapq.heappush(top, entry)
+            elif entry[:2] > top[0][:2]:
+                heapq.heapreplace(top, entry)
+
+    # kept lines in file order
+    for _, _, fields in sorted(top, key=lambda entry: -entry[1]):
+        yield [directory_name] + [file] + split_fields(fields, n_head)
+
+
+def find_result_files(results_dir):
+    """
+    Paths of all m8 files in the results directory (one folder per query).
+    """
+    paths = []
+    for subdir, _, files in os.walk(results_dir):
+        for file in files:
+            if file.endswith('.m8'):
+                paths.append(os.path.join(subdir, file))
+    return sorted(paths)
+
+
+def iter_foldseek_rows(results_dir, parse_filter=None):
+    """
+    Yield one parsed row (query, filename and the m8 columns) per hit in the results directory.
+    """
+    for file_path in find_result_files(results_dir):
+        yield from iter_m8_rows(file_path, parse_filter)
+
+
+def to_dataframe(data):
+    """
+    Build a DataFrame of parsed rows. Filtered by non-human results.
+    """
+    df = pd.DataFrame(data, columns=get_column_names())
     df = df[df.iloc[:, -1] != "Homo sapiens"]
     return df
 
+
+def parse_foldseek_results(results_dir, parse_filter=None):
+    """
+    Parses FoldSeek results files from each folder into a DataFrame. Filtered by non-human results.
+    """
+    data = list(iter_foldseek_rows(results_dir, parse_filter))
+    return to_dataframe(data)
+
+
+def iter_foldseek_chunks(results_dir, chunksize=100_000, parse_filter=None):
+    """
+    Stream FoldSeek results as DataFrames of at most chunksize rows with numeric columns converted.
+
+    Only one chunk is held in memory at a time.
+    """
+    chunk = []
+    for row in iter_foldseek_rows(results_dir, parse_filter):
+        chunk.append(row)
+        if len(chunk) >= chunksize:
+            yield convert_numeric(to_dataframe(chunk))
+            chunk = []
+    if len(chunk) > 0:
+        yield convert_numeric(to_dataframe(chunk))
+
+
+def convert_numeric(df):
+    """
+    Convert the numeric columns of parsed results from strings.
+    """
+    for column in get_numeric_columns():
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+def get_column_mapping():
+    """
+    Mapping from the parsed / annotated column names to the names used in the plots.
+    """
+    return {
+        # ... other column mappings
+        'KnownGutMicrobe(GMrepo)': 'Known Gut Microbe',
+        'KnownGutMicrobe(MGnify)': 'Known Gut Microbe (MGnify)',
+        'Filename': 'Database',
+        # names given by foldseek_parse_results
+        'Target and Description': 'Target/Description',
+        'Mismatch(not sure)': 'mismatch(not sure)',
+        'Gapopen': 'gapopen',
+        'Query start': 'qstart',
+        'Query end': 'Qend',
+        'Target start': 'tstart',
+        'Target end': 'tend',
+        'Probability': 'Prob.',
+        # lineage levels added by foldseek_annotate
+        'superkingdom': 'Super Kingdom',
+        'kingdom': 'Kingdom',
+        'phylum': 'Phylum',
+        'class': 'Class',
+        'order': 'Order',
+        'family': 'Family',
+        'genus': 'Genus',
+        'species': 'Species',
+    }
+
+
+def clean_columns(df):
+    """
+    Rename columns to the plot names and map result filenames to database names.
+    """
+    df = df.rename(columns=get_column_mapping())
+
+    filename_mapping = {
+        'alis_pdb100.m8': 'PDB100',
+        'alis_afdb-swissprot.m8': 'AFDB-Swissprot',
+        'alis_afdb50.m8': 'AFDB50',
+        'alis_mgnify_esm30.m8': 'MGnify_ESM30',
+        'alis_afdb-proteome.m8': 'AFDB-Proteome',
+        'alis_gmgcl_id.m8': 'GMGCL_ID',
+        'alis_bfmd.m8': 'BFMD',
+        'alis_cath50.m8': 'CATH50'
+    }
+
+    if 'Database' in df.columns:
+        df['Database'] = df['Database'].map(filename_mapping).fillna(df['Database'])
+
+    return df
+
+
+def add_filter_arguments(parser):
+    """
+    Command line options of the parse time quality filters.
+    """
+    group = parser.add_argument_group('filters applied while parsing')
+    group.add_argument('--max-evalue', type=float, default=None, help='drop hits with a larger E-value')
+    group.add_argument('--min-prob', type=float, default=None, help='drop hits with a lower Probability')
+    group.add_argument('--min-alnlen', type=int, default=None, help='drop shorter alignments')
+    group.add_argument('--min-pident', type=float, default=None, help='drop hits with a lower identity')
+    group.add_argument('--top-n-per-database', type=int, default=None,
+                       help='keep the hits with the lowest E-values of every query in every database')
+    # human hits are always dropped (to_dataframe)
+    group.add_argument('--exclude-species', nargs='*', default=[], help='drop hits of these species as well')
+    return parser
+
+
+def get_parse_filter(args):
+    """
+    ParseFilter from the options of add_filter_arguments, None if no filter is set.
+    """
+    parse_filter = ParseFilter(args.max_evalue, args.min_prob, args.min_alnlen, args.min_pident,
+                               args.top_n_per_database, tuple(args.exclude_species))
+    if not format_parse_filter(parse_filter):
+        return None
+    return parse_filter
+
+
+def get_data_dir():
+  """
+  Directory with the downloaded foldseek results and the parsed tables.
+  Can be set with the DATA_DIR environment variable.
+  """
+  return pathlib.Path(os.environ.get("DATA_DIR", "/projects/ilfgrid/data/lzr765"))
+
 def main():
   """
   Main function to execute the script.
   """
-  full_dir = "/projects/ilfgrid/data/lzr765"
+  parser = argparse.ArgumentParser(description='Parse the foldseek results into a csv table.')
+  parse_filter = get_parse_filter(add_filter_arguments(parser).parse_args())
+  full_dir = get_data_dir()
   results_dir = full_dir / "foldseek_results"
-  df = parse_foldseek_results(results_dir)
-  df.to_csv(full_dir / "foldseek_parsed_results_nohuman.csv", index=False)
+  report = get_report()
+  with report.stage('parse') as stage:
+    df = parse_foldseek_results(results_dir, parse_filter)
+    stage['items'] = len(df)
+  with report.stage('write csv', items=len(df)):
+    df.to_csv(full_dir / "foldseek_parsed_results_nohuman.csv", index=False)
+  report.write()
 
 if __name__ == "__main__":
   main()
@@ -1,46 +1,54 @@
 """ Show plots for the foldseek results for human hormones.
 """
+import argparse
 import pathlib
 import os 
+import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 import pandas as pd 
 
+from foldseek_parse_results import clean_columns, get_column_mapping
+from deduplicate import expand_source_databases
+from foldseek_topk import (select_top_hits, get_top_criteria, iter_dataset_chunks, iter_csv_chunks,
+                           add_top_arguments, write_top_tables)
+from plot_runner import plot_job, run_plots
+from shared_table import share_table, share_dataset, get_table
+from annotated_store import get_dataset_dir
+from instrumentation import get_report
 
-def get_df():
+
+def get_source_columns(columns, available):
+    """
+    Columns of the annotated results (as named before clean_columns) that give the plot columns.
+    """
+    sources = {}
+    for name, plot_name in get_column_mapping().items():
+        sources.setdefault(plot_name, []).append(name)
+    available = set(available)
+    return list(dict.fromkeys(s for c in columns for s in sources.get(c, []) + [c] if s in available))
+
+
+def get_shared_hits(columns):
     """
-    Load the annotated foldseek results.
+    Shared table of the annotated foldseek results, projected to what the plot columns are made of.
 
     Header:
     Row,Query,Filename,Job ID,Target/Description,pident,alnlen,mismatch(not sure),gapopen,qstart,Qend,tstart,tend,Prob.,
     E-value,Score(not sure),Not sure,Target length,Qaln,Taln,tca,tseq,Taxid,taxname/species
     """
-    #     
     script_dir = pathlib.Path(__file__).parent.absolute()
+    dataset_dir = get_dataset_dir()
+    if dataset_dir.exists():
+        # union of all annotated partitions, only the selected columns are ever read from the mapping
+        shared = share_dataset(dataset_dir)
+        return shared._replace(columns=get_source_columns(columns, get_table(shared).column_names))
     df_p = script_dir / 'foldseek_parsed_results_nohuman_annotated.csv'
-    df = pd.read_csv(df_p)
-
-    df = df.rename(columns={
-        # ... other column mappings
-        'KnownGutMicrobe(GMrepo)': 'Known Gut Microbe',
-        'Filename': 'Database'
-    })
-
-    filename_mapping = {
-    'alis_pdb100.m8': 'PDB100',
-    'alis_afdb-swissprot.m8': 'AFDB-Swissprot',
-    'alis_afdb50.m8': 'AFDB50',
-    'alis_mgnify_esm30.m8': 'MGnify_ESM30',
-    'alis_afdb-proteome.m8': 'AFDB-Proteome',
-    'alis_gmgcl_id.m8': 'GMGCL_ID',
-    'alis_bfmd.m8': 'BFMD',
-    'alis_cath50.m8': 'CATH50'
-    }
-    
-    df['Database'] = df['Database'].map(filename_mapping)
+    available = pd.read_csv(df_p, nrows=0).columns
+    df = pd.read_csv(df_p, usecols=get_source_columns(columns, available))
+    return share_table(df, name='foldseek_plot')
 
-    return df
 
 def save(save_p):
     """
@@ -74,6 +82,13 @@ def plot_kingdoms(df, save_p):
     save(save_p)
 
 
+def clean_database_columns(df):
+    """
+    clean_columns with every deduplicated hit repeated for each database it was found in.
+    """
+    return clean_columns(expand_source_databases(df))
+
+
 def plot_databases(df, save_p):
     """
     Plot which database of origin the hits are from.
@@ -102,10 +117,117 @@ def plot_databases(df, save_p):
     save(save_p)
 
 
-def plot_query_len_target_len(df, save_p, hue='pident', hue_threshold=None):
+def get_density_threshold():
+    """
+    Number of plotted hits above which the length plots are binned (density=None).
+    """
+    return 100_000
+
+
+def get_density_aggregations():
+    """
+    List of aggregations available when binning hits into a grid.
+    """
+    return ["count", "max", "min", "mean", "sum"]
+
+
+def bin_hits(x, y, values=None, agg='count', bins=200, x_range=None, y_range=None):
+    """
+    Aggregate points into a 2D grid of bins.
+
+    Every point is assigned to a bin with integer arithmetic and the bins are
+    reduced with bincount / ufunc.at, so memory is bounded by the grid size
+    and the cost is a single linear pass over the points.
+
+    Returns the grid (shape y bins x x bins, NaN where a bin is empty) together
+    with the x and y bin edges.
+    """
+    options = get_density_aggregations()
+    assert agg in options, f"agg must be one of {options}"
+    x_bins, y_bins = (bins, bins) if np.isscalar(bins) else bins
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    if agg != 'count':
+        values = np.asarray(values, dtype=float)
+        keep &= np.isfinite(values)
+
+    if x_range is None:
+        x_range = (np.min(x[keep]), np.max(x[keep])) if keep.any() else (0, 1)
+    if y_range is None:
+        y_range = (np.min(y[keep]), np.max(y[keep])) if keep.any() else (0, 1)
+    keep &= (x >= x_range[0]) & (x <= x_range[1]) & (y >= y_range[0]) & (y <= y_range[1])
+
+    x_edges = np.linspace(x_range[0], x_range[1], x_bins + 1)
+    y_edges = np.linspace(y_range[0], y_range[1], y_bins + 1)
+    x_width = max(x_range[1] - x_range[0], np.finfo(float).eps)
+    y_width = max(y_range[1] - y_range[0], np.finfo(float).eps)
+
+    # bin index of every kept point (the upper edge belongs to the last bin)
+    x_i = np.minimum(((x[keep] - x_range[0]) / x_width * x_bins).astype(np.int64), x_bins - 1)
+    y_i = np.minimum(((y[keep] - y_range[0]) / y_width * y_bins).astype(np.int64), y_bins - 1)
+    flat = y_i * x_bins + x_i
+    size = x_bins * y_bins
+
+    counts = np.bincount(flat, minlength=size)
+    if agg == 'count':
+        grid = counts.astype(float)
+    else:
+        v = values[keep]
+        if agg == 'sum':
+            grid = np.bincount(flat, weights=v, minlength=size)
+        elif agg == 'mean':
+            grid = np.bincount(flat, weights=v, minlength=size) / np.maximum(counts, 1)
+        elif agg == 'max':
+            grid = np.full(size, -np.inf)
+            np.maximum.at(grid, flat, v)
+        else:
+            grid = np.full(size, np.inf)
+            np.minimum.at(grid, flat, v)
+
+    grid[counts == 0] = np.nan
+    return grid.reshape(y_bins, x_bins), x_edges, y_edges
+
+
+def draw_density(df, hue, agg, bins, cmap, y_max=500):
+    """
+    Draw the target length vs query length grid as a single raster image.
+
+    Only the image is rasterized; axes, ticks, labels and the colorbar stay
+    vector, and the output size depends on the number of bins, not on the
+    number of hits.
+    """
+    x_max = df['Target length'].max() if len(df) > 0 else 1
+    values = None if agg == 'count' else df[hue].values
+    grid, x_edges, y_edges = bin_hits(df['Target length'].values, df['Query length'].values,
+                                      values=values, agg=agg, bins=bins,
+                                      x_range=(0, x_max), y_range=(0, y_max))
+
+    filled = grid[np.isfinite(grid)]
+    vmin, vmax = (filled.min(), filled.max()) if len(filled) > 0 else (1, 1)
+    if agg == 'count':
+        # counts span orders of magnitude, so use a log scale
+        norm = matplotlib.colors.LogNorm(vmin=1, vmax=max(vmax, 1))
+        label = 'Count'
+    else:
+        norm = plt.Normalize(vmin=vmin, vmax=vmax)
+        label = f'{hue} ({agg})'
+
+    ax = plt.gca()
+    im = ax.imshow(grid, origin='lower', extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+                   cmap=cmap, norm=norm, interpolation='nearest', aspect='auto', rasterized=True)
+    cbar = plt.colorbar(im, shrink=0.3, ax=ax)
+    cbar.set_label(label)
+    return ax
+
+
+def plot_query_len_target_len(df, save_p, hue='pident', hue_threshold=None,
+                              density=None, agg='max', bins=200):
     """ 
     Plot identity score vs target length.
     Only known bacteria from gut microbiome
+    density=None bins the hits when more than get_density_threshold() of them are plotted.
     """
     df = df[df['Kingdom'] == 'Bacteria']
     df = df[df['Known Gut Microbe']]
@@ -121,16 +243,21 @@ def plot_query_len_target_len(df, save_p, hue='pident', hue_threshold=None):
     df_filt = df[df['Query length'] <= 150]
     top_5 = df_filt.nlargest(5, hue)
 
-    ax = sns.scatterplot(x='Target length', y='Query length', data=df,
-                         alpha=0.5, hue=hue, palette=cmap, legend=False, edgecolor='black')
+    if density is None:
+        density = len(df) > get_density_threshold()
+    if density:
+        draw_density(df, hue, agg, bins, cmap)
+    else:
+        ax = sns.scatterplot(x='Target length', y='Query length', data=df,
+                             alpha=0.5, hue=hue, palette=cmap, legend=False, edgecolor='black')
 
-    #ax = sns.scatterplot(x='Target length', y='Query length', data=top_5, alpha=1, color='orange', edgecolor='black', s=40, ax=ax)
+        #ax = sns.scatterplot(x='Target length', y='Query length', data=top_5, alpha=1, color='orange', edgecolor='black', s=40, ax=ax)
     
-    sm = plt.cm.ScalarMappable(cmap=cmap,
-                                 norm=plt.Normalize(vmin=df[hue].min(), vmax=df[hue].max()))
-    sm.set_array([])
-    cbar = plt.colorbar(sm, shrink=0.3, ax=ax)         
-    cbar.set_label(hue)
+        sm = plt.cm.ScalarMappable(cmap=cmap,
+                                     norm=plt.Normalize(vmin=df[hue].min(), vmax=df[hue].max()))
+        sm.set_array([])
+        cbar = plt.colorbar(sm, shrink=0.3, ax=ax)         
+        cbar.set_label(hue)
 
     plt.xlim(0, None)
     plt.ylim(0, 500)
@@ -145,10 +272,12 @@ def plot_query_len_target_len(df, save_p, hue='pident', hue_threshold=None):
     save(save_p)
     return top_5
 
-def plot_query_len_target_len_evalue(df, save_p, hue='E-value', hue_threshold=None):
+def plot_query_len_target_len_evalue(df, save_p, hue='E-value', hue_threshold=None,
+                                     density=None, agg='min', bins=200):
     """ 
     Plot identity score vs target length.
     Only known bacteria from gut microbiome
+    density=None bins the hits when more than get_density_threshold() of them are plotted.
     """
     df = df[df['Kingdom'] == 'Bacteria']
     df = df[df['Known Gut Microbe']]
@@ -166,16 +295,21 @@ def plot_query_len_target_len_evalue(df, save_p, hue='E-value', hue_threshold=No
 
     cmap = cmap.reversed()  # so that colors match (good evalues and good identity scores)
 
-    ax = sns.scatterplot(x='Target length', y='Query length', data=df,
-                         alpha=0.5, hue=hue, palette=cmap, legend=False, edgecolor='black')
+    if density is None:
+        density = len(df) > get_density_threshold()
+    if density:
+        draw_density(df, hue, agg, bins, cmap)
+    else:
+        ax = sns.scatterplot(x='Target length', y='Query length', data=df,
+                             alpha=0.5, hue=hue, palette=cmap, legend=False, edgecolor='black')
 
-    #ax = sns.scatterplot(x='Target length', y='Query length', data=top_5, alpha=1, color='orange', edgecolor='black', s=40, ax=ax)
+        #ax = sns.scatterplot(x='Target length', y='Query length', data=top_5, alpha=1, color='orange', edgecolor='black', s=40, ax=ax)
     
-    sm = plt.cm.ScalarMappable(cmap=cmap,
-                                 norm=plt.Normalize(vmin=df[hue].min(), vmax=df[hue].max()))
-    sm.set_array([])
-    cbar = plt.colorbar(sm, shrink=0.3, ax=ax)         
-    cbar.set_label(hue)
+        sm = plt.cm.ScalarMappable(cmap=cmap,
+                                     norm=plt.Normalize(vmin=df[hue].min(), vmax=df[hue].max()))
+        sm.set_array([])
+        cbar = plt.colorbar(sm, shrink=0.3, ax=ax)         
+        cbar.set_label(hue)
 
     plt.xlim(0, None)
     plt.ylim(0, 500)
@@ -190,60 +324,83 @@ def plot_query_len_target_len_evalue(df, save_p, hue='E-value', hue_threshold=No
     save(save_p)
     return top_5
 
-def find_strong_matches(df):
-    df = df[df['Kingdom'] == 'Bacteria']
-    df = df[df['Known Gut Microbe']]
-    #df_filt = df[df['Query length'] <= 150]
-
-    strong_matches_df = df[(df['pident'].astype(float) >= 10) & (df['Query length'] <= 400)]
-    peptide_counts = strong_matches_df['Query'].value_counts()
-    #peptide_counts = df_filt['Query'].value_counts()
-    print("Peptide strong matches counts:")
-    print(peptide_counts.head(5))
-
-    # Sort by pident in descending order and then by E-value in ascending order
-    top5_both = strong_matches_df.sort_values(['pident', 'E-value'], ascending=[False, True]).head(5)
+def get_plot_outputs(save_p):
+    """
+    Files written by save() for a plot.
+    """
+    return [save_p, save_p.with_suffix('.png')]
 
-    return top5_both
 
 def main():
+    parser = argparse.ArgumentParser(description='Plot the foldseek results for human hormones.')
+    args = add_top_arguments(parser).parse_args()
     sns.set_style('whitegrid')
     sns.set_context('paper')
 
-    df = get_df()
+    # columns read by each plot; only these are read from the shared table
+    length_columns = ['Kingdom', 'Known Gut Microbe', 'pident', 'Query length', 'Target length']
+    plot_columns = ['Kingdom', 'Database', 'Known Gut Microbe', 'pident', 'Query length', 'Target length',
+                    'E-value', 'Prob.', 'TM-score', 'Source databases']
+    report = get_report()
+    with report.stage('load') as stage:
+        # mapped read-only by every plot worker, which renames the columns with clean_columns
+        shared = get_shared_hits(plot_columns)
+        table = get_table(shared)
+        stage['items'] = table.num_rows
     #df_filt = df[(df['Target length'] <= 500) & (df['Query length'] <= 150)]
 
+    def source(columns):
+        return get_source_columns(columns, table.column_names)
+
     script_dir = pathlib.Path(__file__).parent.absolute()
     plot_dir = script_dir / 'plots'
     plot_dir.mkdir(exist_ok=True)
-    
-    #databases = pd.unique(df['Database'])
-    #print(databases)
 
-    plot_kingdoms(df.copy(), plot_dir/ 'kingdoms.svg')
-    plot_databases(df.copy(), plot_dir / 'databases.svg')
-    
-    top_both = find_strong_matches(df.copy())
-    plot_query_len_target_len(df.copy(), plot_dir / 'query_target_identity.svg', hue='pident')
-    top_identity20 = plot_query_len_target_len(df.copy(), plot_dir / 'query_target_identity20.svg', hue='pident', hue_threshold=20)
-    top_evalue = plot_query_len_target_len_evalue(df.copy(), plot_dir / 'query_target_evalue.svg', hue='E-value') 
-    top_prob = plot_query_len_target_len(df.copy(), plot_dir / 'query_target_prob.svg', hue='Prob.')
-
-    top_data = [
-        ("top_identity20", top_identity20),
-        ("top_evalue", top_evalue),
-        ("top_prob", top_prob),
-        ("top_both", top_both)
+    has_tm = len(source(['TM-score'])) > 0
+
+    jobs = [
+        plot_job(plot_kingdoms, shared, plot_dir / 'kingdoms.svg',
+                 outputs=get_plot_outputs(plot_dir / 'kingdoms.svg'), columns=source(['Kingdom']),
+                 prepare=clean_columns),
+        plot_job(plot_databases, shared, plot_dir / 'databases.svg',
+                 outputs=get_plot_outputs(plot_dir / 'databases.svg'),
+                 columns=source(['Kingdom', 'Database', 'Known Gut Microbe', 'Source databases']),
+                 prepare=clean_database_columns),
+        plot_job(plot_query_len_target_len, shared, plot_dir / 'query_target_identity.svg',
+                 outputs=get_plot_outputs(plot_dir / 'query_target_identity.svg'),
+                 columns=source(length_columns), prepare=clean_columns, hue='pident'),
+        plot_job(plot_query_len_target_len, shared, plot_dir / 'query_target_identity20.svg',
+                 outputs=get_plot_outputs(plot_dir / 'query_target_identity20.svg'),
+                 columns=source(length_columns), prepare=clean_columns, hue='pident', hue_threshold=20),
+        plot_job(plot_query_len_target_len_evalue, shared, plot_dir / 'query_target_evalue.svg',
+                 outputs=get_plot_outputs(plot_dir / 'query_target_evalue.svg'),
+                 columns=source(length_columns + ['E-value']), prepare=clean_columns, hue='E-value'),
+        plot_job(plot_query_len_target_len, shared, plot_dir / 'query_target_prob.svg',
+                 outputs=get_plot_outputs(plot_dir / 'query_target_prob.svg'),
+                 columns=source(length_columns + ['Prob.']), prepare=clean_columns, hue='Prob.'),
     ]
+    if has_tm:
+        jobs.append(plot_job(plot_query_len_target_len, shared, plot_dir / 'query_target_tm.svg',
+                             outputs=get_plot_outputs(plot_dir / 'query_target_tm.svg'),
+                             columns=source(length_columns + ['TM-score']), prepare=clean_columns,
+                             hue='TM-score'))
+    with report.stage('plots', items=len(jobs)):
+        run_plots(jobs)
+
+    # all top tables in a single pass, streamed in chunks (top_all.csv keeps every column of the rows)
+    dataset_dir = get_dataset_dir()
+    if dataset_dir.exists():
+        chunks = iter_dataset_chunks(dataset_dir)
+    else:
+        chunks = iter_csv_chunks(script_dir / 'foldseek_parsed_results_nohuman_annotated.csv')
+    with report.stage('top hits') as stage:
+        top = select_top_hits(chunks, get_top_criteria(structure=has_tm), per_query_k=args.per_query_k)
+        stage['items'] = top.rows_seen
+    print("Peptide strong matches counts:")
+    print(pd.Series(top.query_counts['top_both']).sort_values(ascending=False).head(5))
 
-    csv_dir = script_dir / 'top_csv'
-    csv_dir.mkdir(exist_ok=True)
-    combined_df = pd.concat([df.assign(key=name) for name, df in top_data])
-
-    # Save the combined DataFrame to a single CSV file
-    csv_path = csv_dir / "top_all.csv"
-    combined_df.to_csv(csv_path, index=False)
-        
+    write_top_tables(top, script_dir / 'top_csv')
+    report.write()
 
 
 if __name__ == "__main__":
@@ -17,9 +17,16 @@
 
 # It also includes a delay between each search to avoid rate limiting.
 
-pdb_dir="/projects/ilfgrid/data/lzr765/computer_files/peptide_structures"
+# DATA_DIR and PDB_DIR can be set in the environment (e.g. by pipeline.py)
+DATA_DIR="${DATA_DIR:-/projects/ilfgrid/data/lzr765}"
 
-output_file="/projects/ilfgrid/data/lzr765/foldseek_results.txt"
+pdb_dir="${PDB_DIR:-$DATA_DIR/computer_files/peptide_structures}"
+
+output_file="$DATA_DIR/foldseek_results.txt"
+
+# request timings (endpoint, seconds, http code), turn into a run report with
+# python instrumentation.py foldseek_http_timings.tsv
+timings_file="$DATA_DIR/foldseek_http_timings.tsv"
 
 for pdb_file in "$pdb_dir"/*.pdb; do
   echo "Processing: $pdb_file"
@@ -27,6 +34,7 @@ for pdb_file in "$pdb_dir"/*.pdb; do
   peptide_name=$(basename "$pdb_file" .pdb)
 
   curl_output=$(curl -X POST \
+    -w '\n%{time_total}\t%{http_code}' \
     -F "q=@$pdb_file" \
     -F 'mode=3diaa' \
     -F 'database[]=afdb50' \
@@ -39,6 +47,10 @@ for pdb_file in "$pdb_dir"/*.pdb; do
     -F 'database[]=bfmd' \
     https://search.foldseek.com/api/ticket)
 
+  # last line is the timing written by -w
+  timing=$(echo "$curl_output" | tail -n 1)
+  curl_output=$(echo "$curl_output" | sed '$d')
+  echo -e "foldseek_ticket\t$timing" >> "$timings_file"
 
   echo "$peptide_name: $curl_output" >> "$output_file"
 
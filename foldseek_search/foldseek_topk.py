@@ -0,0 +1,235 @@
+""" Single pass top-k selection of foldseek hits for several ranking criteria at once.
+
+Hits are streamed in chunks (annotated CSV, Parquet or the raw m8 files) and
+every criterion keeps a bounded heap of its best k rows, globally and per query,
+so the full table never has to be held in memory.
+"""
+import argparse
+import heapq
+import pathlib
+from collections import namedtuple, Counter
+
+import numpy as np
+import pandas as pd
+
+from foldseek_parse_results import iter_foldseek_chunks, clean_columns
+from annotated_store import get_dataset_dir
+from shared_table import share_dataset, iter_shared_chunks
+from instrumentation import get_report
+
+
+# columns: ranking columns, ascending: sort direction per column, mask: row filter (or None)
+Criterion = namedtuple('Criterion', ['columns', 'ascending', 'mask'])
+
+
+def is_gut_bacteria(df):
+    """
+    Rows of known gut microbes in the bacteria kingdom.
+    """
+    return (df['Kingdom'] == 'Bacteria') & (df['Known Gut Microbe'] == True)
+
+
+def get_top_criteria(annotated=True, structure=False):
+    """
+    Ranking criteria of top_all.csv, keyed by the value of the key column.
+
+    Without annotation (raw m8 records) the gut microbe filter is left out,
+    structure adds the ranking by TM-score (see structural_rescore.py).
+    """
+    def base(df):
+        return is_gut_bacteria(df) if annotated else pd.Series(True, index=df.index)
+
+    criteria = {
+        'top_identity20': Criterion(['pident'], [False],
+                                    lambda df: base(df) & (df['pident'] >= 20) & (df['Query length'] <= 150)),
+        'top_evalue': Criterion(['E-value'], [True],
+                                lambda df: base(df) & (df['Query length'] <= 150)),
+        'top_prob': Criterion(['Prob.'], [False],
+                              lambda df: base(df) & (df['Query length'] <= 150)),
+        # Sort by pident in descending order and then by E-value in ascending order
+        'top_both': Criterion(['pident', 'E-value'], [False, True],
+                              lambda df: base(df) & (df['pident'] >= 10) & (df['Query length'] <= 400)),
+    }
+    if structure:
+        criteria['top_tm'] = Criterion(['TM-score', 'E-value'], [False, True],
+                                       lambda df: base(df) & (df['Query length'] <= 150))
+    return criteria
+
+
+class TopK:
+    """
+    Bounded heaps of the best rows for several criteria, globally and per query.
+
+    Heap entries are (score, -row number, record): the score is negated for
+    ascending columns so that larger is always better, and for equal scores the
+    earliest row wins, like DataFrame.nlargest(keep='first').
+    """
+    def __init__(self, criteria, k=5, per_query_k=None, query_column='Query'):
+        self.criteria = criteria
+        self.k = k
+        self.per_query_k = per_query_k
+        self.query_column = query_column
+        self.heaps = {name: [] for name in criteria}
+        self.query_heaps = {name: {} for name in criteria}
+        self.query_counts = {name: Counter() for name in criteria}
+        self.columns = None
+        self.rows_seen = 0
+
+    def push(self, heap, k, entry):
+        """
+        Push an entry to a heap holding at most k entries.
+        """
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+    def get_scores(self, criterion, df):
+        """
+        Score tuples (larger is better) for the rows of df.
+        """
+        columns = [df[c].values if not asc else -df[c].values
+                   for c, asc in zip(criterion.columns, criterion.ascending)]
+        return list(zip(*[c.tolist() for c in columns]))
+
+    def update(self, chunk):
+        """
+        Add a chunk of rows.
+        """
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        row_numbers = pd.Series(self.rows_seen + np.arange(len(chunk)), index=chunk.index)
+        self.rows_seen += len(chunk)
+
+        for name, criterion in self.criteria.items():
+            df = chunk if criterion.mask is None else chunk[criterion.mask(chunk).fillna(False).astype(bool)]
+            df = df.dropna(subset=criterion.columns)
+            if len(df) == 0:
+                continue
+            self.query_counts[name].update(df[self.query_column].values)
+
+            # only the best k rows of the chunk can enter the heap
+            df = df.sort_values(criterion.columns, ascending=criterion.ascending, kind='stable')
+            best = df.head(self.k)
+            for score, row_number, record in zip(self.get_scores(criterion, best), row_numbers[best.index],
+                                                 best.to_dict('records')):
+                self.push(self.heaps[name], self.k, (score, -row_number, record))
+
+            if self.per_query_k:
+                best = df.groupby(self.query_column, sort=False).head(self.per_query_k)
+                heaps = self.query_heaps[name]
+                for score, row_number, record in zip(self.get_scores(criterion, best), row_numbers[best.index],
+                                                     best.to_dict('records')):
+                    heap = heaps.setdefault(record[self.query_column], [])
+                    self.push(heap, self.per_query_k, (score, -row_number, record))
+
+    def sorted_records(self, heap):
+        """
+        Records of a heap, best first.
+        """
+        return [record for _, _, record in sorted(heap, key=lambda e: e[:2], reverse=True)]
+
+    def to_frame(self, per_query=False, key_column='key'):
+        """
+        Selected rows of all criteria tagged with the criterion name in key_column.
+        """
+        frames = []
+        for name in self.criteria:
+            if per_query:
+                records = [r for q in sorted(self.query_heaps[name])
+                           for r in self.sorted_records(self.query_heaps[name][q])]
+            else:
+                records = self.sorted_records(self.heaps[name])
+            frames.append(pd.DataFrame(records, columns=self.columns).assign(**{key_column: name}))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=(self.columns or []) + [key_column])
+        return pd.concat(frames, ignore_index=True)
+
+
+def iter_csv_chunks(csv_p, chunksize=100_000):
+    """
+    Stream an annotated results csv in chunks with plot column names.
+    """
+    for chunk in pd.read_csv(csv_p, chunksize=chunksize):
+        yield clean_columns(chunk)
+
+
+def iter_parquet_chunks(parquet_p, batch_size=100_000):
+    """
+    Stream a Parquet file (or a directory of Parquet files) in record batches with plot column names.
+    """
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(str(parquet_p), format='parquet')
+    for batch in dataset.to_batches(batch_size=batch_size):
+        yield clean_columns(batch.to_pandas())
+
+
+def iter_dataset_chunks(dataset_dir, chunksize=100_000):
+    """
+    Stream the annotated dataset in chunks with plot column names, from its memory-mapped shared table.
+    """
+    for chunk in iter_shared_chunks(share_dataset(dataset_dir), chunksize=chunksize):
+        yield clean_columns(chunk)
+
+
+def iter_m8_chunks(results_dir, chunksize=100_000, parse_filter=None):
+    """
+    Stream the raw m8 results in chunks with plot column names.
+    """
+    for chunk in iter_foldseek_chunks(results_dir, chunksize=chunksize, parse_filter=parse_filter):
+        yield clean_columns(chunk)
+
+
+def select_top_hits(chunks, criteria=None, k=5, per_query_k=None):
+    """
+    Run all criteria over a stream of chunks in a single pass.
+    """
+    top = TopK(criteria if criteria is not None else get_top_criteria(), k=k, per_query_k=per_query_k)
+    for chunk in chunks:
+        top.update(chunk)
+    return top
+
+
+def add_top_arguments(parser):
+    """
+    Add the top table options to an argument parser.
+    """
+    parser.add_argument('--per-query-k', type=int, default=None,
+                        help='also write the best k hits of every query and criterion to top_per_query.csv')
+    return parser
+
+
+def write_top_tables(top, csv_dir):
+    """
+    Write top_all.csv, and top_per_query.csv when the hits were also selected per query.
+    """
+    csv_dir.mkdir(exist_ok=True)
+    top.to_frame().to_csv(csv_dir / "top_all.csv", index=False)
+    if top.per_query_k:
+        top.to_frame(per_query=True).to_csv(csv_dir / "top_per_query.csv", index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Select the top foldseek hits for several criteria.')
+    args = add_top_arguments(parser).parse_args()
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    dataset_dir = get_dataset_dir()
+    if dataset_dir.exists():
+        chunks = iter_dataset_chunks(dataset_dir)
+    else:
+        chunks = iter_csv_chunks(script_dir / 'foldseek_parsed_results_nohuman_annotated.csv')
+
+    report = get_report()
+    with report.stage('top hits') as stage:
+        # the annotated dataset has the structural scores, the old csv does not
+        top = select_top_hits(chunks, get_top_criteria(structure=dataset_dir.exists()), per_query_k=args.per_query_k)
+        stage['items'] = top.rows_seen
+    print("Peptide strong matches counts:")
+    print(pd.Series(top.query_counts['top_both']).sort_values(ascending=False).head(5))
+
+    write_top_tables(top, script_dir / 'top_csv')
+    report.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,17 @@
 import pandas as pd 
 import os
-import requests
 import pathlib
 import Bio.PDB
 
+from http_client import get_client
+from instrumentation import get_report
+
 def download_pdb_struct(pdb_id : str, save_path : pathlib.Path):
     """
     Downloads a PDB structure from the RCSB PDB database.
     """
     url = f'https://files.rcsb.org/download/{pdb_id}.pdb'
-    r = requests.get(url)
+    r = get_client().get('rcsb', url)
     # check if it is not html
     if "the requested url was not found on this server" in r.text.lower():
         raise ValueError(f'{pdb_id} not found')
@@ -55,7 +57,7 @@ def download_all():
     out_dir.mkdir(exist_ok=True)
 
     # ,Peptide name,Sequence,Sequence length,PDB,Chain,Receptor,Family,GPCR Class
-    df = pd.read_csv(script_dir / 'GPCRdb_peptide_ligands.csv')
+    df = pd.read_csv(script_dir.parent / 'oma_search' / 'GPCRdb_peptide_ligands.csv')
     df['PDB'] = df['PDB'].str.upper()
     df['PDB'] = df['PDB'].apply(lambda x: x if x != '-' else '')
     df["Chain"] = df["Chain"].str.upper()
@@ -68,10 +70,14 @@ def download_all():
     df['Peptide name'] = df['Peptide name'].str.replace('</sup>', '')
     df["Peptide name"] = df["Peptide name"].str.replace('/', '_')
 
+    report = get_report()
+    progress = report.progress('structures', len(df))
     for i, row in df.iterrows():
+        progress.update()
         # check if hormone has complex/structure
         pdb = row["PDB"]
         if len(pdb) == 0:
+            report.count('no pdb')
             continue
         # get structure info
         chain = row["Chain"]
@@ -92,36 +98,38 @@ def download_all():
         complex_identifier = f'{pdb}___{peptide}'
         save_path_full = full_dir / f'{complex_identifier}.pdb'
         if save_path_full.exists():
-            print(f'{save_path_full} exists')
+            report.count('complex exists')
         else:
-            print(f'downloading {save_path_full}')
             try:
                 download_pdb_struct(pdb, save_path_full)
             except ValueError as e:
                 print(f'could not download {pdb}')
                 print(e)
+                report.count('complex download failed')
                 continue
-            print(f'downloaded {save_path_full}')
+            report.count('complex downloaded')
 
         # check chain
         chain_identifier = f'{peptide}_{pdb}'
         if len(chain) == 0:
             print(f'no chain for {save_path_full}')
+            report.count('no chain')
             continue
         chains_in_pdb = get_chains_of_pdb(save_path_full)
         if chain.upper() not in [c.id.upper() for c in chains_in_pdb]:
             print(f'chain {chain} not in {save_path_full}')
+            report.count('chain missing')
             continue
         
         # save peptide structure
         save_path_chain = out_dir / f'{chain_identifier}.pdb'
         if save_path_chain.exists():
-            print(f'{save_path_chain} exists')
+            report.count('peptide exists')
         else:
-            print(f'keeping chain {chain} of {save_path_full} to {save_path_chain}')
             keep_only_chain_of_pdb(save_path_full, chain, save_path_chain)
-            print(f'kept chain {chain} of {save_path_full} to {save_path_chain}')
+            report.count('peptide saved')
 
 
 if __name__ == '__main__':
     download_all()
+    get_report().write()
@@ -0,0 +1,43 @@
+""" Normalized hormone names of Foldseek queries and OMA ligands, so both searches can be matched by hormone.
+
+A Foldseek query is named by its structure file ('Galanin__Human_7XJK',
+'alpha_MSH_2IQP'), an OMA ligand by its fasta description ('galanin_1',
+'α-msh_1'). Both reduce to lower case words without punctuation, 'human' and
+the PDB ID or entry number, with greek letters spelled out ('galanin',
+'alpha msh').
+"""
+import pandas as pd
+
+
+def get_greek_letters():
+    """
+    Spelled out names of the greek letters in hormone names (the ligand fasta has 'α-msh', the structures 'alpha_MSH').
+    """
+    return {'α': 'alpha', 'β': 'beta', 'γ': 'gamma', 'δ': 'delta', 'ε': 'epsilon', 'ζ': 'zeta', 'η': 'eta',
+            'θ': 'theta', 'κ': 'kappa', 'λ': 'lambda', 'μ': 'mu', 'π': 'pi', 'σ': 'sigma', 'τ': 'tau',
+            'φ': 'phi', 'χ': 'chi', 'ψ': 'psi', 'ω': 'omega'}
+
+
+def normalize_hormone(names):
+    """
+    Hormone names as lower case words without punctuation and 'human', greek letters spelled out.
+    """
+    names = pd.Series(names, dtype=object).fillna('').astype(str).str.lower()
+    names = names.str.translate(str.maketrans(get_greek_letters()))
+    names = names.str.replace(r'[\W_]+', ' ', regex=True).str.replace(r'\bhuman\b', ' ', regex=True)
+    return names.str.split().str.join(' ')
+
+
+def get_query_hormone(queries):
+    """
+    Hormone of Foldseek queries, named by their structure file ('Galanin__Human_7XJK').
+    """
+    queries = pd.Series(queries, dtype=object).str.replace(r'_[0-9][0-9A-Za-z]{3}$', '', regex=True)
+    return normalize_hormone(queries)
+
+
+def get_ligand_hormone(descriptions):
+    """
+    Hormone of ligand fasta entries ('galanin_1').
+    """
+    return normalize_hormone(pd.Series(descriptions, dtype=object).str.replace(r'_\d+$', '', regex=True))
@@ -0,0 +1,207 @@
+""" Shared HTTP client of the remote lookups (UniProt, Entrez, RCSB, OMA, NCBI taxdump) with record / replay.
+
+All clients go through one requests.Session per process, so connections to a
+host are pooled and reused, and transient failures (connection errors, 429 and
+5xx responses) are retried with backoff in one place. Every call is recorded in
+the run report (instrumentation.py) under its endpoint name.
+
+HTTP_MODE selects where responses come from:
+    live     network only (default)
+    record   network, every response is also stored in the archive
+    replay   archive only, a request that was not recorded raises LookupError
+
+The archive (HTTP_ARCHIVE, default http_archive.sqlite next to this file) is a
+single sqlite file with one zlib compressed response per request key (method,
+URL and sorted parameters, without the contact email of Entrez). A recorded run
+can be replayed on a node without network access, deterministically and at
+local disk speed; rate limiting pauses (pause) are skipped while replaying.
+
+    HTTP_MODE=record python foldseek_annotate.py
+    HTTP_MODE=replay python foldseek_annotate.py
+"""
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.util.retry import Retry
+
+from instrumentation import get_report
+
+
+def get_http_modes():
+    """
+    Valid values of HTTP_MODE.
+    """
+    return ['live', 'record', 'replay']
+
+
+def get_archive_path():
+    """
+    Location of the response archive (HTTP_ARCHIVE or http_archive.sqlite next to this file).
+    """
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    return pathlib.Path(os.environ.get('HTTP_ARCHIVE', script_dir / 'http_archive.sqlite'))
+
+
+def get_ignored_params():
+    """
+    Request parameters that do not change the response and are left out of the archive key.
+    """
+    return ['email', 'tool']
+
+
+def request_key(method, url, params=None, data=None):
+    """
+    Archive key of a request.
+    """
+    params = sorted((str(k), str(v)) for k, v in (params or {}).items() if k not in get_ignored_params())
+    data = sorted((str(k), str(v)) for k, v in (data or {}).items() if k not in get_ignored_params())
+    return hashlib.sha256(json.dumps([method.upper(), url, params, data]).encode()).hexdigest()
+
+
+class ResponseArchive:
+    """
+    Recorded responses in a sqlite file, bodies compressed with zlib.
+    """
+    def __init__(self, archive_p=None):
+        self.archive_p = pathlib.Path(archive_p or get_archive_path())
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            self.archive_p.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(str(self.archive_p), check_same_thread=False)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, method TEXT, url TEXT, '
+                'status INTEGER, headers TEXT, body BLOB, recorded REAL)')
+        return self.connection
+
+    def get(self, key):
+        """
+        (status, headers, body) of a recorded request, None if it was not recorded.
+        """
+        if not self.archive_p.exists():
+            return None
+        with self.lock:
+            row = self.connect().execute(
+                'SELECT status, headers, body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        status, headers, body = row
+        return status, json.loads(headers), zlib.decompress(body)
+
+    def put(self, key, method, url, status, headers, body):
+        """
+        Store (or replace) the response of a request.
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, method.upper(), url, status, json.dumps(headers),
+                                zlib.compress(body, 6), time.time()))
+            connection.commit()
+
+
+def make_response(url, status, headers, body):
+    """
+    requests.Response of a recorded response.
+    """
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = body
+    response._content_consumed = True
+    return response
+
+
+class HttpClient:
+    """
+    Pooled session with retries, run report statistics and the record / replay archive.
+    """
+    def __init__(self, mode=None, archive_p=None, retries=3, backoff=1.0, timeout=60, pool_size=8):
+        self.mode = mode or os.environ.get('HTTP_MODE', 'live')
+        if self.mode not in get_http_modes():
+            raise ValueError(f"HTTP_MODE must be one of {get_http_modes()}, not {self.mode}")
+        self.archive = ResponseArchive(archive_p) if self.mode != 'live' else None
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['GET', 'POST'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def request(self, endpoint, method, url, params=None, data=None, stream=False):
+        """
+        Response of a request, from the network or the archive depending on the mode.
+
+        stream only applies to live mode, recording reads the whole body.
+        """
+        report = get_report()
+        key = request_key(method, url, params, data)
+        if self.replaying:
+            recorded = self.archive.get(key)
+            if recorded is None:
+                raise LookupError(f"No recorded response for {method} {url} {params or ''} "
+                                  f"in {self.archive.archive_p}")
+            report.count(f'{endpoint} replayed')
+            return make_response(url, *recorded)
+
+        with report.http_call(endpoint) as call:
+            response = self.session.request(method, url, params=params, data=data, timeout=self.timeout,
+                                            stream=stream and self.mode == 'live')
+            call['retries'] = len(response.raw.retries.history) if response.raw.retries else 0
+            call['error'] = response.status_code != 200
+        if self.mode == 'record':
+            self.archive.put(key, method, url, response.status_code, dict(response.headers), response.content)
+            report.count(f'{endpoint} recorded')
+        return response
+
+    def get(self, endpoint, url, params=None):
+        return self.request(endpoint, 'GET', url, params=params)
+
+    def post(self, endpoint, url, data=None):
+        return self.request(endpoint, 'POST', url, data=data)
+
+    def download(self, endpoint, url, save_path):
+        """
+        Write the body of a GET request to a file.
+        """
+        with self.request(endpoint, 'GET', url, stream=True) as response:
+            response.raise_for_status()
+            with open(save_path, 'wb') as f:
+                for block in response.iter_content(1 << 20):
+                    f.write(block)
+        return save_path
+
+    def pause(self, seconds):
+        """
+        Rate limiting sleep between requests, skipped while replaying.
+        """
+        if not self.replaying:
+            time.sleep(seconds)
+
+
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """
+    The HTTP client of this process, created on first use.
+    """
+    return HttpClient()
@@ -0,0 +1,247 @@
+""" Run-level instrumentation: stage timers, throughput counters, peak memory and HTTP statistics.
+
+A single report per process collects
+    - stages: wall time, item counts, throughput and peak RSS while the stage ran
+    - counters: free-form counts (e.g. structures downloaded, lookups failed)
+    - http: calls, retries, errors and a latency histogram per endpoint
+and is written as json at the end of a run (run_reports/<run>_<time>.json).
+
+    report = get_report('foldseek_annotate')
+    with report.stage('lineage lookup', items=len(taxon_ids)):
+        ...
+    report.write()
+"""
+import json
+import os
+import pathlib
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds (seconds) of the latency histogram buckets, the last one is open
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes (peak RSS where /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Progress:
+    """
+    Live progress with throughput and ETA, printed at most every `interval` seconds.
+    """
+    def __init__(self, name, total, interval=10):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last_print = 0
+
+    def update(self, n=1):
+        self.done += n
+        now = time.time()
+        if now - self.last_print >= self.interval or self.done == self.total:
+            self.last_print = now
+            print(self.format(now))
+
+    def format(self, now=None):
+        elapsed = (now or time.time()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        if self.total and rate > 0:
+            eta = (self.total - self.done) / rate
+            return f"{self.name}: {self.done}/{self.total} ({rate:.1f}/s, ETA {eta:.0f} s)"
+        return f"{self.name}: {self.done} ({rate:.1f}/s)"
+
+
+class RunReport:
+    """
+    Collects stage timings, counters, memory and HTTP statistics of a run.
+    """
+    def __init__(self, name, sample_interval=0.5):
+        self.name = name
+        self.started = time.time()
+        self.stages = []
+        self.counters = {}
+        self.http = {}
+        self.peak_rss = current_rss()
+        self.lock = threading.Lock()
+        self.open_stages = []
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_memory, args=(sample_interval,), daemon=True)
+        self.sampler.start()
+
+    def sample_memory(self, interval):
+        """
+        Track the peak RSS of the run and of the stages that are running.
+        """
+        while not self.stopped.wait(interval):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss()
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            for stage in self.open_stages:
+                stage['peak_rss'] = max(stage['peak_rss'], rss)
+
+    def close(self):
+        """
+        Take a last memory sample and stop the sampler thread.
+        """
+        if not self.stopped.is_set():
+            self.sample()
+            self.stopped.set()
+            self.sampler.join()
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """
+        Time a stage. items (or stage['items'] set inside the block) gives the throughput.
+        """
+        stage = {'name': name, 'items': items, 'peak_rss': current_rss()}
+        with self.lock:
+            self.open_stages.append(stage)
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            seconds = time.time() - start
+            with self.lock:
+                self.open_stages.remove(stage)
+                stage['peak_rss'] = max(stage['peak_rss'], current_rss())
+            stage['seconds'] = round(seconds, 3)
+            if stage['items'] is not None and seconds > 0:
+                stage['items_per_s'] = round(stage['items'] / seconds, 1)
+            stage['peak_rss_mb'] = round(stage.pop('peak_rss') / 2 ** 20, 1)
+            self.stages.append(stage)
+            print(f"[{self.name}] {name}: {stage['seconds']} s"
+                  + (f", {stage['items']} items" if stage['items'] is not None else ''))
+
+    def count(self, name, n=1):
+        """
+        Increase a counter.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_http(self, endpoint, seconds, retries=0, error=False):
+        """
+        Record one call to a remote endpoint.
+        """
+        with self.lock:
+            stats = self.http.setdefault(endpoint, {
+                'calls': 0, 'retries': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1)})
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['errors'] += int(bool(error))
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            bucket = next((i for i, b in enumerate(LATENCY_BUCKETS) if seconds <= b), len(LATENCY_BUCKETS))
+            stats['histogram'][bucket] += 1
+
+    @contextmanager
+    def http_call(self, endpoint):
+        """
+        Time a remote call; set call['retries'] / call['error'] inside the block if needed.
+        """
+        call = {'retries': 0, 'error': False}
+        start = time.time()
+        try:
+            yield call
+        except Exception:
+            call['error'] = True
+            raise
+        finally:
+            self.record_http(endpoint, time.time() - start, call['retries'], call['error'])
+
+    def progress(self, name, total, interval=10):
+        """
+        Progress printer with ETA for a loop over total items.
+        """
+        return Progress(f"[{self.name}] {name}", total, interval)
+
+    def to_dict(self):
+        with self.lock:
+            http = {}
+            for endpoint, stats in self.http.items():
+                stats = dict(stats)
+                stats['mean_seconds'] = round(stats['seconds'] / stats['calls'], 4) if stats['calls'] else None
+                stats['seconds'] = round(stats['seconds'], 3)
+                stats['max_seconds'] = round(stats['max_seconds'], 3)
+                stats['histogram'] = {f'<={b}s': c for b, c in zip(LATENCY_BUCKETS, stats['histogram'])} | \
+                                     {f'>{LATENCY_BUCKETS[-1]}s': stats['histogram'][-1]}
+                http[endpoint] = stats
+            return {
+                'run': self.name,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'seconds': round(time.time() - self.started, 3),
+                'peak_rss_mb': round(self.peak_rss / 2 ** 20, 1),
+                'stages': list(self.stages),
+                'counters': dict(self.counters),
+                'http': http,
+            }
+
+    def write(self, report_dir=None):
+        """
+        Write the report as json and return its path. Ends the memory sampling of the run.
+        """
+        self.close()
+        if report_dir is None:
+            report_dir = pathlib.Path(__file__).parent.absolute() / 'run_reports'
+        report_dir = pathlib.Path(report_dir)
+        report_dir.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(self.started))
+        report_p = report_dir / f'{self.name}_{stamp}.json'
+        report_p.write_text(json.dumps(self.to_dict(), indent=1))
+        print(f"Run report written to {report_p}")
+        return report_p
+
+
+_report = None
+
+
+def get_report(name=None):
+    """
+    The report of this process, created on first use (name defaults to the script name).
+    """
+    global _report
+    if _report is None:
+        _report = RunReport(name or pathlib.Path(sys.argv[0]).stem or 'run')
+    return _report
+
+
+def import_curl_timings(timings_p, report=None):
+    """
+    Add HTTP timings written by the shell scripts (endpoint, seconds, http code per line).
+    """
+    report = report or get_report()
+    with open(timings_p) as f:
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) < 3:
+                continue
+            endpoint, seconds, code = parts[:3]
+            report.record_http(endpoint, float(seconds), error=not code.startswith('2'))
+    return report
+
+
+if __name__ == "__main__":
+    # turn the curl timings of the foldseek shell scripts into a run report
+    for timings_p in sys.argv[1:]:
+        report = RunReport(pathlib.Path(timings_p).stem)
+        import_curl_timings(timings_p, report)
+        report.write()
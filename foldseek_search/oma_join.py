@@ -0,0 +1,188 @@
+""" Join the OMA (sequence search) and Foldseek (structure search) hits by taxonomy and hormone.
+
+OMA targets (oma_search/oma_search_results_bacteria.json) name their species, which
+are resolved to taxon IDs with the species -> taxon cache of foldseek_annotate
+(foldseek_species_to_taxon.csv, missing species are looked up at UniProt unless
+--offline). The taxa of both sides are mapped to their ancestor at a chosen rank
+(taxonomy_index.py) and the hormones to a normalized name (hormones.py): the OMA
+query sequence is named by ligand_sequences.fasta, the Foldseek query by its structure file
+('Galanin__Human_7XJK' and 'galanin_1' are both 'galanin', 'α-msh_1' and
+'alpha_MSH_2IQP' are both 'alpha msh'). Hormones whose name has no counterpart
+on the other side are written to oma_foldseek_<rank>_unmatched_hormones.csv.
+
+Both sides are first aggregated per hormone and clade, then joined with one hash
+join (pandas merge), so the runtime grows linearly with the number of hits. The
+combined table has a row per hormone and clade hit by both searches:
+
+    Hormone, Rank, Taxon ID, Name, Foldseek hits, Foldseek queries, Best E-value,
+    Best TM-score, OMA targets, OMA species, Identified by
+
+Usage:
+    python oma_join.py                      # species level, oma_foldseek_species.csv
+    python oma_join.py --rank genus
+"""
+import argparse
+import json
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+
+from taxonomy_index import load_taxonomy_index, load_taxon_names
+from hormones import get_query_hormone, get_ligand_hormone
+
+
+def get_oma_dir():
+    """
+    Directory of the OMA workflow.
+    """
+    return pathlib.Path(__file__).parent.parent.absolute() / 'oma_search'
+
+
+def read_fasta(fasta_p):
+    """
+    (description, sequence) pairs of a fasta file.
+    """
+    records = []
+    for line in pathlib.Path(fasta_p).read_text().splitlines():
+        if line.startswith('>'):
+            records.append([line[1:].strip(), ''])
+        elif records:
+            records[-1][1] += line.strip()
+    return [tuple(r) for r in records]
+
+
+def read_oma_hits(oma_json_p, fasta_p):
+    """
+    OMA bacterial targets with their hormone (a sequence can be the ligand of several hormones).
+    """
+    targets = pd.DataFrame(json.loads(pathlib.Path(oma_json_p).read_text()))
+    ligands = pd.DataFrame(read_fasta(fasta_p), columns=['Description', 'query'])
+    ligands['Hormone'] = get_ligand_hormone(ligands['Description'])
+    ligands = ligands[['query', 'Hormone']].drop_duplicates()
+    return targets.merge(ligands, on='query', how='inner')
+
+
+def resolve_species(species, species_csv, offline=False):
+    """
+    Taxon IDs of species names from the species -> taxon cache (looked up at UniProt if not offline).
+    """
+    species = pd.Series(species, dtype=object)
+    if offline:
+        cache = pd.read_csv(species_csv, index_col=0) if pathlib.Path(species_csv).exists() else None
+        taxon_ids = cache['Taxon ID'] if cache is not None else pd.Series(dtype='Int64')
+    else:
+        from foldseek_annotate import get_species_to_taxon
+        taxon_ids = get_species_to_taxon(species.dropna().unique(), species_csv)['Taxon ID']
+    taxon_ids = pd.to_numeric(taxon_ids, errors='coerce')
+    taxon_ids = taxon_ids[~taxon_ids.index.duplicated()]
+    return species.map(taxon_ids).astype('Int64')
+
+
+def summarize_foldseek(hits, clade):
+    """
+    Foldseek hits per hormone and clade.
+    """
+    hits = pd.DataFrame({
+        'Hormone': get_query_hormone(hits['Query']).values, 'Taxon ID': clade,
+        'Query': hits['Query'].values, 'E-value': hits['E-value'].values,
+        'TM-score': hits['TM-score'].values if 'TM-score' in hits.columns else np.nan,
+    })
+    grouped = hits[hits['Taxon ID'] >= 0].groupby(['Hormone', 'Taxon ID'], sort=False)
+    return grouped.agg(**{
+        'Foldseek hits': ('Query', 'size'),
+        'Foldseek queries': ('Query', lambda q: ';'.join(sorted(set(q)))),
+        'Best E-value': ('E-value', 'min'),
+        'Best TM-score': ('TM-score', 'max'),
+    }).reset_index()
+
+
+def summarize_oma(targets, clade):
+    """
+    OMA targets per hormone and clade.
+    """
+    targets = pd.DataFrame({
+        'Hormone': targets['Hormone'].values, 'Taxon ID': clade,
+        'Species': targets['target_species'].values, 'Identified by': targets['identified_by'].values,
+    })
+    grouped = targets[targets['Taxon ID'] >= 0].groupby(['Hormone', 'Taxon ID'], sort=False)
+    return grouped.agg(**{
+        'OMA targets': ('Species', 'size'),
+        'OMA species': ('Species', lambda s: ';'.join(sorted(set(s)))),
+        'Identified by': ('Identified by', lambda s: ';'.join(sorted(set(s)))),
+    }).reset_index()
+
+
+def join_hits(foldseek_hits, oma_targets, index, rank='species', names=None):
+    """
+    Hormones and clades (taxa of the rank) hit by both searches.
+
+    foldseek_hits needs Query, Taxon ID and E-value (TM-score is optional),
+    oma_targets needs Hormone, Taxon ID, target_species and identified_by.
+    """
+    foldseek = summarize_foldseek(foldseek_hits, index.at_rank(foldseek_hits['Taxon ID'], rank))
+    oma = summarize_oma(oma_targets, index.at_rank(oma_targets['Taxon ID'], rank))
+    joined = foldseek.merge(oma, on=['Hormone', 'Taxon ID'], how='inner')
+    joined.insert(1, 'Rank', rank)
+    if callable(names):
+        names = names(joined['Taxon ID'].unique())
+    joined.insert(3, 'Name', joined['Taxon ID'].map(names or {}))
+    return joined.sort_values(['Hormone', 'Best E-value'], ignore_index=True)
+
+
+def get_unmatched_hormones(foldseek_hits, oma_targets):
+    """
+    Hormones of only one of the searches (no hormone of the other side has the same normalized name).
+    """
+    foldseek = set(get_query_hormone(pd.Series(foldseek_hits['Query']).dropna().unique()))
+    oma = set(oma_targets['Hormone'].dropna())
+    rows = [(h, 'Foldseek') for h in sorted(foldseek - oma)] + [(h, 'OMA') for h in sorted(oma - foldseek)]
+    return pd.DataFrame(rows, columns=['Hormone', 'Only in'])
+
+
+def main():
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    oma_dir = get_oma_dir()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rank', default='species', help='rank to join the taxa on, e.g. species or genus')
+    parser.add_argument('--oma-json', type=pathlib.Path, default=oma_dir / 'oma_search_results_bacteria.json')
+    parser.add_argument('--fasta', type=pathlib.Path, default=oma_dir / 'ligand_sequences.fasta')
+    parser.add_argument('--offline', action='store_true', help='only use the cached species -> taxon IDs')
+    parser.add_argument('--taxdump-dir', type=pathlib.Path, default=None)
+    parser.add_argument('--output', type=pathlib.Path, default=None,
+                        help='default: oma_foldseek_<rank>.csv')
+    args = parser.parse_args()
+
+    index = load_taxonomy_index(args.taxdump_dir)
+    if index is None:
+        sys.exit("No NCBI taxdump found, download it with taxonomy_index.download_taxdump()")
+
+    oma_targets = read_oma_hits(args.oma_json, args.fasta)
+    oma_targets['Taxon ID'] = resolve_species(oma_targets['target_species'],
+                                              script_dir / 'foldseek_species_to_taxon.csv', args.offline)
+    print(f"OMA targets: {len(oma_targets)}, with taxon ID: {oma_targets['Taxon ID'].notna().sum()}")
+
+    import pyarrow.dataset as ds
+    from annotated_store import get_dataset_dir, read_annotated_dataset
+    available = ds.dataset(str(get_dataset_dir()), format='parquet').schema.names
+    foldseek_hits = read_annotated_dataset(get_dataset_dir(), columns=[c for c in ['Query', 'Taxon ID', 'E-value',
+                                                                                   'TM-score'] if c in available])
+
+    joined = join_hits(foldseek_hits, oma_targets, index, args.rank,
+                       names=lambda taxids: load_taxon_names(args.taxdump_dir, taxids))
+    output_p = args.output or script_dir / f'oma_foldseek_{args.rank}.csv'
+    joined.to_csv(output_p, index=False)
+    print(f"{len(joined)} hormone / {args.rank} pairs hit by both searches, written to {output_p}")
+
+    # hormones that cannot join because their name has no counterpart on the other side
+    unmatched = get_unmatched_hormones(foldseek_hits, oma_targets)
+    unmatched_p = output_p.with_name(f'{output_p.stem}_unmatched_hormones.csv')
+    unmatched.to_csv(unmatched_p, index=False)
+    counts = unmatched['Only in'].value_counts()
+    print(f"Hormones without a match: {counts.get('Foldseek', 0)} only in Foldseek, "
+          f"{counts.get('OMA', 0)} only in OMA, written to {unmatched_p}")
+
+
+if __name__ == "__main__":
+    main()
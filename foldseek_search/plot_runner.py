@@ -0,0 +1,207 @@
+""" Render plots in parallel worker processes and skip figures whose inputs did not change.
+
+Every plot is described by a PlotJob: the plot function, the (projected) data it
+reads, its remaining arguments and the files it writes. A job is keyed on a hash
+of the data, the arguments and the source of the module defining the plot
+function (so edits to its helpers count as well), and is only rendered again
+when that key differs from the one stored next to its outputs.
+
+The data can be a SharedTable (see shared_table.py): the job then only carries
+the path of the memory-mapped table and its columns, and the worker reads the
+column slices from the mapping instead of unpickling a copy of the data. A
+prepare function (e.g. renaming columns) is applied to the data in the worker.
+"""
+import hashlib
+import inspect
+import json
+import pathlib
+import multiprocessing
+import pickle
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import numpy as np
+import pandas as pd
+
+from shared_table import SharedTable, read_shared
+
+
+# prepare: function applied to the data in the worker before func (or None)
+PlotJob = namedtuple('PlotJob', ['func', 'data', 'args', 'kwargs', 'outputs', 'prepare'], defaults=(None,))
+
+
+def plot_job(func, data, *args, outputs, columns=None, prepare=None, **kwargs):
+    """
+    Describe a single plot.
+
+    data is projected to `columns` (DataFrame columns or dictionary keys of a
+    list of records) so that only what the plot reads is hashed and sent to the
+    worker process. A SharedTable is not read here, the worker maps its columns.
+    """
+    if columns is not None:
+        if isinstance(data, SharedTable):
+            data = data._replace(columns=list(dict.fromkeys(columns)))
+        elif isinstance(data, pd.DataFrame):
+            data = data[list(dict.fromkeys(columns))]
+        else:
+            data = [{c: d.get(c) for c in columns} for d in data]
+    outputs = [pathlib.Path(o) for o in outputs]
+    return PlotJob(func, data, args, kwargs, outputs, prepare)
+
+
+def hash_data(data, h):
+    """
+    Update hash h with the content of a DataFrame, a file or a plain python value.
+    """
+    if isinstance(data, SharedTable):
+        # the file name of a shared table contains the hash of its content
+        h.update(json.dumps([pathlib.Path(data.path).name, data.columns]).encode())
+    elif isinstance(data, pd.DataFrame):
+        h.update(json.dumps([list(map(str, data.columns)), list(map(str, data.dtypes))]).encode())
+        h.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    elif isinstance(data, pathlib.Path) and data.is_file():
+        # files passed as inputs (e.g. the fasta file) are hashed by content
+        with open(data, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    elif isinstance(data, np.ndarray):
+        h.update(str(data.dtype).encode())
+        h.update(np.ascontiguousarray(data).tobytes())
+    else:
+        h.update(json.dumps(data, sort_keys=True, default=str).encode())
+
+
+def hash_function(func, h):
+    """
+    Update hash h with a function and the source of the module it is defined in.
+    """
+    # the whole module is hashed, so changes of its helpers invalidate the cache
+    # too; it is named by file name because __module__ is '__main__' when the
+    # module runs as a script
+    try:
+        module_p = pathlib.Path(inspect.getsourcefile(func))
+    except TypeError:
+        module_p = None
+    h.update(f'{module_p.name if module_p else ""}:{func.__qualname__}'.encode())
+    if module_p is not None and module_p.is_file():
+        hash_data(module_p, h)
+
+
+def job_key(job):
+    """
+    Content hash of a plot job (data, arguments and the source of the plot function's module).
+    """
+    h = hashlib.sha256()
+    hash_function(job.func, h)
+    if job.prepare is not None:
+        hash_function(job.prepare, h)
+    hash_data(job.data, h)
+    # output paths are hashed by name only, their content changes with every render
+    outputs = set(job.outputs)
+    for arg in job.args:
+        hash_data(str(arg) if isinstance(arg, pathlib.Path) and arg in outputs else arg, h)
+    for name in sorted(job.kwargs):
+        h.update(name.encode())
+        value = job.kwargs[name]
+        hash_data(str(value) if isinstance(value, pathlib.Path) and value in outputs else value, h)
+    hash_data([str(o) for o in job.outputs], h)
+    return h.hexdigest()
+
+
+def get_cache_paths(job):
+    """
+    Paths of the key file and pickled return value for a plot job.
+    """
+    first = job.outputs[0]
+    cache_dir = first.parent / '.plot_cache'
+    return cache_dir / f'{first.name}.json', cache_dir / f'{first.name}.pkl'
+
+
+def is_cached(job, key):
+    """
+    Check if all outputs exist and were produced with the same key.
+    """
+    key_p, result_p = get_cache_paths(job)
+    if not key_p.exists() or not result_p.exists():
+        return False
+    if not all(o.exists() for o in job.outputs):
+        return False
+    return json.loads(key_p.read_text()).get('key') == key
+
+
+def load_cached_result(job):
+    """
+    Load the return value stored for a cached plot job.
+    """
+    _, result_p = get_cache_paths(job)
+    with open(result_p, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_cached_result(job, key, result):
+    """
+    Store the key and return value of a rendered plot job.
+    """
+    key_p, result_p = get_cache_paths(job)
+    key_p.parent.mkdir(parents=True, exist_ok=True)
+    with open(result_p, 'wb') as f:
+        pickle.dump(result, f)
+    # the key is written last, so an interrupted run is never seen as cached
+    key_p.write_text(json.dumps({'key': key, 'outputs': [str(o) for o in job.outputs]}))
+
+
+def init_worker(style, context):
+    """
+    Set up a worker process with a non-interactive backend.
+    """
+    matplotlib.use('Agg', force=True)
+    import seaborn as sns
+    sns.set_style(style)
+    sns.set_context(context)
+
+
+def render(job):
+    """
+    Render a plot job inside a worker process.
+    """
+    import matplotlib.pyplot as plt
+    for o in job.outputs:
+        o.parent.mkdir(parents=True, exist_ok=True)
+    data = read_shared(job.data) if isinstance(job.data, SharedTable) else job.data
+    if job.prepare is not None:
+        data = job.prepare(data)
+    result = job.func(data, *job.args, **job.kwargs)
+    plt.close('all')
+    return result
+
+
+def run_plots(jobs, max_workers=None, style='whitegrid', context='paper', force=False):
+    """
+    Render plot jobs in parallel, skipping jobs whose cached outputs are still valid.
+
+    Returns the return values of the plot functions, in the order of jobs.
+    """
+    keys = [job_key(job) for job in jobs]
+    results = [None] * len(jobs)
+    todo = []
+    for i, (job, key) in enumerate(zip(jobs, keys)):
+        if not force and is_cached(job, key):
+            print(f"Up to date: {job.outputs[0]}")
+            results[i] = load_cached_result(job)
+        else:
+            todo.append(i)
+
+    if len(todo) == 0:
+        return results
+
+    # spawned workers start clean: a forked worker would inherit the run report's sampler lock
+    # (and any other lock) in whatever state a thread of the parent held it
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(style, context)) as executor:
+        futures = {i: executor.submit(render, jobs[i]) for i in todo}
+        for i, future in futures.items():
+            results[i] = future.result()
+            save_cached_result(jobs[i], keys[i], results[i])
+            print(f"Rendered: {jobs[i].outputs[0]}")
+    return results
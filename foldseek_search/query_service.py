@@ -0,0 +1,307 @@
+""" Indexed queries over the annotated foldseek hits, from the command line or a local HTTP endpoint.
+
+The hits are read from the memory-mapped shared table of the annotated dataset
+(shared_table.py). Secondary indexes on Query, Database, Taxon ID, the lineage
+ranks and the known gut microbe columns map every value to its rows (sorted row
+numbers per value, in CSR form); they are stored next to the shared table
+(.shared_tables/<table>.index/<column>.npz) and rebuilt only when the dataset
+changes. A query intersects the rows of its equality filters, applies the range
+filters (min.<column> / max.<column>) to the remaining rows only, sorts them and
+returns a page of the projected columns.
+
+Filter values are matched as strings: booleans as true/false, integral numbers
+without decimals, '' for missing values.
+
+Usage:
+    python query_service.py query kingdom=Bacteria Query=Galanin__Human_7XJK max.E-value=1e-5 \\
+        --columns Query species E-value --order-by E-value --limit 20
+    python query_service.py serve --port 8765
+    curl 'http://localhost:8765/query?kingdom=Bacteria&max.E-value=1e-5&columns=Query,species&limit=20'
+    curl 'http://localhost:8765/values?column=genus'
+"""
+import argparse
+import json
+import pathlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from deduplicate import get_database_name
+from shared_table import share_dataset, get_table
+
+
+def get_index_columns():
+    """
+    Columns with a secondary index (Database is derived from Filename).
+    """
+    return ['Query', 'Database', 'Taxon ID', 'superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family',
+            'genus', 'species', 'KnownGutMicrobe(GMrepo)', 'KnownGutMicrobe(MGnify)']
+
+
+def format_keys(values):
+    """
+    Index keys of column values as strings.
+    """
+    values = pd.Series(values)
+    missing = values.isna().to_numpy()
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        numbers = values.astype(float).to_numpy()
+        integral = ~missing & (numbers == np.round(numbers))
+        keys = values.astype(str).to_numpy(dtype=object)
+        keys[integral] = numbers[integral].astype(np.int64).astype(str)
+    else:
+        keys = values.astype(str).replace({'True': 'true', 'False': 'false'}).to_numpy(dtype=object)
+    keys[missing] = ''
+    return keys.astype(str)
+
+
+def format_filter_keys(values):
+    """
+    Index keys of filter values given as strings (numbers are formatted like numeric columns).
+    """
+    keys = []
+    for value in values:
+        if isinstance(value, (bool, np.bool_)):
+            keys.append(str(value).lower())
+            continue
+        try:
+            number = float(value)
+            keys.append(str(int(number)) if number.is_integer() else str(number))
+        except (TypeError, ValueError):
+            keys.append(str(value).replace('True', 'true').replace('False', 'false') if value is not None else '')
+    return keys
+
+
+class ColumnIndex:
+    """
+    Rows of every value of a column: keys, offsets into rows (CSR) and sorted row numbers.
+    """
+    def __init__(self, keys, offsets, rows):
+        self.keys, self.offsets, self.rows = keys, offsets, rows
+        self.positions = {key: i for i, key in enumerate(keys.tolist())}
+
+    @classmethod
+    def build(cls, values):
+        """
+        Index of an array of column values.
+        """
+        codes, keys = pd.factorize(format_keys(values), sort=True)
+        rows = np.argsort(codes, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(keys)))]).astype(np.int64)
+        return cls(np.asarray(keys, dtype=str), offsets, rows)
+
+    def save(self, index_p):
+        np.savez(index_p, keys=self.keys, offsets=self.offsets, rows=self.rows)
+
+    @classmethod
+    def load(cls, index_p):
+        data = np.load(index_p)
+        return cls(data['keys'], data['offsets'], data['rows'])
+
+    def lookup(self, keys):
+        """
+        Sorted rows of any of the keys.
+        """
+        parts = [self.rows[self.offsets[i]:self.offsets[i + 1]]
+                 for i in (self.positions.get(k) for k in keys) if i is not None]
+        if len(parts) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts))
+
+    def counts(self):
+        """
+        Number of rows per key.
+        """
+        return pd.Series(np.diff(self.offsets), index=self.keys)
+
+
+class QueryService:
+    """
+    Filtered, sorted and paginated queries over a shared table with persistent column indexes.
+    """
+    def __init__(self, shared):
+        self.table = get_table(shared)
+        self.columns = self.table.column_names
+        self.index_dir = pathlib.Path(shared.path).with_suffix('.index')
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_dataset(cls, dataset_dir=None):
+        """
+        Service over the annotated dataset.
+        """
+        from annotated_store import get_dataset_dir
+        return cls(share_dataset(dataset_dir or get_dataset_dir()))
+
+    def column_values(self, column):
+        """
+        Values of a table column (Database from Filename).
+        """
+        if column == 'Database':
+            return get_database_name(self.table.column('Filename').to_pandas()).to_numpy()
+        return self.table.column(column).to_pandas().to_numpy()
+
+    def get_index(self, column):
+        """
+        Index of a column, loaded from disk or built (and stored) on first use.
+        """
+        with self.lock:
+            if column not in self.indexes:
+                index_p = self.index_dir / f'{column}.npz'
+                if index_p.exists():
+                    self.indexes[column] = ColumnIndex.load(index_p)
+                else:
+                    self.indexes[column] = ColumnIndex.build(self.column_values(column))
+                    self.index_dir.mkdir(parents=True, exist_ok=True)
+                    self.indexes[column].save(index_p)
+            return self.indexes[column]
+
+    def build_indexes(self):
+        """
+        Load or build the indexes of all indexed columns of the table.
+        """
+        for column in get_index_columns():
+            if column in self.columns or (column == 'Database' and 'Filename' in self.columns):
+                self.get_index(column)
+
+    def query(self, filters=None, ranges=None, columns=None, order_by=None, descending=False,
+              offset=0, limit=50):
+        """
+        Rows matching all filters as a DataFrame page and the total number of matches.
+
+        filters maps indexed columns to a value or a list of values, ranges maps
+        numeric columns to (min, max) with None for an open end.
+        """
+        rows = None
+        for column, values in (filters or {}).items():
+            if column not in get_index_columns():
+                raise ValueError(f"No index on column {column}")
+            values = [values] if isinstance(values, (str, int, float, bool)) else list(values)
+            matches = self.get_index(column).lookup(format_filter_keys(values))
+            rows = matches if rows is None else np.intersect1d(rows, matches, assume_unique=True)
+        if rows is None:
+            rows = np.arange(self.table.num_rows)
+
+        for column, (low, high) in (ranges or {}).items():
+            values = self.table.column(column).take(rows).to_numpy(zero_copy_only=False).astype(float)
+            keep = np.ones(len(rows), dtype=bool)
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high
+            rows = rows[keep]
+
+        if order_by is not None:
+            values = self.table.column(order_by).take(rows).to_pandas()
+            order = values.sort_values(ascending=not descending, kind='stable', na_position='last').index
+            rows = rows[order.to_numpy()]
+
+        page = rows[offset:offset + limit]
+        columns = [c for c in (columns or self.columns) if c in self.columns]
+        return self.table.select(columns).take(page).to_pandas(), len(rows)
+
+    def values(self, column):
+        """
+        Distinct values of an indexed column with their number of rows.
+        """
+        return self.get_index(column).counts()
+
+
+def parse_conditions(items):
+    """
+    Filters and ranges from 'column=value' / 'min.column=value' / 'max.column=value' pairs.
+
+    Values of the same column are combined (any of them matches).
+    """
+    filters, ranges = {}, {}
+    for column, value in items:
+        if column.startswith(('min.', 'max.')):
+            bound, column = column.split('.', 1)
+            low, high = ranges.get(column, (None, None))
+            ranges[column] = (float(value), high) if bound == 'min' else (low, float(value))
+        else:
+            filters.setdefault(column, []).extend(value.split(','))
+    return filters, ranges
+
+
+def make_handler(service):
+    """
+    HTTP request handler answering /query, /values and /columns with json.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            try:
+                if url.path == '/columns':
+                    self.send_json(200, {'columns': service.columns, 'indexed': get_index_columns()})
+                elif url.path == '/values':
+                    counts = service.values(params['column'][0])
+                    self.send_json(200, {'values': counts.to_dict()})
+                elif url.path == '/query':
+                    options = {k: v[0] for k, v in params.items()
+                               if k in ('columns', 'order_by', 'offset', 'limit')}
+                    items = [(k, value) for k, values in params.items() if k not in options for value in values]
+                    filters, ranges = parse_conditions(items)
+                    order_by = options.get('order_by')
+                    page, total = service.query(
+                        filters, ranges, options['columns'].split(',') if 'columns' in options else None,
+                        order_by.lstrip('-') if order_by else None, bool(order_by and order_by.startswith('-')),
+                        int(options.get('offset', 0)), int(options.get('limit', 50)))
+                    self.send_json(200, f'{{"total": {total}, "rows": {page.to_json(orient="records")}}}')
+                else:
+                    self.send_json(404, {'error': f'unknown path {url.path}'})
+            except (KeyError, ValueError) as e:
+                self.send_json(400, {'error': str(e)})
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset-dir', type=pathlib.Path, default=None)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='answer queries over HTTP')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    query = commands.add_parser('query', help='run a single query')
+    query.add_argument('conditions', nargs='*', help='column=value, min.column=value or max.column=value')
+    query.add_argument('--columns', nargs='*', default=None)
+    query.add_argument('--order-by', default=None, help='sort column, prefix with - to sort descending')
+    query.add_argument('--offset', type=int, default=0)
+    query.add_argument('--limit', type=int, default=50)
+    query.add_argument('--output', type=pathlib.Path, default=None, help='write the page as csv')
+    args = parser.parse_args()
+
+    service = QueryService.from_dataset(args.dataset_dir)
+    service.build_indexes()
+    if args.command == 'serve':
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+        print(f"Serving {service.table.num_rows} hits on http://{args.host}:{args.port}")
+        server.serve_forever()
+        return
+
+    filters, ranges = parse_conditions(c.split('=', 1) for c in args.conditions)
+    order_by = args.order_by
+    page, total = service.query(filters, ranges, args.columns, order_by.lstrip('-') if order_by else None,
+                                bool(order_by and order_by.startswith('-')), args.offset, args.limit)
+    if args.output:
+        page.to_csv(args.output, index=False)
+    print(page.to_string(index=False))
+    print(f"Rows {args.offset + 1}-{args.offset + len(page)} of {total}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+""" Content-addressed store of target sequences, so that hit tables only hold a sequence ID.
+
+The same target sequence (tseq) is repeated in every hit of that target, across
+queries and databases. The annotated dataset keeps a tseq_id column instead (a
+64 bit hash of the uppercase sequence) and every distinct sequence is stored
+once under the dataset directory:
+
+    foldseek_annotated/_sequences/sequences.bin   5 bit codes, 8 residues per 5 bytes
+    foldseek_annotated/_sequences/index.npz       sorted IDs, byte offsets and lengths
+
+New sequences are appended to sequences.bin before the index is replaced, so an
+interrupted run only leaves unreferenced bytes. Sequences are read back by ID in
+batches from a memory map of sequences.bin (resolve_sequences adds them to a
+DataFrame only when a reader needs them). Adding a sequence whose ID is already
+taken compares it with the stored one, so a hash collision raises ValueError
+instead of resolving hits to the wrong sequence.
+
+Only tseq is stored this way. The other long per-hit columns (Qaln, Taln and the
+tca CA coordinates) differ between hits of the same target and stay in the hit
+tables.
+"""
+import os
+import pathlib
+import re
+
+import numpy as np
+import pandas as pd
+
+
+def get_alphabet():
+    """
+    Amino acid letters by 5 bit code (code 0 is padding, letters not in the alphabet are stored as X).
+    """
+    return '-ACDEFGHIKLMNPQRSTVWYBZXUOJ*'
+
+
+def get_sequence_store_dir(dataset_dir=None):
+    """
+    Default location of the sequence store (inside the annotated dataset, ignored by its readers).
+    """
+    if dataset_dir is None:
+        from annotated_store import get_dataset_dir
+        dataset_dir = get_dataset_dir()
+    return pathlib.Path(dataset_dir) / '_sequences'
+
+
+def get_sequence_ids(seqs):
+    """
+    Sequence IDs (UInt64, missing for missing or empty sequences).
+    """
+    seqs = pd.Series(seqs, dtype=object).fillna('').astype(str).str.upper()
+    ids = pd.Series(pd.util.hash_pandas_object(seqs, index=False).to_numpy(), dtype='UInt64')
+    return ids.where(seqs.str.len().to_numpy() > 0).array
+
+
+def canonical_sequences(seqs):
+    """
+    Sequences as they are read back from the store (letters not in the alphabet become X).
+    """
+    pattern = '[^' + ''.join(re.escape(letter) for letter in get_alphabet()) + ']'
+    return pd.Series(seqs, dtype=object).str.replace(pattern, 'X', regex=True)
+
+
+def encode(seqs):
+    """
+    Pack sequences into 5 bit codes, every sequence starts at a 5 byte group.
+
+    Returns the packed bytes and the number of groups of every sequence.
+    """
+    seqs = list(seqs)
+    lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+    table = np.full(256, get_alphabet().index('X'), dtype=np.uint64)
+    for code, letter in enumerate(get_alphabet()):
+        table[ord(letter)] = code
+    letters = np.frombuffer(''.join(seqs).encode('ascii', 'replace'), dtype=np.uint8)
+
+    # codes of every sequence padded with 0 to a multiple of 8 residues
+    groups = -(-lengths // 8)
+    padded = np.zeros(groups.sum() * 8, dtype=np.uint64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    padded_starts = np.concatenate([[0], np.cumsum(groups * 8)[:-1]])
+    positions = np.repeat(padded_starts - starts, lengths) + np.arange(lengths.sum())
+    padded[positions] = table[letters]
+
+    # 8 codes -> one 40 bit integer -> 5 bytes (big endian)
+    values = (padded.reshape(-1, 8) << (5 * np.arange(7, -1, -1, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+    packed = values.astype('>u8').view(np.uint8).reshape(-1, 8)[:, 3:]
+    return packed.tobytes(), groups
+
+
+def decode(packed, groups, lengths):
+    """
+    Sequences from packed 5 byte groups (groups and lengths per sequence).
+    """
+    blocks = np.zeros((len(packed) // 5, 8), dtype=np.uint8)
+    blocks[:, 3:] = np.frombuffer(packed, dtype=np.uint8).reshape(-1, 5)
+    values = blocks.view('>u8').ravel().astype(np.uint64)
+    codes = (values[:, None] >> (5 * np.arange(7, -1, -1, dtype=np.uint64))) & np.uint64(31)
+    alphabet = np.frombuffer(get_alphabet().encode('ascii'), dtype=np.uint8)
+    text = alphabet[codes.ravel()].tobytes().decode('ascii')
+    starts = np.concatenate([[0], np.cumsum(np.asarray(groups) * 8)[:-1]])
+    return [text[start:start + length] for start, length in zip(starts.tolist(), np.asarray(lengths).tolist())]
+
+
+class SequenceStore:
+    """
+    Append-only store of sequences, random access by sequence ID.
+    """
+    def __init__(self, store_dir=None):
+        self.store_dir = pathlib.Path(store_dir or get_sequence_store_dir())
+        self.data_p = self.store_dir / 'sequences.bin'
+        self.index_p = self.store_dir / 'index.npz'
+        if self.index_p.exists():
+            index = np.load(self.index_p)
+            self.ids, self.offsets, self.lengths = index['ids'], index['offsets'], index['lengths']
+        else:
+            self.ids = np.zeros(0, dtype=np.uint64)
+            self.offsets = np.zeros(0, dtype=np.int64)
+            self.lengths = np.zeros(0, dtype=np.int64)
+        self.data = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, ids):
+        """
+        Positions of IDs in the index, -1 for IDs that are not stored.
+        """
+        ids = np.asarray(ids, dtype=np.uint64)
+        pos = np.searchsorted(self.ids, ids)
+        found = pos < len(self.ids)
+        found[found] = self.ids[pos[found]] == ids[found]
+        return np.where(found, pos, -1)
+
+    def add(self, seqs):
+        """
+        Store the sequences that are not stored yet, returns the IDs of all of them.
+
+        Raises ValueError if two different sequences have the same ID.
+        """
+        seqs = pd.Series(seqs, dtype=object).fillna('').astype(str).str.upper()
+        ids = get_sequence_ids(seqs)
+        has_id = ~pd.isna(ids)
+        unique_ids, first = np.unique(ids[has_id].to_numpy(dtype=np.uint64), return_index=True)
+        self.check_collisions(seqs[has_id], ids[has_id], unique_ids, first)
+        new = self.find(unique_ids) < 0
+        if not new.any():
+            return ids
+
+        new_seqs = seqs[has_id].to_numpy()[first[new]]
+        packed, groups = encode(new_seqs)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.data_p, 'ab') as f:
+            start = f.tell()
+            f.write(packed)
+        offsets = start + 5 * np.concatenate([[0], np.cumsum(groups)[:-1]])
+
+        all_ids = np.concatenate([self.ids, unique_ids[new]])
+        order = np.argsort(all_ids, kind='stable')
+        self.ids = all_ids[order]
+        self.offsets = np.concatenate([self.offsets, offsets])[order]
+        self.lengths = np.concatenate([self.lengths, np.fromiter((len(s) for s in new_seqs), dtype=np.int64)])[order]
+        self.save_index()
+        self.data = None
+        return ids
+
+    def check_collisions(self, seqs, ids, unique_ids, first):
+        """
+        Raise ValueError if sequences of the same ID differ, within the batch or from the stored one.
+        """
+        seqs = canonical_sequences(seqs.to_numpy())
+        per_id = seqs.groupby(ids.to_numpy(dtype=np.uint64)).nunique()
+        if (per_id > 1).any():
+            raise ValueError(f"Sequence ID collision within a batch for IDs {per_id.index[per_id > 1].tolist()[:5]}")
+        stored = self.find(unique_ids) >= 0
+        if stored.any():
+            differ = self.get(unique_ids[stored]) != seqs.to_numpy()[first[stored]]
+            if differ.any():
+                raise ValueError(f"Sequence ID collision with the store for IDs {unique_ids[stored][differ].tolist()[:5]}")
+
+    def save_index(self):
+        """
+        Atomically replace the index.
+        """
+        tmp_p = self.index_p.with_name('_index.tmp.npz')
+        np.savez(tmp_p, ids=self.ids, offsets=self.offsets, lengths=self.lengths)
+        os.replace(tmp_p, self.index_p)
+
+    def get(self, ids):
+        """
+        Sequences of a batch of IDs (None for missing or unknown IDs).
+        """
+        ids = pd.array(ids, dtype='UInt64')
+        pos = np.full(len(ids), -1, dtype=np.int64)
+        has_id = ~pd.isna(ids)
+        pos[has_id] = self.find(ids[has_id].to_numpy(dtype=np.uint64))
+        found = np.flatnonzero(pos >= 0)
+        seqs = np.full(len(ids), None, dtype=object)
+        if len(found) == 0:
+            return seqs
+        if self.data is None:
+            self.data = np.memmap(self.data_p, dtype=np.uint8, mode='r')
+
+        # each distinct sequence is read once, in file order
+        unique_pos, inverse = np.unique(pos[found], return_inverse=True)
+        lengths = self.lengths[unique_pos]
+        groups = -(-lengths // 8)
+        n_bytes = 5 * groups
+        starts = self.offsets[unique_pos]
+        index = np.repeat(starts - np.concatenate([[0], np.cumsum(n_bytes)[:-1]]), n_bytes) + np.arange(n_bytes.sum())
+        decoded = decode(self.data[index].tobytes(), groups, lengths)
+        seqs[found] = np.array(decoded, dtype=object)[inverse.ravel()]
+        return seqs
+
+
+def store_sequences(df, store, column='tseq', id_column='tseq_id'):
+    """
+    Move the sequences of a hit table into the store, replacing the column by the sequence IDs.
+    """
+    if column not in df.columns:
+        return df
+    ids = store.add(df[column].values)
+    position = df.columns.get_loc(column)
+    df = df.drop(columns=column)
+    df.insert(position, id_column, ids)
+    return df
+
+
+def resolve_sequences(df, store, id_column='tseq_id', column='tseq', batch_size=100_000):
+    """
+    Add the sequences of the IDs in a hit table, read from the store in batches.
+    """
+    ids = pd.array(df[id_column].values, dtype='UInt64')
+    seqs = [store.get(ids[start:start + batch_size]) for start in range(0, len(ids), batch_size)]
+    df = df.copy()
+    df[column] = np.concatenate(seqs) if seqs else np.zeros(0, dtype=object)
+    return df
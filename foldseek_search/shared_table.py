@@ -0,0 +1,132 @@
+""" Hit tables shared between processes as memory-mapped Arrow IPC (Feather v2) files.
+
+A table is written once, uncompressed, to .shared_tables/<name>-<key>.arrow where
+the key is a hash of its content (or of the dataset manifest it was built from),
+so it is only rewritten when the hits change. Worker processes map the file
+read-only instead of receiving a pickled copy of the data: the pages are shared
+through the page cache, so the table is loaded once per node however many
+workers read it, and every process opens the mapping once (open_table is cached).
+Readers select column slices of the mapped table; numeric columns without
+missing values are converted to pandas without copying.
+"""
+import functools
+import hashlib
+import os
+import pathlib
+import shutil
+from collections import namedtuple
+
+import pandas as pd
+import pyarrow as pa
+
+
+# path: Arrow IPC file, columns: columns read from it (None for all)
+SharedTable = namedtuple('SharedTable', ['path', 'columns'])
+
+
+def get_shared_dir():
+    """
+    Default location of the shared tables.
+    """
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    return script_dir / '.shared_tables'
+
+
+def get_shared_path(name, key, shared_dir=None):
+    """
+    Arrow IPC file of a table version.
+    """
+    return pathlib.Path(shared_dir or get_shared_dir()) / f'{name}-{key[:16]}.arrow'
+
+
+def hash_frame(df):
+    """
+    Content hash of a DataFrame (column names, dtypes and values).
+    """
+    h = hashlib.sha256()
+    h.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def write_shared(path, batches, schema):
+    """
+    Write record batches as an uncompressed Arrow IPC file and drop older versions of the table.
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_p = path.with_suffix(f'.arrow.{os.getpid()}.tmp')
+    with pa.OSFile(str(tmp_p), 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    os.replace(tmp_p, path)
+    # processes still mapping an old version keep reading it until they close it
+    name = path.name.rsplit('-', 1)[0]
+    for old_p in path.parent.glob(f'{name}-*.arrow'):
+        if old_p != path:
+            old_p.unlink(missing_ok=True)
+            # indexes built over the old version (query_service.py)
+            shutil.rmtree(old_p.with_suffix('.index'), ignore_errors=True)
+
+
+def share_table(df, name='hits', shared_dir=None):
+    """
+    Make a DataFrame available to other processes, returns its SharedTable.
+    """
+    path = get_shared_path(name, hash_frame(df), shared_dir)
+    if not path.exists():
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        write_shared(path, table.to_batches(), table.schema)
+    return SharedTable(path, None)
+
+
+def share_dataset(dataset_dir, name='foldseek_annotated', batch_size=100_000, shared_dir=None):
+    """
+    Make the annotated Parquet dataset available to other processes, returns its SharedTable.
+
+    The table is keyed on the dataset manifest, it is rebuilt when a partition changes.
+    """
+    import pyarrow.dataset as ds
+    dataset_dir = pathlib.Path(dataset_dir)
+    key = hashlib.sha256((dataset_dir / '_manifest.json').read_bytes()).hexdigest()
+    path = get_shared_path(name, key, shared_dir)
+    if not path.exists():
+        dataset = ds.dataset(str(dataset_dir), format='parquet', exclude_invalid_files=True)
+        write_shared(path, dataset.to_batches(batch_size=batch_size), dataset.schema)
+    return SharedTable(path, None)
+
+
+@functools.lru_cache(maxsize=8)
+def open_table(path):
+    """
+    Memory-map an Arrow IPC file read-only, once per process.
+    """
+    source = pa.memory_map(str(path), 'r')
+    return pa.ipc.open_file(source).read_all()
+
+
+def get_table(shared, columns=None):
+    """
+    Arrow table of the (selected) columns of a shared table, backed by the mapping.
+    """
+    table = open_table(str(shared.path))
+    columns = columns if columns is not None else shared.columns
+    if columns is not None:
+        table = table.select(list(dict.fromkeys(columns)))
+    return table
+
+
+def read_shared(shared, columns=None):
+    """
+    DataFrame of the (selected) columns of a shared table.
+    """
+    return get_table(shared, columns).to_pandas(split_blocks=True)
+
+
+def iter_shared_chunks(shared, columns=None, chunksize=100_000):
+    """
+    Stream a shared table in chunks of rows (zero-copy slices of the mapping).
+    """
+    table = get_table(shared, columns)
+    for start in range(0, table.num_rows, chunksize):
+        yield table.slice(start, chunksize).to_pandas(split_blocks=True)
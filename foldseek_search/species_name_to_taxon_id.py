@@ -1,4 +1,4 @@
-import requests
+from http_client import get_client
 
 def get_taxon_id_uniprot(species_name : str) -> int:
     """
@@ -9,7 +9,7 @@ def get_taxon_id_uniprot(species_name : str) -> int:
         "query": species_name,
         "format": "json"
     }
-    response = requests.get(url, params=params)
+    response = get_client().get('uniprot', url, params=params)
     if response.status_code == 200:
         data = response.json()
         if "results" in data and len(data["results"]) > 0:
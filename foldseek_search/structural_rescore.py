@@ -0,0 +1,238 @@
+""" Structural re-scoring of foldseek hits from the CA coordinates of query and target.
+
+Foldseek reports the CA trace of every target (tca, x,y,z per residue) and the
+alignment (Qaln / Taln from Query start / Target start). The aligned residue pairs
+are taken from the alignment strings, the CA atoms of the query peptides from
+peptide_structures.zip, and each hit is superposed with the Kabsch algorithm.
+
+Everything is vectorized over a chunk of hits: the alignment strings are
+handled as one byte array, hits are grouped by their number of aligned pairs
+(padded to a multiple of `pad` with zero weights) and every group is superposed
+with one batched SVD. Scores:
+    RMSD      of the aligned CA atoms after the optimal (least squares) superposition
+    TM-score  normalized by the query length, from the best of a few superpositions
+              weighted towards the well aligned pairs (an approximation of TM-align,
+              which searches the superposition maximizing the TM-score itself)
+"""
+import functools
+import pathlib
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+
+def read_ca_coordinates(pdb_text):
+    """
+    CA coordinates (L, 3) of the first model of a PDB file, one per residue (first altloc).
+    """
+    coords = []
+    seen = set()
+    for line in pdb_text.splitlines():
+        if line.startswith('ENDMDL'):
+            break
+        if not line.startswith(('ATOM', 'HETATM')) or line[12:16].strip() != 'CA':
+            continue
+        # chain, residue number and insertion code
+        residue = (line[21], line[22:27])
+        if residue in seen:
+            continue
+        seen.add(residue)
+        coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return np.array(coords, dtype=float).reshape(-1, 3)
+
+
+@functools.lru_cache(maxsize=2)
+def load_query_coordinates(zip_p=None):
+    """
+    CA coordinates of the query peptides by query name (the PDB filename without suffix).
+    """
+    if zip_p is None:
+        zip_p = pathlib.Path(__file__).parent.absolute() / 'peptide_structures.zip'
+    coords = {}
+    with zipfile.ZipFile(zip_p) as z:
+        for name in z.namelist():
+            if name.endswith('.pdb'):
+                coords[pathlib.PurePath(name).stem] = read_ca_coordinates(z.read(name).decode())
+    return coords
+
+
+def parse_ca_windows(tca, first, last):
+    """
+    Target CA coordinates of residues first..last (0-based) of every hit, without parsing the rest of tca.
+
+    Returns the concatenated window coordinates (N, 3), the offset of every window,
+    the first residue of every window and the number of residues of every target.
+    """
+    tca = pd.Series(tca).fillna('').astype(str)
+    has_trace = (tca.str.len() > 0).to_numpy()
+    lengths = np.zeros(len(tca), dtype=np.int64)
+    window_off = np.zeros(len(tca), dtype=np.int64)
+    if not has_trace.any():
+        return np.zeros((0, 3)), window_off, np.asarray(first), lengths
+
+    # every value of the joined traces is followed by a comma
+    buffer = np.frombuffer((','.join(tca[has_trace]) + ',').encode('ascii'), dtype=np.uint8)
+    commas = np.flatnonzero(buffer == ord(','))
+    ends = np.cumsum(tca[has_trace].str.len().to_numpy() + 1) - 1
+    value_end = np.searchsorted(commas, ends) + 1
+    values = np.diff(np.concatenate([[0], value_end]))
+    lengths[has_trace] = values // 3
+    value_start = np.zeros(len(tca), dtype=np.int64)
+    value_start[has_trace] = value_end - values
+
+    # windows of residues, as ranges of characters in the buffer
+    first = np.clip(np.asarray(first, dtype=np.int64), 0, None)
+    last = np.minimum(np.asarray(last, dtype=np.int64), lengths - 1)
+    size = np.where(has_trace, np.maximum(last - first + 1, 0), 0)
+    v_first = value_start + 3 * first
+    v_last = v_first + 3 * size - 1
+    window = np.flatnonzero(size > 0)
+    char_start = np.where(v_first[window] > 0, commas[np.maximum(v_first[window] - 1, 0)] + 1, 0)
+    char_end = commas[v_last[window]]
+    n_chars = char_end - char_start + 1
+    chars = np.repeat(char_start - np.concatenate([[0], np.cumsum(n_chars)[:-1]]), n_chars) + np.arange(n_chars.sum())
+    text = buffer[chars][:-1].tobytes().decode('ascii')
+    coords = np.fromstring(text, sep=',').reshape(-1, 3) if text else np.zeros((0, 3))
+    window_off[window] = np.concatenate([[0], np.cumsum(size[window])[:-1]])
+    return coords, window_off, first, lengths
+
+
+def aligned_pairs(qaln, taln, qstart, tstart):
+    """
+    Residue pairs of the alignments as (hit, query index, target index) arrays (0-based).
+
+    Hits with alignment strings of different lengths give no pairs.
+    """
+    qaln = pd.Series(qaln).fillna('').astype(str)
+    taln = pd.Series(taln).fillna('').astype(str)
+    lengths = qaln.str.len().to_numpy().copy()
+    lengths[lengths != taln.str.len().to_numpy()] = 0
+    hits = np.repeat(np.arange(len(qaln)), lengths)
+    valid = lengths > 0
+    q = np.frombuffer(''.join(qaln[valid]).encode('ascii', 'replace'), dtype=np.uint8)
+    t = np.frombuffer(''.join(taln[valid]).encode('ascii', 'replace'), dtype=np.uint8)
+
+    gap = ord('-')
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    q_count = np.cumsum(q != gap)
+    t_count = np.cumsum(t != gap)
+    # residues seen before the first column of every hit
+    q_before = np.where(starts > 0, q_count[np.maximum(starts - 1, 0)] if len(q) else 0, 0)
+    t_before = np.where(starts > 0, t_count[np.maximum(starts - 1, 0)] if len(t) else 0, 0)
+    q_index = np.asarray(qstart, dtype=np.int64)[hits] - 1 + q_count - q_before[hits] - 1
+    t_index = np.asarray(tstart, dtype=np.int64)[hits] - 1 + t_count - t_before[hits] - 1
+
+    both = (q != gap) & (t != gap)
+    return hits[both], q_index[both], t_index[both]
+
+
+def superpose(P, Q, w):
+    """
+    Distances (B, L) of the pairs after the weighted least squares superposition of P onto Q (B, L, 3).
+    """
+    w3 = w[..., None]
+    total = w3.sum(axis=1, keepdims=True)
+    P0 = P - (w3 * P).sum(axis=1, keepdims=True) / total
+    Q0 = Q - (w3 * Q).sum(axis=1, keepdims=True) / total
+    H = np.einsum('bli,blj->bij', w3 * P0, Q0)
+    U, _, Vt = np.linalg.svd(H)
+    # no reflections
+    d = np.sign(np.linalg.det(U @ Vt))
+    d[d == 0] = 1
+    U[:, :, 2] *= d[:, None]
+    R = U @ Vt
+    return np.sqrt(((P0 @ R - Q0) ** 2).sum(axis=-1))
+
+
+def get_d0(length):
+    """
+    TM-score distance scale for a normalization length (as in TM-align, at least 0.5).
+    """
+    length = np.asarray(length, dtype=float)
+    return np.maximum(1.24 * np.cbrt(np.maximum(length - 15, 1)) - 1.8, 0.5)
+
+
+def score_batch(P, Q, mask, norm_length, iterations=3):
+    """
+    RMSD and TM-score of a batch of padded pair sets.
+    """
+    w = mask.astype(float)
+    n = w.sum(axis=1)
+    dist = superpose(P, Q, w)
+    rmsd = np.sqrt((w * dist ** 2).sum(axis=1) / n)
+
+    d0 = get_d0(norm_length)[:, None]
+    tm = (w / (1 + (dist / d0) ** 2)).sum(axis=1) / norm_length
+    for _ in range(iterations):
+        # superpose again with the weight of every pair in the TM-score
+        dist = superpose(P, Q, w / (1 + (dist / d0) ** 2))
+        tm = np.maximum(tm, (w / (1 + (dist / d0) ** 2)).sum(axis=1) / norm_length)
+    return rmsd, tm
+
+
+def rescore(df, query_coords=None, pad=8, min_pairs=3):
+    """
+    Aligned CA pairs, RMSD and TM-score of hits (index of df), NaN where not available.
+
+    Uses the parse column names (Qaln, Taln, Query start, Target start, tca).
+    """
+    if query_coords is None:
+        query_coords = load_query_coordinates()
+    n_hits = len(df)
+    scores = pd.DataFrame({'Aligned CA': np.zeros(n_hits, dtype=np.int64),
+                           'RMSD': np.nan, 'TM-score': np.nan}, index=df.index)
+    if n_hits == 0:
+        return scores
+
+    # query coordinates of all queries in the chunk, concatenated
+    queries, query_i = np.unique(df['Query'].astype(str).to_numpy(), return_inverse=True)
+    query_xyz = [query_coords.get(q, np.zeros((0, 3))) for q in queries]
+    query_len = np.array([len(c) for c in query_xyz])
+    query_off = np.concatenate([[0], np.cumsum(query_len)[:-1]])
+    query_xyz = np.concatenate(query_xyz) if query_len.sum() > 0 else np.zeros((0, 3))
+
+    hits, q_index, t_index = aligned_pairs(df['Qaln'].to_numpy(), df['Taln'].to_numpy(),
+                                           df['Query start'].to_numpy(), df['Target start'].to_numpy())
+    t_first = np.full(n_hits, np.iinfo(np.int64).max)
+    t_last = np.full(n_hits, -1)
+    np.minimum.at(t_first, hits, t_index)
+    np.maximum.at(t_last, hits, t_index)
+    # only the aligned part of each target trace is parsed
+    target_xyz, target_off, target_first, target_len = parse_ca_windows(df['tca'].to_numpy(),
+                                                                        np.minimum(t_first, t_last), t_last)
+    # drop pairs outside the structures (missing query structure, inconsistent records)
+    inside = (q_index >= 0) & (q_index < query_len[query_i][hits]) & (t_index >= 0) & (t_index < target_len[hits])
+    hits, q_index, t_index = hits[inside], q_index[inside], t_index[inside]
+    P = query_xyz[query_off[query_i][hits] + q_index]
+    Q = target_xyz[target_off[hits] + t_index - target_first[hits]]
+
+    pairs = np.bincount(hits, minlength=n_hits)
+    first = np.concatenate([[0], np.cumsum(pairs)[:-1]])
+    rmsd = np.full(n_hits, np.nan)
+    tm = np.full(n_hits, np.nan)
+    scored = np.flatnonzero(pairs >= min_pairs)
+    padded = -(-pairs // pad) * pad
+    for length in np.unique(padded[scored]):
+        group = scored[padded[scored] == length]
+        position = np.arange(length)
+        mask = position[None, :] < pairs[group][:, None]
+        rows = np.where(mask, first[group][:, None] + position[None, :], 0)
+        rmsd[group], tm[group] = score_batch(P[rows], Q[rows], mask, query_len[query_i][group])
+
+    scores['Aligned CA'] = pairs
+    scores['RMSD'] = rmsd
+    scores['TM-score'] = tm
+    return scores
+
+
+def add_structure_scores(df, query_coords=None, chunksize=50_000):
+    """
+    Add the Aligned CA, RMSD and TM-score columns, in chunks to bound the memory of the coordinates.
+    """
+    parts = [rescore(df.iloc[start:start + chunksize], query_coords)
+             for start in range(0, len(df), chunksize)]
+    scores = pd.concat(parts) if parts else rescore(df, query_coords)
+    for column in scores.columns:
+        df[column] = scores[column].values
+    return df
@@ -0,0 +1,220 @@
+""" Summary of the annotated foldseek hits per Query, Database and Kingdom, for instant lookups.
+
+The annotation stage keeps a small table next to the partitions of the annotated
+dataset (foldseek_annotated/_summary.parquet, ignored by the dataset readers)
+with one row per Query x Database x Kingdom of the hits of a result file
+(a deduplicated hit counts for every database it was found in):
+    Hits, Best E-value, Median E-value, Max pident, Max Prob. and the number of
+    hits of known gut microbes (GMrepo, MGnify)
+The rows of a result file are replaced whenever its partition is written, so the
+summary is updated incrementally together with the dataset. Questions like
+"how many bacterial hits did Galanin get in CATH50 and what was the best E-value"
+are answered from the summary without reading the hits.
+
+Usage:
+    python summary_index.py Galanin --database cath50 --kingdom Bacteria
+    python summary_index.py --database afdb50              # all queries
+    python summary_index.py --check                        # test the lookups
+"""
+import argparse
+import os
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from deduplicate import get_database_name, expand_source_databases
+from hormones import get_query_hormone, normalize_hormone
+
+
+def get_summary_columns():
+    """
+    Columns of the summary, after the Source (manifest key), Query, Database and Kingdom keys.
+    """
+    return ['Hits', 'Best E-value', 'Median E-value', 'Max pident', 'Max Prob.',
+            'Known gut microbes (GMrepo)', 'Known gut microbes (MGnify)']
+
+
+def get_summary_path(dataset_dir):
+    """
+    Summary file of an annotated dataset.
+    """
+    return pathlib.Path(dataset_dir) / '_summary.parquet'
+
+
+def summarize_partition(source_key, df):
+    """
+    Summary rows of the annotated hits of a single result file (annotation column names).
+
+    Hits without a kingdom are summarized under 'unclassified'. The partition holds
+    deduplicated hits, so every hit is counted for each database it was found in
+    (Source databases), with the scores of the representative copy.
+    """
+    keys = ['Source', 'Query', 'Database', 'Kingdom']
+    if len(df) == 0:
+        return pd.DataFrame(columns=keys + get_summary_columns())
+    df = expand_source_databases(df)
+    kingdom = df['kingdom'] if 'kingdom' in df.columns else pd.Series(np.nan, index=df.index)
+    hits = pd.DataFrame({
+        'Query': df['Query'].values,
+        'Database': get_database_name(df['Filename'].values).values,
+        'Kingdom': kingdom.fillna('unclassified').astype(str).values,
+        'E-value': pd.to_numeric(df['E-value'], errors='coerce').values,
+        'pident': pd.to_numeric(df['pident'], errors='coerce').values,
+        'Prob.': pd.to_numeric(df['Probability'], errors='coerce').values,
+    })
+    for column, name in [('KnownGutMicrobe(GMrepo)', 'GMrepo'), ('KnownGutMicrobe(MGnify)', 'MGnify')]:
+        known = df[column] if column in df.columns else pd.Series(False, index=df.index)
+        hits[name] = (known == True).values
+
+    grouped = hits.groupby(['Query', 'Database', 'Kingdom'], sort=True)
+    summary = grouped.agg(**{
+        'Hits': ('E-value', 'size'),
+        'Best E-value': ('E-value', 'min'),
+        'Median E-value': ('E-value', 'median'),
+        'Max pident': ('pident', 'max'),
+        'Max Prob.': ('Prob.', 'max'),
+        'Known gut microbes (GMrepo)': ('GMrepo', 'sum'),
+        'Known gut microbes (MGnify)': ('MGnify', 'sum'),
+    }).reset_index()
+    summary.insert(0, 'Source', source_key)
+    return summary
+
+
+def read_summary(dataset_dir):
+    """
+    Load the summary of a dataset, None if it has none.
+    """
+    summary_p = get_summary_path(dataset_dir)
+    if not summary_p.exists():
+        return None
+    return pd.read_parquet(summary_p)
+
+
+def update_summary(dataset_dir, parts, removed=()):
+    """
+    Replace the summary rows of the written result files (source key -> annotated rows)
+    and drop those of removed ones. The summary is replaced atomically.
+    """
+    summary = read_summary(dataset_dir)
+    stale = set(parts) | set(removed)
+    frames = [] if summary is None else [summary[~summary['Source'].isin(stale)]]
+    frames.extend(summarize_partition(key, df) for key, df in parts.items())
+    frames = [frame for frame in frames if len(frame) > 0]
+    if frames:
+        summary = pd.concat(frames, ignore_index=True)
+    else:
+        summary = summarize_partition('', pd.DataFrame())
+    summary = summary.astype({'Hits': 'int64', 'Known gut microbes (GMrepo)': 'int64',
+                              'Known gut microbes (MGnify)': 'int64'})
+    summary = summary.sort_values(['Query', 'Database', 'Kingdom'], kind='stable', ignore_index=True)
+
+    summary_p = get_summary_path(dataset_dir)
+    tmp_p = summary_p.with_name(f'{summary_p.name}.tmp')
+    summary.to_parquet(tmp_p, index=False)
+    os.replace(tmp_p, summary_p)
+    return summary
+
+
+class SummaryIndex:
+    """
+    Lookups in the summary of an annotated dataset.
+
+    Keys are matched case-insensitively, a key left out (None) matches all values.
+    A query matches its structure name ('galanin_7WQ3') or its hormone, the name
+    without PDB ID and 'Human' ('Galanin' matches galanin_7WQ3 and Galanin__Human_7XJK).
+    """
+    def __init__(self, summary):
+        self.summary = summary.reset_index(drop=True)
+        self.keys = {column: summary[column].astype(str).str.lower().to_numpy()
+                     for column in ['Query', 'Database', 'Kingdom']}
+        self.hormones = get_query_hormone(summary['Query'].astype(str)).to_numpy()
+
+    @classmethod
+    def load(cls, dataset_dir):
+        """
+        Index of the summary of a dataset (an empty one if it has no summary yet).
+        """
+        summary = read_summary(dataset_dir)
+        return cls(summary if summary is not None else summarize_partition('', pd.DataFrame()))
+
+    def rows(self, query=None, database=None, kingdom=None):
+        """
+        Summary rows of the matching Query x Database x Kingdom combinations.
+        """
+        mask = np.ones(len(self.summary), dtype=bool)
+        if query is not None:
+            mask &= (self.keys['Query'] == str(query).lower()) | (self.hormones == normalize_hormone([query])[0])
+        for column, value in [('Database', database), ('Kingdom', kingdom)]:
+            if value is not None:
+                mask &= self.keys[column] == str(value).lower()
+        return self.summary[mask]
+
+    def lookup(self, query=None, database=None, kingdom=None):
+        """
+        Totals over the matching rows as a dict.
+
+        The median E-value is only defined for a single Query x Database x Kingdom
+        (medians of parts do not combine), it is NaN otherwise.
+        """
+        rows = self.rows(query, database, kingdom)
+        return {
+            'Hits': int(rows['Hits'].sum()),
+            'Best E-value': float(rows['Best E-value'].min()) if len(rows) else np.nan,
+            'Median E-value': float(rows['Median E-value'].iloc[0]) if len(rows) == 1 else np.nan,
+            'Max pident': float(rows['Max pident'].max()) if len(rows) else np.nan,
+            'Max Prob.': float(rows['Max Prob.'].max()) if len(rows) else np.nan,
+            'Known gut microbes (GMrepo)': int(rows['Known gut microbes (GMrepo)'].sum()),
+            'Known gut microbes (MGnify)': int(rows['Known gut microbes (MGnify)'].sum()),
+        }
+
+
+def check_summary_index():
+    """
+    Test the lookups of the usage example on a summary of structure-named queries.
+    """
+    hits = pd.DataFrame({
+        'Query': ['galanin_7WQ3', 'galanin_7WQ3', 'Galanin__Human_7XJK', 'Galanin__Human_7XJK', 'GALP_7XJL'],
+        'Filename': ['alis_cath50.m8', 'alis_afdb50.m8', 'alis_cath50.m8', 'alis_cath50.m8', 'alis_cath50.m8'],
+        'kingdom': ['Bacteria', 'Bacteria', 'Bacteria', 'Metazoa', 'Bacteria'],
+        'E-value': [1e-3, 1e-4, 1e-5, 1e-6, 1e-7],
+        'pident': [30.0, 40.0, 50.0, 60.0, 70.0],
+        'Probability': [0.5, 0.6, 0.7, 0.8, 0.9],
+    })
+    index = SummaryIndex(summarize_partition('check', hits))
+    rows = index.rows('Galanin', 'cath50', 'Bacteria')
+    assert sorted(rows['Query']) == ['Galanin__Human_7XJK', 'galanin_7WQ3'], 'hormone lookup error'
+    assert index.lookup('Galanin', 'cath50', 'Bacteria')['Best E-value'] == 1e-5, 'hormone totals error'
+    assert len(index.rows('galanin_7WQ3', 'cath50', 'Bacteria')) == 1, 'structure name lookup error'
+    assert len(index.rows('GALP', 'cath50')) == 1, 'GALP lookup error'
+    deduplicated = hits.assign(**{'Source databases': ['afdb50;cath50', 'afdb50', 'cath50', 'cath50', 'cath50']})
+    index = SummaryIndex(summarize_partition('check', deduplicated))
+    assert index.lookup('galanin_7WQ3', 'afdb50')['Hits'] == 2, 'source databases error'
+    print("All tests passed for check_summary_index")
+
+
+def main():
+    from annotated_store import get_dataset_dir
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('query', nargs='?', default=None, help="hormone (e.g. Galanin) or query structure name")
+    parser.add_argument('--database', default=None, help="database name, e.g. afdb50 or cath50")
+    parser.add_argument('--kingdom', default=None, help="e.g. Bacteria")
+    parser.add_argument('--dataset-dir', type=pathlib.Path, default=None)
+    parser.add_argument('--check', action='store_true', help="test the lookups on a synthetic summary")
+    args = parser.parse_args()
+
+    if args.check:
+        check_summary_index()
+        return
+
+    index = SummaryIndex.load(args.dataset_dir or get_dataset_dir())
+    rows = index.rows(args.query, args.database, args.kingdom)
+    with pd.option_context('display.max_rows', 200, 'display.width', 200):
+        print(rows.drop(columns='Source').to_string(index=False))
+    print()
+    for name, value in index.lookup(args.query, args.database, args.kingdom).items():
+        print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,24 @@
+import io
+
 from Bio import Entrez
 
+from http_client import get_client
+
+
+def efetch_taxonomy(ids_str : str, email : str):
+    """
+    Fetch and parse NCBI taxonomy records (Entrez efetch through the shared HTTP client).
+    """
+    url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+    params = {"db": "taxonomy", "id": ids_str, "retmode": "xml", "tool": "biopython", "email": email}
+    response = get_client().post('entrez', url, data=params)
+    response.raise_for_status()
+    return Entrez.read(io.BytesIO(response.content))
+
 def get_taxon_lineage_batch(taxon_ids : list, email : str):
     """
     Retrieve the taxonomic lineage for a batch of taxon IDs using Entrez.
     """
-    Entrez.email = email
     lineages = {}
 
     # Convert the list of IDs into a comma-separated string
@@ -12,9 +26,7 @@ def get_taxon_lineage_batch(taxon_ids : list, email : str):
 
     try:
         # Fetch taxonomy data for all IDs in one request
-        handle = Entrez.efetch(db="taxonomy", id=ids_str, retmode="xml")
-        records = Entrez.read(handle)
-        handle.close()
+        records = efetch_taxonomy(ids_str, email)
 
         # Extract lineage for each ID
         for r_i, record in enumerate(records):
@@ -28,9 +40,7 @@ def get_taxon_lineage_batch(taxon_ids : list, email : str):
         print(f"Error retrieving Taxon IDs: {e}")
         for taxon_id in taxon_ids:
             try:
-                handle = Entrez.efetch(db="taxonomy", id=taxon_id, retmode="xml")
-                record = Entrez.read(handle)
-                handle.close()
+                record = efetch_taxonomy(str(taxon_id), email)
                 lineage = record[0]['Lineage']
                 lineages[taxon_id] = lineage
             except Exception as e:
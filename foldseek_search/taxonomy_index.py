@@ -0,0 +1,270 @@
+""" Ancestor index over the NCBI taxonomy for clade membership tests.
+
+Every taxon gets the interval [tin, tout] of its subtree in a depth-first
+(Euler tour) order of the tree, so "is X a descendant of Y" is
+tin[Y] <= tin[X] <= tout[Y]. For a reference set S the (nested or disjoint)
+intervals of S are merged and sorted once; a whole column of taxids is then
+tested with a single vectorized binary search, O(log |S|) per hit.
+
+The tree is read from the NCBI taxdump (nodes.dmp, optionally merged.dmp for
+renamed taxids), available at https://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz
+"""
+import functools
+import pathlib
+import tarfile
+
+import numpy as np
+import pandas as pd
+
+
+def get_taxdump_dir():
+    """
+    Default location of the extracted NCBI taxdump.
+    """
+    script_dir = pathlib.Path(__file__).parent.absolute()
+    return script_dir / 'taxdump'
+
+
+def download_taxdump(taxdump_dir=None, url='https://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz'):
+    """
+    Download and extract the NCBI taxdump (nodes.dmp, names.dmp, merged.dmp).
+    """
+    taxdump_dir = pathlib.Path(taxdump_dir or get_taxdump_dir())
+    taxdump_dir.mkdir(parents=True, exist_ok=True)
+    archive_p = taxdump_dir / 'taxdump.tar.gz'
+    from http_client import get_client
+    get_client().download('taxdump', url, archive_p)
+    with tarfile.open(archive_p) as tar:
+        tar.extractall(taxdump_dir, members=[m for m in tar.getmembers()
+                                             if m.name in ('nodes.dmp', 'names.dmp', 'merged.dmp')])
+    archive_p.unlink()
+    return taxdump_dir
+
+
+def read_dmp(dmp_p, columns):
+    """
+    Read the first columns of a taxdump .dmp file ('\\t|\\t' separated) as lists of strings.
+    """
+    values = [[] for _ in range(columns)]
+    with open(dmp_p, 'r') as f:
+        for line in f:
+            parts = line.rstrip('\t|\n').split('\t|\t', columns)
+            for i in range(columns):
+                values[i].append(parts[i])
+    return values
+
+
+class TaxonomyIndex:
+    """
+    Parent pointers, ranks and Euler tour intervals of the taxonomy, indexed by taxid.
+    """
+    def __init__(self, taxids, parents, ranks=None, merged=None):
+        taxids = np.asarray(taxids, dtype=np.int64)
+        parents = np.asarray(parents, dtype=np.int64)
+        size = int(max(taxids.max(), parents.max())) + 1
+        if merged:
+            size = max(size, max(merged) + 1)
+
+        self.parent = np.full(size, -1, dtype=np.int64)
+        self.parent[taxids] = parents
+        self.known = np.zeros(size, dtype=bool)
+        self.known[taxids] = True
+        self.rank = None
+        if ranks is not None:
+            self.rank = np.full(size, '', dtype=object)
+            self.rank[taxids] = ranks
+
+        # renamed taxids point to their current id
+        self.current = np.arange(size, dtype=np.int64)
+        if merged:
+            old = np.fromiter(merged.keys(), dtype=np.int64)
+            new = np.fromiter(merged.values(), dtype=np.int64)
+            self.current[old] = new
+            self.known[old] = True
+
+        self.tin, self.tout = self.build_intervals(taxids, parents, size)
+
+    @staticmethod
+    def build_intervals(taxids, parents, size):
+        """
+        Euler tour entry / exit numbers (tout = largest tin inside the subtree).
+        """
+        # children of every node in CSR form (roots point to themselves)
+        is_child = taxids != parents
+        child = taxids[is_child]
+        parent = parents[is_child]
+        order = np.argsort(parent, kind='stable')
+        child, parent = child[order], parent[order]
+        start = np.searchsorted(parent, np.arange(size), side='left')
+        end = np.searchsorted(parent, np.arange(size), side='right')
+
+        tin = np.full(size, -1, dtype=np.int64)
+        tout = np.full(size, -1, dtype=np.int64)
+        counter = 0
+        roots = taxids[~is_child]
+        for root in roots.tolist():
+            # iterative DFS, a node is pushed as ~node when its subtree is done
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node < 0:
+                    tout[~node] = counter - 1
+                    continue
+                tin[node] = counter
+                counter += 1
+                stack.append(~node)
+                stack.extend(child[start[node]:end[node]].tolist())
+        return tin, tout
+
+    def to_current(self, taxids):
+        """
+        Taxids as int array with renamed ids replaced, -1 for missing or unknown ids.
+        """
+        taxids = to_float(taxids)
+        valid = np.isfinite(taxids) & (taxids >= 0) & (taxids < len(self.current))
+        out = np.full(len(taxids), -1, dtype=np.int64)
+        out[valid] = self.current[taxids[valid].astype(np.int64)]
+        out[out >= 0] = np.where(self.known[out[out >= 0]], out[out >= 0], -1)
+        return out
+
+    def reference_intervals(self, reference_taxids):
+        """
+        Sorted, merged subtree intervals of a reference set.
+        """
+        ref = self.to_current(list(reference_taxids))
+        ref = ref[(ref >= 0)]
+        ref = ref[self.tin[ref] >= 0]
+        starts = self.tin[ref]
+        ends = self.tout[ref]
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+        # subtree intervals are nested or disjoint, drop those inside an earlier one
+        if len(starts) > 0:
+            covered = np.concatenate([[-1], np.maximum.accumulate(ends)[:-1]])
+            keep = starts > covered
+            starts, ends = starts[keep], ends[keep]
+        return starts, ends
+
+    def is_descendant_of_any(self, taxids, reference_taxids=None, intervals=None):
+        """
+        For each taxid, whether it is in the subtree of any reference taxon (itself included).
+
+        Pass intervals from reference_intervals to reuse them for several columns.
+        """
+        starts, ends = intervals if intervals is not None else self.reference_intervals(reference_taxids)
+        ids = self.to_current(taxids)
+        q = np.where(ids >= 0, self.tin[np.maximum(ids, 0)], -1)
+        pos = np.searchsorted(starts, q, side='right') - 1
+        inside = (pos >= 0) & (q >= 0)
+        inside[inside] = q[inside] <= ends[pos[inside]]
+        return inside
+
+    def at_rank(self, taxids, rank):
+        """
+        For each taxid, its ancestor (or itself) of the given rank, -1 if there is none.
+
+        All taxids climb the tree together, one parent step per iteration.
+        """
+        node = self.to_current(taxids)
+        result = np.full(len(node), -1, dtype=np.int64)
+        if self.rank is None:
+            return result
+        active = np.flatnonzero(node >= 0)
+        while len(active) > 0:
+            current = node[active]
+            found = self.rank[current] == rank
+            result[active[found]] = current[found]
+            parent = self.parent[current]
+            # stop at the root (its own parent) and at broken parent links
+            keep = ~found & (parent != current) & (parent >= 0)
+            node[active[keep]] = parent[keep]
+            active = active[keep]
+        return result
+
+    def ancestors(self, taxid):
+        """
+        Path from a taxon to the root (taxon first).
+        """
+        path = []
+        node = int(self.current[taxid])
+        while node >= 0 and (not path or node != path[-1]):
+            path.append(node)
+            node = int(self.parent[node])
+        return path
+
+    def save(self, index_p):
+        """
+        Store the index arrays as npz.
+        """
+        np.savez(index_p, parent=self.parent, known=self.known, current=self.current,
+                 tin=self.tin, tout=self.tout,
+                 rank=self.rank.astype(str) if self.rank is not None else np.array([]))
+
+    @classmethod
+    def load(cls, index_p):
+        """
+        Load an index stored with save.
+        """
+        data = np.load(index_p)
+        index = cls.__new__(cls)
+        index.parent, index.known, index.current = data['parent'], data['known'], data['current']
+        index.tin, index.tout = data['tin'], data['tout']
+        index.rank = data['rank'].astype(object) if len(data['rank']) > 0 else None
+        return index
+
+
+def to_float(values):
+    """
+    Convert taxids (ints, floats, strings, nullable Int64 or None) to floats with NaN for missing values.
+    """
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+
+@functools.lru_cache(maxsize=4)
+def load_taxonomy_index(taxdump_dir=None):
+    """
+    Build (or load the cached) index from a taxdump directory. Returns None if there is no nodes.dmp.
+    """
+    taxdump_dir = pathlib.Path(taxdump_dir or get_taxdump_dir())
+    nodes_p = taxdump_dir / 'nodes.dmp'
+    if not nodes_p.exists():
+        return None
+    index_p = taxdump_dir / 'taxonomy_index.npz'
+    if index_p.exists() and index_p.stat().st_mtime >= nodes_p.stat().st_mtime:
+        return TaxonomyIndex.load(index_p)
+
+    taxids, parents, ranks = read_dmp(nodes_p, 3)
+    merged = None
+    merged_p = taxdump_dir / 'merged.dmp'
+    if merged_p.exists():
+        old, new = read_dmp(merged_p, 2)
+        merged = dict(zip(map(int, old), map(int, new)))
+    index = TaxonomyIndex(np.array(taxids, dtype=np.int64), np.array(parents, dtype=np.int64),
+                          ranks, merged)
+    index.save(index_p)
+    return index
+
+
+def load_taxon_names(taxdump_dir=None, taxids=None):
+    """
+    Scientific names from names.dmp, optionally only for some taxids.
+    """
+    taxdump_dir = pathlib.Path(taxdump_dir or get_taxdump_dir())
+    taxids = set(int(t) for t in taxids) if taxids is not None else None
+    names = {}
+    with open(taxdump_dir / 'names.dmp', 'r') as f:
+        for line in f:
+            if not line.endswith('scientific name\t|\n'):
+                continue
+            taxid, name = line.split('\t|\t', 2)[:2]
+            taxid = int(taxid)
+            if taxids is None or taxid in taxids:
+                names[taxid] = name
+    return names
+
+
+def read_taxon_list(list_p):
+    """
+    Read a file with one taxid per line.
+    """
+    return [int(t) for t in pathlib.Path(list_p).read_text().split()]
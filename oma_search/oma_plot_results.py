@@ -1,12 +1,16 @@
 import json
 import os
 import pathlib
+import sys
 import matplotlib.pyplot as plt
 import seaborn as sns
 import csv
 from Bio import SeqIO
 import random
 
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute() / "foldseek_search"))
+from plot_runner import plot_job, run_plots
+
 
 def load_data(file_path):
   """
@@ -189,8 +193,14 @@ def main():
 
   bacteria_data = load_data(bacteria_file)
 
-  create_bar_plot(bacteria_data, fasta_seq_file, plots_dir / "bacteria_target_counts.png")
-  create_scatter_plot(bacteria_data, fasta_seq_file, plots_dir / "alignment_score_vs_length.png")
+  jobs = [
+      plot_job(create_bar_plot, bacteria_data, fasta_seq_file, plots_dir / "bacteria_target_counts.png",
+               outputs=[plots_dir / "bacteria_target_counts.png"], columns=['query']),
+      plot_job(create_scatter_plot, bacteria_data, fasta_seq_file, plots_dir / "alignment_score_vs_length.png",
+               outputs=[plots_dir / "alignment_score_vs_length.png"],
+               columns=['query', 'identified_by', 'alignment', 'alignment_score']),
+  ]
+  run_plots(jobs)
   create_csv_report(bacteria_data, fasta_seq_file, plots_dir / "bacteria_targets_table.csv")
 
 
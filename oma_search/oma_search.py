@@ -1,8 +1,12 @@
-import requests
 import json
 from Bio import SeqIO
 import pandas as pd
 import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute() / "foldseek_search"))
+from http_client import get_client
+from instrumentation import get_report
 
 
 def oma_search(fasta_file):
@@ -25,9 +29,12 @@ def oma_search(fasta_file):
 
     all_results = {}  # Dictionary to store results for all sequences
 
+    report = get_report()
+    progress = report.progress('oma search', len(sequences))
     for seq in sequences:
         params["query"] = seq
-        response = requests.get(base_url, params=params)
+        response = get_client().get('oma', base_url, params=params)
+        progress.update()
 
         if response.status_code == 200:
             all_results[seq] = response.json()  # Store the JSON response
@@ -46,6 +53,7 @@ def main():
   full_dir = pathlib.Path(__file__).parent.absolute()
   fasta_file = full_dir / "ligand_sequences.fasta"
   oma_search(fasta_file)
+  get_report().write()
 
 if __name__ == "__main__":
   main()
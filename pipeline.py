@@ -0,0 +1,364 @@
+""" Run the Foldseek and OMA workflows as one pipeline with stage-level caching.
+
+Every stage declares the command it runs and the artifacts it reads and writes.
+Dependencies follow from the artifacts (a stage depends on the stages that
+write its inputs). A stage is skipped when the fingerprint of its command,
+script and input artifacts matches the one of its last successful run and all
+of its outputs exist. Stages whose dependencies are done run concurrently, so
+the Foldseek and OMA branches run side by side.
+
+Usage:
+    python pipeline.py                       # run everything that is out of date
+    python pipeline.py foldseek_plot         # run a stage and what it needs
+    python pipeline.py --dry-run             # only show what would run
+    python pipeline.py --force foldseek_annotate
+    python pipeline.py --http-mode replay    # remote lookups from the recorded archive
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# command: argument list, cwd: working directory, inputs / outputs: artifact paths
+# (files or directories), clean: remove output files before running (for scripts that append)
+Stage = namedtuple('Stage', ['name', 'command', 'cwd', 'inputs', 'outputs', 'clean'], defaults=(False,))
+
+
+def get_local_imports(script_p, search_dirs):
+    """
+    The script and every module of search_dirs it imports, directly or through other local modules.
+
+    Imports are read from the source (also those inside functions), a module is
+    local if <name>.py exists in one of search_dirs, searched in order.
+    """
+    found = []
+    todo = [pathlib.Path(script_p)]
+    while todo:
+        path = todo.pop()
+        if path in found:
+            continue
+        found.append(path)
+        for node in ast.walk(ast.parse(path.read_text(), str(path))):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                for search_dir in search_dirs:
+                    module_p = search_dir / f"{name.split('.')[0]}.py"
+                    if module_p.exists():
+                        todo.append(module_p)
+                        break
+    return found[:1] + sorted(found[1:])
+
+
+def get_stages(repo_dir, data_dir):
+    """
+    Stages of the Foldseek and OMA workflows.
+
+    The inputs of a Python stage start with its script and the local modules it imports.
+    """
+    fs = repo_dir / 'foldseek_search'
+    oma = repo_dir / 'oma_search'
+    py = sys.executable
+
+    def script(script_p):
+        # the OMA scripts add foldseek_search to sys.path for the shared modules
+        return get_local_imports(script_p, [script_p.parent, fs])
+
+    return [
+        # Foldseek branch
+        Stage('peptide_structures', [py, 'get_peptide_structures.py'], fs,
+              [*script(fs / 'get_peptide_structures.py'), oma / 'GPCRdb_peptide_ligands.csv'],
+              [fs / 'hormone_structures_v2']),
+        Stage('foldseek_search', ['bash', 'foldseek_search.sh'], fs,
+              [fs / 'foldseek_search.sh', fs / 'hormone_structures_v2'],
+              [data_dir / 'foldseek_results.txt'], clean=True),
+        Stage('foldseek_download', ['bash', 'foldseek_download.sh'], fs,
+              [fs / 'foldseek_download.sh', data_dir / 'foldseek_results.txt'],
+              [data_dir / 'foldseek_results']),
+        Stage('foldseek_parse', [py, 'foldseek_parse_results.py'], fs,
+              [*script(fs / 'foldseek_parse_results.py'), data_dir / 'foldseek_results'],
+              [data_dir / 'foldseek_parsed_results_nohuman.csv']),
+        Stage('foldseek_annotate', [py, 'foldseek_annotate.py'], fs,
+              [*script(fs / 'foldseek_annotate.py'), data_dir / 'foldseek_results', fs / 'peptide_structures.zip',
+               fs / 'GMrepo_species_taxon_ids_morethan3.txt',
+               fs / 'mgnify_human_gut_taxons.txt', fs / 'taxdump' / 'nodes.dmp', fs / 'taxdump' / 'merged.dmp'],
+              [fs / 'foldseek_annotated']),
+        Stage('common_tree', [py, 'common_tree.py'], fs,
+              [*script(fs / 'common_tree.py'), fs / 'foldseek_annotated',
+               fs / 'taxdump' / 'nodes.dmp', fs / 'taxdump' / 'names.dmp', fs / 'taxdump' / 'merged.dmp'],
+              [fs / 'foldseek_tree_common.txt', fs / 'foldseek_tree_common.csv']),
+        Stage('alignment_stats', [py, 'alignment_stats.py'], fs,
+              [*script(fs / 'alignment_stats.py'), data_dir / 'foldseek_results'],
+              [fs / 'foldseek_alignment_discrepancies.csv', fs / 'foldseek_alignment_discrepancy_summary.csv']),
+        Stage('foldseek_plot', [py, 'foldseek_plot.py'], fs,
+              [*script(fs / 'foldseek_plot.py'), fs / 'foldseek_annotated'],
+              [fs / 'plots', fs / 'top_csv' / 'top_all.csv']),
+        # OMA branch
+        Stage('hormone_sequences', [py, 'get_hormone_sequences.py'], oma,
+              [*script(oma / 'get_hormone_sequences.py'), oma / 'GPCRdb_peptide_ligands_info.txt',
+               oma / 'GPCRdb_peptides.xls'],
+              [oma / 'ligand_sequences.fasta']),
+        Stage('oma_search', [py, 'oma_search.py'], oma,
+              [*script(oma / 'oma_search.py'), oma / 'ligand_sequences.fasta'],
+              [oma / 'oma_search_results.json']),
+        Stage('oma_parse', [py, 'oma_parse_bacteria.py'], oma,
+              [*script(oma / 'oma_parse_bacteria.py'), oma / 'oma_search_results.json'],
+              [oma / 'oma_search_results_bacteria.json']),
+        Stage('oma_plot', [py, 'oma_plot_results.py'], oma,
+              [*script(oma / 'oma_plot_results.py'), oma / 'oma_search_results_bacteria.json',
+               oma / 'ligand_sequences.fasta'],
+              [oma / 'oma_plots']),
+        # both branches
+        Stage('oma_join', [py, 'oma_join.py'], fs,
+              [*script(fs / 'oma_join.py'), fs / 'foldseek_annotated',
+               oma / 'oma_search_results_bacteria.json', oma / 'ligand_sequences.fasta',
+               fs / 'taxdump' / 'nodes.dmp', fs / 'taxdump' / 'names.dmp', fs / 'taxdump' / 'merged.dmp'],
+              [fs / 'oma_foldseek_species.csv', fs / 'oma_foldseek_species_unmatched_hormones.csv']),
+    ]
+
+
+def is_within(path, parent):
+    """
+    Check if path is parent or inside it.
+    """
+    return path == parent or parent in path.parents
+
+
+def get_dependencies(stages):
+    """
+    Map each stage name to the names of the stages that write its inputs.
+    """
+    deps = {}
+    for stage in stages:
+        deps[stage.name] = set()
+        for other in stages:
+            if other.name == stage.name:
+                continue
+            if any(is_within(i, o) or is_within(o, i) for i in stage.inputs for o in other.outputs):
+                deps[stage.name].add(other.name)
+    return deps
+
+
+def load_state(state_p):
+    """
+    Load the pipeline state (stage fingerprints and the file hash cache).
+    """
+    if state_p.exists():
+        return json.loads(state_p.read_text())
+    return {'stages': {}, 'files': {}}
+
+
+def save_state(state_p, state):
+    """
+    Atomically save the pipeline state.
+    """
+    tmp_p = state_p.with_suffix('.tmp')
+    tmp_p.write_text(json.dumps(state, indent=1, sort_keys=True))
+    os.replace(tmp_p, state_p)
+
+
+def file_hash(path, file_cache):
+    """
+    Content hash of a file, reusing the cached hash while size and mtime are unchanged.
+    """
+    st = path.stat()
+    cached = file_cache.get(str(path))
+    if cached and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime_ns:
+        return cached['sha256']
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    file_cache[str(path)] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': h.hexdigest()}
+    return h.hexdigest()
+
+
+def artifact_fingerprint(path, file_cache):
+    """
+    Fingerprint of a file or of all files in a directory ('missing' if it does not exist).
+    """
+    if not path.exists():
+        return 'missing'
+    if path.is_file():
+        return file_hash(path, file_cache)
+    h = hashlib.sha256()
+    for subdir, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_p = pathlib.Path(subdir) / file
+            h.update(str(file_p.relative_to(path)).encode())
+            h.update(file_hash(file_p, file_cache).encode())
+    return h.hexdigest()
+
+
+def stage_fingerprint(stage, env, file_cache):
+    """
+    Fingerprint of a stage: its command, environment and input artifacts.
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([stage.command, str(stage.cwd), env]).encode())
+    for path in stage.inputs:
+        h.update(str(path).encode())
+        h.update(artifact_fingerprint(path, file_cache).encode())
+    return h.hexdigest()
+
+
+def is_up_to_date(stage, fingerprint, state):
+    """
+    Check if a stage ran successfully with the same fingerprint and its outputs still exist.
+    """
+    previous = state['stages'].get(stage.name, {})
+    return previous.get('fingerprint') == fingerprint and all(o.exists() for o in stage.outputs)
+
+
+def run_stage(stage, env, log_dir):
+    """
+    Run the command of a stage, logging its output. Returns the exit code and runtime.
+    """
+    # files written in append mode (e.g. foldseek_results.txt) must start empty
+    if stage.clean:
+        for o in stage.outputs:
+            if o.is_file():
+                o.unlink()
+    start = time.time()
+    log_p = log_dir / f'{stage.name}.log'
+    with open(log_p, 'w') as log:
+        code = subprocess.call(stage.command, cwd=stage.cwd, env={**os.environ, **env},
+                               stdout=log, stderr=subprocess.STDOUT)
+    return code, time.time() - start
+
+
+def select_stages(stages, deps, targets):
+    """
+    The target stages and everything they depend on (all stages without targets).
+    """
+    if not targets:
+        return stages
+    names = {s.name for s in stages}
+    unknown = set(targets) - names
+    assert not unknown, f"unknown stages {sorted(unknown)}, options are {sorted(names)}"
+    selected = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(deps[name])
+    return [s for s in stages if s.name in selected]
+
+
+def run_pipeline(stages, env, state_p, log_dir, jobs=2, force=(), dry_run=False):
+    """
+    Run out-of-date stages, in parallel where their dependencies allow it.
+
+    Returns the status ('skipped', 'done', 'failed', 'blocked', 'would run' or 'pending') per
+    stage. In a dry run, stages after a stage that would run are 'pending': their inputs
+    are only known once it ran.
+    """
+    state = load_state(state_p)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    names = {s.name for s in stages}
+    deps = {name: d & names for name, d in get_dependencies(stages).items() if name in names}
+    by_name = {s.name: s for s in stages}
+    status = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(status) < len(stages):
+            progress = False
+            for name, stage in by_name.items():
+                if name in status or name in running.values():
+                    continue
+                if any(status.get(d) in ('failed', 'blocked') for d in deps[name]):
+                    status[name] = 'blocked'
+                    print(f"[blocked] {name}")
+                    continue
+                if not all(d in status for d in deps[name]):
+                    continue
+                progress = True
+                if dry_run and any(status[d] in ('would run', 'pending') for d in deps[name]):
+                    status[name] = 'pending'
+                    print(f"[pending] {name}")
+                    continue
+                fingerprint = stage_fingerprint(stage, env, state['files'])
+                if name not in force and is_up_to_date(stage, fingerprint, state):
+                    status[name] = 'skipped'
+                    print(f"[up to date] {name}")
+                elif dry_run:
+                    status[name] = 'would run'
+                    print(f"[would run] {name}")
+                else:
+                    print(f"[running] {name}")
+                    future = executor.submit(run_stage, stage, env, log_dir)
+                    running[future] = name
+                    state['stages'].setdefault(name, {})['pending'] = fingerprint
+
+            if not running:
+                if not progress:
+                    # only possible with circular dependencies
+                    for name in by_name:
+                        status.setdefault(name, 'blocked')
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                code, runtime = future.result()
+                entry = state['stages'][name]
+                fingerprint = entry.pop('pending')
+                if code == 0:
+                    entry.update({'fingerprint': fingerprint, 'runtime': round(runtime, 1)})
+                    status[name] = 'done'
+                    print(f"[done] {name} ({runtime:.1f} s)")
+                else:
+                    entry.pop('fingerprint', None)
+                    status[name] = 'failed'
+                    print(f"[failed] {name} (exit code {code}, see {log_dir / (name + '.log')})")
+                save_state(state_p, state)
+    save_state(state_p, state)
+    return status
+
+
+def main():
+    repo_dir = pathlib.Path(__file__).parent.absolute()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (default: all)')
+    parser.add_argument('--data-dir', default=os.environ.get('DATA_DIR', '/projects/ilfgrid/data/lzr765'),
+                        help='directory for the foldseek results')
+    parser.add_argument('--jobs', type=int, default=2, help='number of stages to run at the same time')
+    parser.add_argument('--force', nargs='*', default=[], help='stages to rerun even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only show which stages would run')
+    parser.add_argument('--http-mode', choices=['live', 'record', 'replay'], default=None,
+                        help='record the remote lookups, or replay them offline (see foldseek_search/http_client.py)')
+    args = parser.parse_args()
+
+    # not part of the stage fingerprints: replayed responses give the same results
+    if args.http_mode:
+        os.environ['HTTP_MODE'] = args.http_mode
+
+    data_dir = pathlib.Path(args.data_dir).absolute()
+    env = {
+        'DATA_DIR': str(data_dir),
+        'PDB_DIR': str(repo_dir / 'foldseek_search' / 'hormone_structures_v2'),
+    }
+    stages = get_stages(repo_dir, data_dir)
+    stages = select_stages(stages, get_dependencies(stages), args.targets)
+    status = run_pipeline(stages, env, repo_dir / '.pipeline_state.json', repo_dir / 'pipeline_logs',
+                          jobs=args.jobs, force=set(args.force), dry_run=args.dry_run)
+    if any(s in ('failed', 'blocked') for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+""" The scripts of foldseek_search import each other as top-level modules, as when they are run from their directory.
+"""
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute() / 'foldseek_search'))
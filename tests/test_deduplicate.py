@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from deduplicate import deduplicate_hits, expand_source_databases
+
+
+def make_hits():
+    """
+    Three copies of target P1 (two databases and a duplicate in afdb50) and one of P2 with the same sequence.
+    """
+    return pd.DataFrame({
+        'Query': ['q1', 'q1', 'q1', 'q1'],
+        'Filename': ['alis_afdb50.m8', 'alis_afdb-swissprot.m8', 'alis_afdb50.m8', 'alis_afdb50.m8'],
+        'Target and Description': ['AF-P1-F1-model_v4 a', 'AF-P1-F1-model_v4 a', 'AF-P1-F1-model_v4 a',
+                                   'AF-P2-F1-model_v4 b'],
+        'tseq': ['ACDEFGHIK', 'acdefghik', 'ACDEFGHIK', 'ACDEFGHIK'],
+        'E-value': [1e-5, 1e-5, 1e-3, 1e-4],
+        'Score(not sure)': [10.0, 20.0, 30.0, 5.0],
+        'Probability': [0.5, 0.9, 0.9, 0.1],
+        'pident': [30.0, 40.0, 50.0, 60.0],
+    })
+
+
+def test_evalue_tie_break_uses_score():
+    deduplicated = deduplicate_hits(make_hits(), tie_break='evalue')
+    # equal E-values, the higher score wins; P2 is a different accession
+    assert deduplicated.index.tolist() == [1, 3]
+    assert deduplicated['Copies'].tolist() == [3, 1]
+    assert deduplicated['Source databases'].tolist() == ['afdb-swissprot;afdb50', 'afdb50']
+
+
+def test_prob_tie_break_uses_evalue():
+    # equal probabilities, the lower E-value wins
+    assert deduplicate_hits(make_hits(), tie_break='prob').index.tolist() == [1, 3]
+
+
+def test_pident_tie_break():
+    assert deduplicate_hits(make_hits(), tie_break='pident').index.tolist() == [2, 3]
+
+
+def test_ties_keep_the_first_row():
+    hits = make_hits().assign(**{'E-value': 1e-5, 'Score(not sure)': 1.0})
+    assert deduplicate_hits(hits, tie_break='evalue').index.tolist() == [0, 3]
+
+
+def test_queries_are_not_merged():
+    hits = make_hits().assign(Query=['q1', 'q2', 'q1', 'q2'])
+    assert deduplicate_hits(hits).index.tolist() == [0, 1, 3]
+
+
+def test_minhash_stays_within_an_accession():
+    hits = make_hits()
+    hits.loc[2, 'tseq'] = 'ACDEFGHIKL'
+    deduplicated = deduplicate_hits(hits, minhash=True, threshold=0.5)
+    assert deduplicated['Target and Description'].str[:5].tolist() == ['AF-P1', 'AF-P2']
+
+
+def test_missing_filename():
+    hits = make_hits()
+    hits.loc[0, 'Filename'] = np.nan
+    deduplicated = deduplicate_hits(hits)
+    assert deduplicated['Source databases'].tolist() == [';afdb-swissprot;afdb50', 'afdb50']
+
+
+def test_expand_source_databases():
+    expanded = expand_source_databases(deduplicate_hits(make_hits()))
+    assert expanded['Filename'].tolist() == ['alis_afdb-swissprot.m8', 'alis_afdb50.m8', 'alis_afdb50.m8']
@@ -0,0 +1,83 @@
+import pandas as pd
+
+from foldseek_parse_results import ParseFilter, get_column_names, iter_m8_rows, to_dataframe
+
+
+def write_m8(path, rows):
+    """
+    Write m8 lines of (target, pident, alnlen, prob, evalue, species) rows.
+    """
+    lines = ['# comment']
+    for i, (target, pident, alnlen, prob, evalue, species) in enumerate(rows):
+        lines.append('\t'.join(map(str, [
+            'job', target, pident, alnlen, 0, 0, 1, alnlen, 1, alnlen, prob, evalue, 50 - i, alnlen, 100,
+            'AC-D', 'ACD-', '1.0,2.0,3.0', 'ACDE', 9606 if species == 'Homo sapiens' else 562, species])))
+    lines.append('short\tline')
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def get_rows():
+    return [
+        ('t1', 30.0, 20, 0.9, 1e-5, 'Escherichia coli'),
+        ('t2', 50.0, 10, 0.2, 1e-2, 'Escherichia coli'),
+        ('t3', 80.0, 40, 1.0, 1e-9, 'Homo sapiens'),
+        ('t4', 20.0, 30, 0.7, 1e-5, 'Bacteroides fragilis'),
+        ('t5', 90.0, 50, 0.95, 1e-7, 'Bacteroides fragilis'),
+        ('t6', 10.0, 5, 0.1, 'nan', 'Escherichia coli'),
+    ]
+
+
+def parse(path, parse_filter):
+    df = pd.DataFrame(list(iter_m8_rows(str(path), parse_filter)), columns=get_column_names())
+    for column in ['pident', 'alnlen', 'Probability', 'E-value']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+def test_empty_filter_matches_unfiltered(tmp_path):
+    path = tmp_path / 'q1' / 'alis_afdb50.m8'
+    path.parent.mkdir()
+    write_m8(path, get_rows())
+    unfiltered = list(iter_m8_rows(str(path)))
+    assert len(unfiltered) == len(get_rows())
+    assert unfiltered[0][:4] == ['q1', 'alis_afdb50.m8', 'job', 't1']
+    assert list(iter_m8_rows(str(path), ParseFilter())) == unfiltered
+
+
+def test_filters_match_filtering_the_parsed_rows(tmp_path):
+    path = tmp_path / 'q1' / 'alis_afdb50.m8'
+    path.parent.mkdir()
+    write_m8(path, get_rows())
+    df = parse(path, None)
+    checks = [
+        (ParseFilter(max_evalue=1e-4), df['E-value'] <= 1e-4),
+        (ParseFilter(min_prob=0.5), df['Probability'] >= 0.5),
+        (ParseFilter(min_alnlen=20), df['alnlen'] >= 20),
+        (ParseFilter(min_pident=30), df['pident'] >= 30),
+        (ParseFilter(exclude_species=('Bacteroides fragilis',)), df['taxname/species'] != 'Bacteroides fragilis'),
+        (ParseFilter(max_evalue=1e-4, min_pident=25, exclude_species=('Homo sapiens',)),
+         (df['E-value'] <= 1e-4) & (df['pident'] >= 25) & (df['taxname/species'] != 'Homo sapiens')),
+    ]
+    for parse_filter, expected in checks:
+        assert parse(path, parse_filter)['Target and Description'].tolist() == \
+            df.loc[expected, 'Target and Description'].tolist(), parse_filter
+
+
+def test_top_n_per_database(tmp_path):
+    path = tmp_path / 'q1' / 'alis_afdb50.m8'
+    path.parent.mkdir()
+    write_m8(path, get_rows())
+    df = parse(path, None)
+    # lowest E-values, the earlier line wins ties, kept in file order
+    expected = df.dropna(subset=['E-value']).nsmallest(3, 'E-value', keep='first').sort_index()
+    top = parse(path, ParseFilter(top_n_per_database=3))
+    assert top['Target and Description'].tolist() == expected['Target and Description'].tolist()
+
+
+def test_to_dataframe_drops_human_hits(tmp_path):
+    path = tmp_path / 'q1' / 'alis_afdb50.m8'
+    path.parent.mkdir()
+    write_m8(path, get_rows())
+    df = to_dataframe(list(iter_m8_rows(str(path))))
+    assert 't3' not in df['Target and Description'].tolist()
+    assert len(df) == len(get_rows()) - 1
@@ -0,0 +1,15 @@
+from http_client import request_key
+
+
+def test_request_key_ignores_contact_params():
+    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+    key = request_key('post', url, data={'db': 'taxonomy', 'id': '9606'})
+    assert request_key('POST', url, data={'id': '9606', 'db': 'taxonomy', 'email': 'a@b.c', 'tool': 'x'}) == key
+    assert request_key('POST', url, data={'db': 'taxonomy', 'id': '562'}) != key
+    assert request_key('GET', url, params={'db': 'taxonomy', 'id': '9606'}) != key
+
+
+def test_request_key_params():
+    url = 'https://rest.uniprot.org/taxonomy/search'
+    assert request_key('GET', url, {'query': 'E. coli', 'email': 'a@b.c'}) == request_key('GET', url, {'query': 'E. coli'})
+    assert request_key('GET', url, {'query': 'E. coli'}) != request_key('GET', url + '/', {'query': 'E. coli'})
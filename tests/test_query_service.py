@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from query_service import ColumnIndex
+
+
+def test_lookup():
+    index = ColumnIndex.build(np.array(['b', 'a', 'b', 'c', 'a', 'b']))
+    assert index.lookup(['b']).tolist() == [0, 2, 5]
+    assert index.lookup(['a', 'c']).tolist() == [1, 3, 4]
+    assert index.lookup(['c', 'a', 'a']).tolist() == [1, 3, 4]
+    assert index.lookup(['d']).tolist() == []
+    assert index.counts().to_dict() == {'a': 2, 'b': 3, 'c': 1}
+
+
+def test_lookup_numeric_and_missing_keys():
+    index = ColumnIndex.build(pd.Series([9606.0, np.nan, 562.0, 9606.0]))
+    assert index.lookup(['9606']).tolist() == [0, 3]
+    assert index.lookup(['']).tolist() == [1]
+
+
+def test_save_and_load(tmp_path):
+    index = ColumnIndex.build(np.array(['x', 'y', 'x']))
+    index.save(tmp_path / 'index.npz')
+    loaded = ColumnIndex.load(tmp_path / 'index.npz')
+    assert loaded.lookup(['x']).tolist() == [0, 2]
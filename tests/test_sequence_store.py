@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sequence_store import SequenceStore, encode, decode, get_sequence_ids, resolve_sequences, store_sequences
+
+
+def test_encode_decode_round_trip():
+    seqs = ['ACDEFGHIKLMNPQRSTVWY', 'M', 'ACDEFGHI', 'ACDEFGHIK', '', 'BZXUOJ*-', 'WWWWWWWWWWWWWWWWW']
+    packed, groups = encode(seqs)
+    assert len(packed) == 5 * groups.sum()
+    assert decode(packed, groups, [len(s) for s in seqs]) == seqs
+
+
+def test_unknown_letters_decode_as_x():
+    packed, groups = encode(['AC9E'])
+    assert decode(packed, groups, [4]) == ['ACXE']
+
+
+def test_store_add_and_get(tmp_path):
+    store = SequenceStore(tmp_path)
+    ids = store.add(['ACDE', 'acde', 'MKV', None, ''])
+    assert ids[0] == ids[1] and pd.isna(ids[3]) and pd.isna(ids[4])
+    assert len(store) == 2
+    assert list(SequenceStore(tmp_path).get(ids)) == ['ACDE', 'ACDE', 'MKV', None, None]
+
+    # stored sequences are not appended again
+    size = store.data_p.stat().st_size
+    assert list(SequenceStore(tmp_path).add(['MKV', 'ACDE'])) == [ids[2], ids[0]]
+    assert store.data_p.stat().st_size == size
+
+
+def test_collision_with_the_store(tmp_path):
+    store = SequenceStore(tmp_path)
+    store.add(['ACDE'])
+    # pretend that MKV hashes to the ID of ACDE
+    store.ids[:] = np.uint64(get_sequence_ids(['MKV'])[0])
+    with pytest.raises(ValueError):
+        store.add(['MKV'])
+
+
+def test_store_and_resolve_sequences(tmp_path):
+    store = SequenceStore(tmp_path)
+    hits = pd.DataFrame({'Query': ['q1', 'q1', 'q2'], 'tseq': ['ACDE', 'MKV', 'ACDE'], 'Taxid': [1, 2, 3]})
+    stored = store_sequences(hits, store)
+    assert stored.columns.tolist() == ['Query', 'tseq_id', 'Taxid']
+    resolved = resolve_sequences(stored, SequenceStore(tmp_path), batch_size=2)
+    assert resolved['tseq'].tolist() == hits['tseq'].tolist()
@@ -0,0 +1,48 @@
+import numpy as np
+
+from taxonomy_index import TaxonomyIndex
+
+
+def make_index():
+    """
+    1 root
+    ├── 2 superkingdom
+    │   ├── 3 genus
+    │   │   ├── 4 species
+    │   │   └── 5 species
+    │   └── 6 genus
+    │       └── 7 species
+    └── 8 superkingdom
+        └── 9 species
+    10 was merged into 5.
+    """
+    taxids = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    parents = [1, 1, 2, 3, 3, 2, 6, 1, 8]
+    ranks = ['no rank', 'superkingdom', 'genus', 'species', 'species', 'genus', 'species', 'superkingdom',
+             'species']
+    return TaxonomyIndex(taxids, parents, ranks, merged={10: 5})
+
+
+def test_is_descendant_of_any():
+    index = make_index()
+    taxids = [4, 5, 7, 9, 3, 10, 11, np.nan]
+    assert index.is_descendant_of_any(taxids, [3]).tolist() == [True, True, False, False, True, True, False,
+                                                                False]
+    # nested references are merged, disjoint ones are both checked
+    assert index.is_descendant_of_any(taxids, [2, 3, 9]).tolist() == [True, True, True, True, True, True,
+                                                                      False, False]
+    assert not index.is_descendant_of_any(taxids, []).any()
+
+
+def test_is_descendant_of_any_reuses_intervals():
+    index = make_index()
+    intervals = index.reference_intervals([6, 8])
+    assert index.is_descendant_of_any([7, 9, 4], intervals=intervals).tolist() == [True, True, False]
+
+
+def test_at_rank():
+    index = make_index()
+    taxids = [4, 5, 7, 9, 3, 10, 1, 11]
+    assert index.at_rank(taxids, 'genus').tolist() == [3, 3, 6, -1, 3, 3, -1, -1]
+    assert index.at_rank(taxids, 'superkingdom').tolist() == [2, 2, 2, 8, 2, 2, -1, -1]
+    assert index.at_rank(taxids, 'species').tolist() == [4, 5, 7, 9, -1, 5, -1, -1]